@@ -1,6 +1,9 @@
 import json
 import os
-from flask import request, abort
+import threading
+import time
+from flask import request, abort, g, current_app
+from flask.signals import Namespace
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
@@ -12,6 +15,37 @@ load_dotenv
 AUTH0_DOMAIN = os.getenv("AUTH0_DOMAIN")
 ALGORITHMS = os.getenv("ALGORITHMS")
 API_AUDIENCE = os.getenv("API_AUDIENCE")
+JWKS_CACHE_TTL = int(os.getenv("JWKS_CACHE_TTL", 60 * 60))
+JWKS_MIN_REFRESH = int(os.getenv("JWKS_MIN_REFRESH", 60))
+
+auth_signals = Namespace()
+
+# sent with the decoded payload once a request's token is verified and its
+# permission checked, e.g. for per-client rate limits keyed on the subject
+auth_verified = auth_signals.signal('auth-verified')
+
+## JWKS
+
+'''
+Implemented get_jwks(refresh) method
+    it returns the signing keys from Auth0 /.well-known/jwks.json
+    the keys are fetched once and kept for JWKS_CACHE_TTL seconds, so a
+    request does not wait on Auth0 unless the keys have expired
+    refresh=True refetches early (a token signed with a key we do not know
+    yet, after Auth0 rotated its keys), at most once per JWKS_MIN_REFRESH
+'''
+_jwks = {'keys': None, 'fetched_at': 0.0}
+_jwks_lock = threading.Lock()
+
+
+def get_jwks(refresh=False):
+    with _jwks_lock:
+        age = time.monotonic() - _jwks['fetched_at']
+        if _jwks['keys'] is None or age > JWKS_CACHE_TTL or (refresh and age > JWKS_MIN_REFRESH):
+            jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+            _jwks['keys'] = json.loads(jsonurl.read())['keys']
+            _jwks['fetched_at'] = time.monotonic()
+        return _jwks['keys']
 
 ## AuthError Exception
 '''
@@ -90,7 +124,7 @@ Implemented verify_decode_jwt(token) method
         token: a json web token (string)
 
     it is an Auth0 token with key id (kid)
-    it verifies the token using Auth0 /.well-known/jwks.json
+    it verifies the token using Auth0 /.well-known/jwks.json (cached, see get_jwks)
     it decodes the payload from the token
     it validates the claims
     returns the decoded payload
@@ -98,8 +132,6 @@ Implemented verify_decode_jwt(token) method
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -108,7 +140,11 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
+    keys = get_jwks()
+    if not any(key['kid'] == unverified_header['kid'] for key in keys):
+        keys = get_jwks(refresh=True)
+
+    for key in keys:
         if key['kid'] == unverified_header['kid']:
             rsa_key = {
                 'kty': key['kty'],
@@ -158,6 +194,7 @@ Implemented @requires_auth(permission) decorator method
     it uses the get_token_auth_header method to get the token
     it uses the verify_decode_jwt method to decode the jwt
     it uses the check_permissions method validate claims and check the requested permission
+    it stores the payload on flask.g and sends the auth_verified signal
     returns the decorator which passes the decoded payload to the decorated method
 '''
 def requires_auth(permission=''):
@@ -170,6 +207,8 @@ def requires_auth(permission=''):
             except:
                 abort(401)
             check_permissions(permission, payload)
+            g.auth_payload = payload
+            auth_verified.send(current_app._get_current_object(), payload=payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,121 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from dotenv import load_dotenv
+load_dotenv()
+
+PASSWORD_HASH_ITERATIONS = int(os.getenv("PASSWORD_HASH_ITERATIONS", 260000))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 2))
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", 32))
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", 5))
+
+ALGORITHM = "pbkdf2_sha256"
+
+'''
+PasswordHashBusy Exception
+raised when the hashing pool is saturated, so the caller can shed the
+login instead of tying up a request worker
+'''
+class PasswordHashBusy(Exception):
+    pass
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt.encode("ascii"), iterations)
+
+'''
+hash_password(password, iterations)
+    returns an encoded "pbkdf2_sha256$<iterations>$<salt>$<hash>" string,
+    suitable for User.actual_password
+'''
+def hash_password(password, iterations=None):
+    iterations = iterations or PASSWORD_HASH_ITERATIONS
+    salt = _b64(secrets.token_bytes(16))
+    return "{}${}${}${}".format(ALGORITHM, iterations, salt, _b64(_pbkdf2(password, salt, iterations)))
+
+'''
+check_password(password, encoded)
+    returns (matches, needs_rehash). values that are not in the encoded
+    format are legacy plain-text passwords; they are still accepted once so
+    the caller can upgrade them in place.
+'''
+def check_password(password, encoded):
+    if not encoded:
+        return False, False
+
+    parts = encoded.split("$")
+    if len(parts) != 4 or parts[0] != ALGORITHM:
+        matches = hmac.compare_digest(password.encode("utf-8"), encoded.encode("utf-8"))
+        return matches, matches
+
+    # a corrupted stored hash is a failed login, not a server error
+    if not "".join(parts[1:]).isascii() or not parts[1].isdigit() or int(parts[1]) < 1:
+        return False, False
+    iterations = int(parts[1])
+    matches = hmac.compare_digest(_b64(_pbkdf2(password, parts[2], iterations)), parts[3])
+    return matches, matches and iterations != PASSWORD_HASH_ITERATIONS
+
+
+'''
+The hashing pool
+    pbkdf2_hmac releases the GIL, so hashes run in a small dedicated thread
+    pool. a semaphore bounds how many logins may be hashing or queued at
+    once; past that, PasswordHashBusy is raised right away instead of letting
+    a burst of logins pile up behind every request worker.
+'''
+_pool = None
+_pool_pid = None
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE)
+_pool_lock = threading.Lock()
+_dummy_hash = None
+
+
+def _executor():
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pool = ThreadPoolExecutor(PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def run_in_pool(fn, *args):
+    if not _slots.acquire(blocking=False):
+        raise PasswordHashBusy()
+    try:
+        future = _executor().submit(fn, *args)
+    except Exception:
+        _slots.release()
+        raise
+    # the slot is held until the hash really finishes, even if we stop waiting
+    future.add_done_callback(lambda f: _slots.release())
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except FutureTimeout:
+        raise PasswordHashBusy()
+
+
+def verify_password(password, encoded):
+    return run_in_pool(check_password, password, encoded)
+
+
+def verify_dummy_password(password):
+    # used when no user matches, so unknown accounts take as long as known ones
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hash_password(secrets.token_urlsafe(16))
+    return run_in_pool(check_password, password, _dummy_hash)
+
+
+def hash_password_pooled(password):
+    return run_in_pool(hash_password, password)
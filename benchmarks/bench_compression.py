@@ -0,0 +1,85 @@
+"""
+CPU-versus-bytes benchmark for response compression.
+
+Builds a student listing payload like the list/export endpoints return and
+reports, per encoding and level, the compressed size and the CPU time per
+response, next to the cost of serving the same page from the compressed
+body cache (hash the body, look it up).
+
+    python benchmarks/bench_compression.py --rows 1000
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def payload(rows):
+    programs = ["Data Science", "Web Development", "Cloud Engineering", "UI/UX Design"]
+    students = [
+        {
+            "id": i,
+            "user_id": i,
+            "course_id": random.randint(1, 40),
+            "date_of_birth": "Tue, 14 Mar 2000 00:00:00 GMT",
+            "program_start_date": "Mon, 14 Feb 2022 00:00:00 GMT",
+            "program_end_date": "Mon, 15 Aug 2022 00:00:00 GMT",
+            "accommodation": random.random() < 0.5,
+            "amount_paid": random.randint(0, 500000),
+            "gender": random.choice(["male", "female"]),
+            "student_program": random.choice(programs),
+            "marital_status": random.choice(["single", "married"]),
+            "health_condition": None,
+            "disability": None,
+            "profile_picture": None,
+        }
+        for i in range(rows)
+    ]
+    return json.dumps({"success": True, "students": students, "total_students": rows}).encode()
+
+
+def timed(fn, repeat):
+    started = time.process_time()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.process_time() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    body = payload(args.rows)
+    print("uncompressed {} bytes".format(len(body)))
+    print("{:<12} {:>10} {:>8} {:>12}".format("encoding", "bytes", "ratio", "cpu/resp ms"))
+
+    cases = [("gzip-{}".format(level), lambda level=level: gzip.compress(body, compresslevel=level, mtime=0)) for level in (1, 6, 9)]
+    if brotli is not None:
+        cases += [("br-{}".format(quality), lambda quality=quality: brotli.compress(body, quality=quality)) for quality in (1, 5, 11)]
+
+    cache = {}
+    digest = hashlib.blake2b(body, digest_size=16).digest()
+    for name, fn in cases:
+        compressed, cpu = timed(fn, args.repeat)
+        cache[(name, digest)] = compressed
+        print("{:<12} {:>10} {:>8.2f} {:>12.3f}".format(name, len(compressed), len(body) / len(compressed), cpu * 1000))
+
+    hit, cpu = timed(lambda: cache[("gzip-6", hashlib.blake2b(body, digest_size=16).digest())], args.repeat * 10)
+    print("{:<12} {:>10} {:>8} {:>12.3f}".format("cache hit", "-", "-", cpu * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Login throughput and latency benchmark for password verification.
+
+Simulates a burst of logins from many request threads against the bounded
+hashing pool and reports accepted logins per second, latency percentiles and
+how many logins were shed with PasswordHashBusy.
+
+    PASSWORD_HASH_ITERATIONS=260000 python benchmarks/bench_login.py --clients 64 --logins 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from auth import passwords
+
+
+def client(encoded, logins, latencies, shed, lock):
+    for _ in range(logins):
+        started = time.perf_counter()
+        try:
+            matches, _ = passwords.verify_password("correct horse", encoded)
+            assert matches
+        except passwords.PasswordHashBusy:
+            with lock:
+                shed.append(1)
+            continue
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=64, help="concurrent request threads")
+    parser.add_argument("--logins", type=int, default=20, help="logins per client")
+    args = parser.parse_args()
+
+    encoded = passwords.hash_password("correct horse")
+    started = time.perf_counter()
+    passwords.check_password("correct horse", encoded)
+    print("iterations={} single hash={:.1f}ms workers={} queue={}".format(
+        passwords.PASSWORD_HASH_ITERATIONS, (time.perf_counter() - started) * 1000,
+        passwords.PASSWORD_HASH_WORKERS, passwords.PASSWORD_HASH_QUEUE))
+
+    latencies, shed, lock = [], [], threading.Lock()
+    threads = [
+        threading.Thread(target=client, args=(encoded, args.logins, latencies, shed, lock))
+        for _ in range(args.clients)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print("accepted={} shed={} elapsed={:.2f}s throughput={:.1f} logins/s".format(
+        len(latencies), len(shed), elapsed, len(latencies) / elapsed))
+    if latencies:
+        print("latency mean={:.1f}ms p50={:.1f}ms p99={:.1f}ms".format(
+            statistics.mean(latencies) * 1000,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Schedule conflict checks, interval trees versus comparing every pair.
+
+Generates a synthetic catalogue (courses of 4 to 16 weeks spread over two
+years, shared between instructors, with students in a few courses each),
+then times, for nupatcodeclass/schedule.py and for the pairwise scan it
+replaces:
+
+    - checking one new course against its instructor's courses
+    - listing every instructor and student conflict of a 3-month term
+
+Needs no database.
+
+    python benchmarks/bench_schedule.py --courses 5000 --instructors 300 --students 20000
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from nupatcodeclass.schedule import Schedule, instructor_key
+
+
+def catalogue(courses, instructors, students, per_student, seed):
+    rng = random.Random(seed)
+    first_day = datetime.datetime(2023, 1, 1)
+    rows = []
+    for course_id in range(1, courses + 1):
+        start = first_day + datetime.timedelta(days=rng.randrange(730))
+        end = start + datetime.timedelta(weeks=rng.randint(4, 16))
+        rows.append((course_id, "Course {}".format(course_id), "Instructor {}".format(rng.randrange(instructors)), start, end))
+    enrollments = {
+        student_id: set(rng.sample(range(1, courses + 1), per_student))
+        for student_id in range(1, students + 1)
+    }
+    return rows, enrollments
+
+
+def pairwise_course_check(rows, new):
+    return [
+        row for row in rows
+        if row[0] != new[0] and instructor_key(row[2]) == instructor_key(new[2]) and row[3] <= new[4] and new[3] <= row[4]
+    ]
+
+
+def pairwise_term(rows, enrollments, lo, hi):
+    in_term = [row for row in rows if row[3] <= hi and lo <= row[4]]
+    by_id = {row[0]: row for row in rows}
+    # a conflict counts when either of its courses runs in the term
+    pairs = set()
+    for a in in_term:
+        for b in rows:
+            if a[0] != b[0] and instructor_key(a[2]) == instructor_key(b[2]) and a[3] <= b[4] and b[3] <= a[4]:
+                pairs.add((min(a[0], b[0]), max(a[0], b[0])))
+    instructors = len(pairs)
+    students = 0
+    for course_ids in enrollments.values():
+        mine = sorted(by_id[course_id] for course_id in course_ids)
+        for i, a in enumerate(mine):
+            for b in mine[i + 1:]:
+                if a[3] <= b[4] and b[3] <= a[4] and (a[3] <= hi and lo <= a[4] or b[3] <= hi and lo <= b[4]):
+                    students += 1
+    return instructors, students
+
+
+def timed(fn, repeat=1):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--courses", type=int, default=5000)
+    parser.add_argument("--instructors", type=int, default=300)
+    parser.add_argument("--students", type=int, default=20000)
+    parser.add_argument("--per-student", type=int, default=3)
+    parser.add_argument("--checks", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rows, enrollments = catalogue(args.courses, args.instructors, args.students, args.per_student, args.seed)
+
+    def build():
+        schedule = Schedule()
+        for row in rows:
+            schedule.set_course(*row)
+        for student_id, course_ids in enrollments.items():
+            schedule.set_enrollments(student_id, course_ids)
+        return schedule
+
+    schedule, build_seconds = timed(build)
+    print("build: {:.3f}s for {} courses, {} students".format(build_seconds, len(rows), len(enrollments)))
+
+    rng = random.Random(args.seed + 1)
+    checks = [rows[rng.randrange(len(rows))] for _ in range(args.checks)]
+
+    def tree_checks():
+        found = 0
+        for row in checks:
+            schedule.set_course(*row)
+            found += len(schedule.course_conflicts(row[0]))
+        return found
+
+    def pairwise_checks():
+        return sum(len(pairwise_course_check(rows, row)) for row in checks)
+
+    tree_found, tree_seconds = timed(tree_checks)
+    pair_found, pair_seconds = timed(pairwise_checks)
+    assert tree_found == pair_found, (tree_found, pair_found)
+    print("insert check: tree {:8.1f} us   pairwise {:10.1f} us   ({} conflicts)".format(
+        tree_seconds / args.checks * 1e6, pair_seconds / args.checks * 1e6, tree_found))
+
+    lo, hi = datetime.datetime(2024, 1, 1), datetime.datetime(2024, 3, 31, 23, 59, 59)
+    conflicts, tree_seconds = timed(lambda: schedule.term_conflicts(lo, hi))
+    (instructors, students), pair_seconds = timed(lambda: pairwise_term(rows, enrollments, lo, hi))
+    assert (len(conflicts["instructors"]), len(conflicts["students"])) == (instructors, students)
+    print("term conflicts: tree {:.3f}s   pairwise {:.3f}s   ({} instructor, {} student)".format(
+        tree_seconds, pair_seconds, instructors, students))
+
+
+if __name__ == "__main__":
+    main()
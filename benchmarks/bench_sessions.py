@@ -0,0 +1,83 @@
+"""
+Concurrent login benchmark for the SQLite session store.
+
+Every simulated login writes a fresh session with the keys /login sets and
+reads it back on a follow-up request, from several worker processes sharing
+one store file, the same way forked app workers would.
+
+    python benchmarks/bench_sessions.py --workers 8 --logins 2000
+"""
+import argparse
+import os
+import secrets
+import statistics
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from nupatcodeclass.sessions import SqliteSessionInterface, SqliteSessionStore
+
+
+def run_logins(args):
+    path, logins, ttl = args
+    store = SqliteSessionStore(path, sweep_interval=0)
+    serializer = SqliteSessionInterface.serializer
+    latencies = []
+
+    for i in range(logins):
+        started = time.perf_counter()
+        sid = secrets.token_urlsafe(32)
+        data = {
+            "loggedin": True,
+            "new_email": "student{}@nupat.test".format(i),
+            "new_username": "student{}".format(i),
+            "new_role": "student",
+        }
+        store.set(sid, serializer.dumps(data), time.time() + ttl)
+        serializer.loads(store.get(sid)[0])
+        latencies.append(time.perf_counter() - started)
+
+    return latencies
+
+
+def percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--logins", type=int, default=2000, help="logins per worker")
+    parser.add_argument("--max-entries", type=int, default=50000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sessions.db")
+        store = SqliteSessionStore(path, max_entries=args.max_entries, sweep_interval=0)
+
+        started = time.perf_counter()
+        with Pool(args.workers) as pool:
+            results = pool.map(run_logins, [(path, args.logins, 3600)] * args.workers)
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(l for worker in results for l in worker)
+        total = len(latencies)
+        print("workers={} logins={} elapsed={:.2f}s throughput={:.0f} logins/s".format(
+            args.workers, total, elapsed, total / elapsed))
+        print("latency mean={:.3f}ms p50={:.3f}ms p99={:.3f}ms max={:.3f}ms".format(
+            statistics.mean(latencies) * 1000,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000,
+            latencies[-1] * 1000))
+
+        started = time.perf_counter()
+        removed = store.sweep()
+        print("sweep removed={} remaining={} in {:.3f}ms".format(
+            removed, store.count(), (time.perf_counter() - started) * 1000))
+
+
+if __name__ == "__main__":
+    main()
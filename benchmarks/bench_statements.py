@@ -0,0 +1,77 @@
+"""
+Per-request CPU of the hot read paths, ORM query versus statement layer.
+
+Times the /students list page (one page plus the total) and the detail
+lookup by id, each built the old way (Model.query chains, rebuilt and
+re-keyed on every call) and through nupatcodeclass/statements.py, and
+reports the CPU time per call. The identity map is cleared between calls
+so every detail lookup really goes to the database. Needs the database
+from .env.
+
+    python benchmarks/bench_statements.py --iterations 2000
+    DB_DRIVER=psycopg python benchmarks/bench_statements.py   # with server-side prepares
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from models import db, Student
+from nupatcodeclass import STUDENTS_PER_PAGE, create_app, statements
+
+
+def orm_page():
+    selection = Student.query.order_by(Student.id)
+    items = selection.offset(0).limit(STUDENTS_PER_PAGE).all()
+    return items, selection.order_by(None).count()
+
+
+def statement_page():
+    return statements.page(Student, 0, STUDENTS_PER_PAGE), statements.count(Student)
+
+
+def orm_detail(student_id):
+    return Student.query.filter(Student.id == student_id).one_or_none()
+
+
+def statement_detail(student_id):
+    return statements.get(Student, student_id)
+
+
+def measure(fn, iterations):
+    fn()
+    db.session.expunge_all()
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+        db.session.expunge_all()
+    return (time.process_time() - cpu) / iterations * 1e6, (time.perf_counter() - wall) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        student_id = db.session.query(Student.id).order_by(Student.id).limit(1).scalar()
+        if student_id is None:
+            raise SystemExit("the students table is empty")
+
+        cases = [
+            ("list page", orm_page, statement_page),
+            ("detail", lambda: orm_detail(student_id), lambda: statement_detail(student_id)),
+        ]
+        print("{:10} {:>14} {:>14} {:>14} {:>14}".format("path", "orm cpu us", "stmt cpu us", "orm wall us", "stmt wall us"))
+        for name, orm, stmt in cases:
+            orm_cpu, orm_wall = measure(orm, args.iterations)
+            stmt_cpu, stmt_wall = measure(stmt, args.iterations)
+            print("{:10} {:14.1f} {:14.1f} {:14.1f} {:14.1f}".format(name, orm_cpu, stmt_cpu, orm_wall, stmt_wall))
+
+
+if __name__ == "__main__":
+    main()
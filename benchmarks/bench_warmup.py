@@ -0,0 +1,86 @@
+"""
+Cold versus warm first-request latency.
+
+Each round starts a fresh interpreter (nothing imported, no caches), creates
+the app and times its first requests, once as is (cold) and once after
+warm_caches() has run (what a worker forked from the preloading launcher
+sees). Needs the database from .env; pass a token so the JWKS is part of
+the measurement.
+
+    TEST_AUTH_TOKEN=... python benchmarks/bench_warmup.py --rounds 5 --path /students
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+
+def child(mode, path, requests):
+    started = time.perf_counter()
+    from nupatcodeclass import create_app
+    from nupatcodeclass.server import warm_caches
+    app = create_app()
+    boot = time.perf_counter() - started
+
+    warm = 0.0
+    if mode == "warm":
+        started = time.perf_counter()
+        warm_caches(app)
+        warm = time.perf_counter() - started
+
+    headers = {}
+    if os.getenv("TEST_AUTH_TOKEN"):
+        headers["Authorization"] = "Bearer " + os.environ["TEST_AUTH_TOKEN"]
+
+    client = app.test_client()
+    latencies = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        client.get(path, headers=headers)
+        latencies.append(time.perf_counter() - started)
+
+    print(json.dumps({"boot": boot, "warm": warm, "latencies": latencies}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--path", default="/students")
+    parser.add_argument("--requests", type=int, default=3, help="requests timed per process")
+    parser.add_argument("--child", choices=["cold", "warm"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.path, args.requests)
+        return
+
+    for mode in ("cold", "warm"):
+        runs = []
+        for _ in range(args.rounds):
+            output = subprocess.run(
+                [sys.executable, __file__, "--child", mode, "--path", args.path, "--requests", str(args.requests)],
+                cwd=ROOT, capture_output=True, text=True, check=True,
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+        first = [run["latencies"][0] * 1000 for run in runs]
+        later = [latency * 1000 for run in runs for latency in run["latencies"][1:]]
+        print(
+            "{:5} boot {:7.1f} ms  warm {:7.1f} ms  first request {:7.1f} ms  later requests {:7.1f} ms".format(
+                mode,
+                statistics.median(run["boot"] for run in runs) * 1000,
+                statistics.median(run["warm"] for run in runs) * 1000,
+                statistics.median(first),
+                statistics.median(later) if later else float("nan"),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
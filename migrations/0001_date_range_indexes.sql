@@ -0,0 +1,18 @@
+--
+-- GiST range indexes for active-on-date and date-overlap queries
+--
+-- Run outside a transaction block (CREATE INDEX CONCURRENTLY does not lock
+-- writes, but cannot run inside one):
+--     psql -d nupatcodeclass -f migrations/0001_date_range_indexes.sql
+--
+-- The indexed expressions must match models.period() exactly. tsrange()
+-- rejects rows whose end date is before their start date, so fix any such
+-- rows before running this.
+--
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_students_program_period
+    ON students USING gist (tsrange(program_start_date, program_end_date, '[]'));
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_courses_course_period
+    ON courses USING gist (tsrange(course_start_date, course_end_date, '[]'))
+    WHERE course_start_date IS NOT NULL AND course_end_date IS NOT NULL;
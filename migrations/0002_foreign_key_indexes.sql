@@ -0,0 +1,41 @@
+--
+-- Indexes for every foreign key and for the hot filters
+--
+-- Run outside a transaction block, so each index is built CONCURRENTLY and
+-- the tables stay writable while it runs:
+--     psql -d nupatcodeclass -f migrations/0002_foreign_key_indexes.sql
+--
+-- If a concurrent build fails it leaves an INVALID index behind; drop it
+-- and run this file again.
+--
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- foreign keys
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_students_user_id ON students (user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_students_course_id ON students (course_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_sponsors_user_id ON sponsors (user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_sponsors_student_id ON sponsors (student_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_courses_user_id ON courses (user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_course_materials_course_id ON course_materials (course_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_course_materials_digest ON course_materials (digest);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_instructors_student_id ON instructors (student_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_instructors_user_id ON instructors (user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_admins_user_id ON admins (user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_admins_course_id ON admins (course_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_admins_student_id ON admins (student_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_admins_instructor_id ON admins (instructor_id);
+
+-- hot filters; ix_instructors_course_week also serves instructors.course_id
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_instructors_course_week
+    ON instructors (course_id, weekly_project) INCLUDE (project_grade);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_students_student_program
+    ON students (student_program) INCLUDE (program_start_date, program_end_date);
+
+-- substring (ILIKE '%term%') searches
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_students_student_program_trgm
+    ON students USING gin (student_program gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_courses_course_title_trgm
+    ON courses USING gin (course_title gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_instructors_instructor_course_trgm
+    ON instructors USING gin (instructor_course gin_trgm_ops);
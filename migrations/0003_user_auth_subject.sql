@@ -0,0 +1,24 @@
+--
+-- users.auth_subject: the sub claim of the user's Auth0 tokens, looked up
+-- by the principal cache (nupatcodeclass/principals.py)
+--
+-- Run outside a transaction block, so the unique index is built
+-- CONCURRENTLY and users stays writable while it runs:
+--     psql -d nupatcodeclass -f migrations/0003_user_auth_subject.sql
+--
+-- Then link existing accounts, e.g.
+--     UPDATE users SET auth_subject = 'auth0|...' WHERE email = '...';
+--
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS auth_subject varchar(255);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_auth_subject_key ON users (auth_subject);
+
+-- same name as the constraint create_all() would make; guarded, so the
+-- migration can be re-run like the statements above
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'users_auth_subject_key') THEN
+        ALTER TABLE users ADD CONSTRAINT users_auth_subject_key UNIQUE USING INDEX users_auth_subject_key;
+    END IF;
+END $$;
@@ -0,0 +1,94 @@
+--
+-- courses.student_count and courses.instructor_count, kept by statement
+-- triggers on students and instructors (the same DDL models.py attaches to
+-- create_all()).
+--
+-- Runs as one transaction. students and instructors are locked against
+-- writes while the counters are backfilled, so no enrollment can slip in
+-- between the backfill and the triggers; reads go on as usual:
+--     psql -d nupatcodeclass -1 -f migrations/0004_course_counters.sql
+--
+-- Later drift (e.g. rows changed with the triggers disabled) is repaired by
+-- the recount_courses job.
+--
+
+LOCK TABLE students, instructors IN SHARE ROW EXCLUSIVE MODE;
+
+ALTER TABLE courses ADD COLUMN IF NOT EXISTS student_count integer NOT NULL DEFAULT 0;
+ALTER TABLE courses ADD COLUMN IF NOT EXISTS instructor_count integer NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION count_course_students() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE courses c SET student_count = c.student_count + d.n
+        FROM (SELECT course_id, count(*) AS n FROM new_rows GROUP BY course_id) d
+        WHERE c.id = d.course_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE courses c SET student_count = c.student_count - d.n
+        FROM (SELECT course_id, count(*) AS n FROM old_rows GROUP BY course_id) d
+        WHERE c.id = d.course_id;
+    ELSE
+        UPDATE courses c SET student_count = c.student_count + d.n
+        FROM (
+            SELECT course_id, sum(n) AS n FROM (
+                SELECT course_id, 1 AS n FROM new_rows
+                UNION ALL
+                SELECT course_id, -1 AS n FROM old_rows
+            ) moved
+            GROUP BY course_id HAVING sum(n) <> 0
+        ) d
+        WHERE c.id = d.course_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_course_instructors() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE courses c SET instructor_count = c.instructor_count + d.n
+        FROM (SELECT course_id, count(*) AS n FROM new_rows GROUP BY course_id) d
+        WHERE c.id = d.course_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE courses c SET instructor_count = c.instructor_count - d.n
+        FROM (SELECT course_id, count(*) AS n FROM old_rows GROUP BY course_id) d
+        WHERE c.id = d.course_id;
+    ELSE
+        UPDATE courses c SET instructor_count = c.instructor_count + d.n
+        FROM (
+            SELECT course_id, sum(n) AS n FROM (
+                SELECT course_id, 1 AS n FROM new_rows
+                UNION ALL
+                SELECT course_id, -1 AS n FROM old_rows
+            ) moved
+            GROUP BY course_id HAVING sum(n) <> 0
+        ) d
+        WHERE c.id = d.course_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS students_count_insert ON students;
+DROP TRIGGER IF EXISTS students_count_update ON students;
+DROP TRIGGER IF EXISTS students_count_delete ON students;
+CREATE TRIGGER students_count_insert AFTER INSERT ON students
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_students();
+CREATE TRIGGER students_count_update AFTER UPDATE ON students
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_students();
+CREATE TRIGGER students_count_delete AFTER DELETE ON students
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_students();
+
+DROP TRIGGER IF EXISTS instructors_count_insert ON instructors;
+DROP TRIGGER IF EXISTS instructors_count_update ON instructors;
+DROP TRIGGER IF EXISTS instructors_count_delete ON instructors;
+CREATE TRIGGER instructors_count_insert AFTER INSERT ON instructors
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_instructors();
+CREATE TRIGGER instructors_count_update AFTER UPDATE ON instructors
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_instructors();
+CREATE TRIGGER instructors_count_delete AFTER DELETE ON instructors
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_instructors();
+
+UPDATE courses c
+SET student_count = (SELECT count(*) FROM students s WHERE s.course_id = c.id),
+    instructor_count = (SELECT count(*) FROM instructors i WHERE i.course_id = c.id);
@@ -0,0 +1,22 @@
+--
+-- the NOTIFY trigger on changes behind the /events stream (the same DDL
+-- models.py attaches to create_all()). databases whose changes table was
+-- created before the trigger existed never got it, and their /events
+-- streams only saw the worker's own commits.
+--
+-- Safe to re-run:
+--     psql -d nupatcodeclass -1 -f migrations/0005_changes_notify.sql
+--
+
+CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('nupat_changes', json_build_object(
+        'version', NEW.version, 'entity', NEW.entity, 'id', NEW.entity_id, 'operation', NEW.operation
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS changes_notify ON changes;
+CREATE TRIGGER changes_notify AFTER INSERT ON changes
+    FOR EACH ROW EXECUTE PROCEDURE notify_change();
@@ -0,0 +1,14 @@
+--
+-- students.profile_picture: /media only serves blobs that are some
+-- student's profile picture and looks every requested digest up here
+--
+-- Run outside a transaction block, so the index is built CONCURRENTLY and
+-- students stays writable while it runs:
+--     psql -d nupatcodeclass -f migrations/0006_profile_picture_index.sql
+--
+-- If the concurrent build fails it leaves an INVALID index behind; drop it
+-- and run this file again.
+--
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_students_profile_picture
+    ON students (profile_picture) WHERE profile_picture IS NOT NULL;
@@ -0,0 +1,23 @@
+--
+-- Rebuilds the GiST range indexes of 0001 on tsrange(least(start, end),
+-- greatest(start, end)), the expression models.period() builds now. With
+-- the plain tsrange(start, end) index any write of a row whose end date is
+-- before its start date failed with a range error.
+--
+-- Run outside a transaction block, so each index is built CONCURRENTLY and
+-- the tables stay writable while it runs (range queries fall back to a
+-- scan between the DROP and the CREATE):
+--     psql -d nupatcodeclass -f migrations/0007_ordered_period_indexes.sql
+--
+-- Safe to re-run. If a concurrent build fails it leaves an INVALID index
+-- behind; run this file again.
+--
+
+DROP INDEX CONCURRENTLY IF EXISTS ix_students_program_period;
+CREATE INDEX CONCURRENTLY ix_students_program_period
+    ON students USING gist (tsrange(least(program_start_date, program_end_date), greatest(program_start_date, program_end_date), '[]'));
+
+DROP INDEX CONCURRENTLY IF EXISTS ix_courses_course_period;
+CREATE INDEX CONCURRENTLY ix_courses_course_period
+    ON courses USING gist (tsrange(least(course_start_date, course_end_date), greatest(course_start_date, course_end_date), '[]'))
+    WHERE course_start_date IS NOT NULL AND course_end_date IS NOT NULL;
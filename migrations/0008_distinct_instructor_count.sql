@@ -0,0 +1,59 @@
+--
+-- courses.instructor_count becomes the number of distinct instructors
+-- (user_id) grading in a course. instructors rows are one grade of one
+-- student in one week, so counting rows made the counter grow with every
+-- graded week. The trigger function is the one models.py attaches to
+-- create_all(); it recomputes the touched courses from
+-- ix_instructors_course_user.
+--
+-- Run outside a transaction block, so the index is built CONCURRENTLY and
+-- instructors stays writable while it runs:
+--     psql -d nupatcodeclass -f migrations/0008_distinct_instructor_count.sql
+--
+-- Safe to re-run. A grade written while the backfill runs can leave its
+-- course's counter stale until the next write to that course; the
+-- recount_courses job repairs it.
+--
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_instructors_course_user ON instructors (course_id, user_id);
+
+CREATE OR REPLACE FUNCTION count_course_instructors() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE courses c SET instructor_count = d.n
+        FROM (
+            SELECT t.course_id, (SELECT count(DISTINCT i.user_id) FROM instructors i WHERE i.course_id = t.course_id) AS n
+            FROM (SELECT DISTINCT course_id FROM new_rows) t
+        ) d
+        WHERE c.id = d.course_id AND c.instructor_count <> d.n;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE courses c SET instructor_count = d.n
+        FROM (
+            SELECT t.course_id, (SELECT count(DISTINCT i.user_id) FROM instructors i WHERE i.course_id = t.course_id) AS n
+            FROM (SELECT DISTINCT course_id FROM old_rows) t
+        ) d
+        WHERE c.id = d.course_id AND c.instructor_count <> d.n;
+    ELSE
+        UPDATE courses c SET instructor_count = d.n
+        FROM (
+            SELECT t.course_id, (SELECT count(DISTINCT i.user_id) FROM instructors i WHERE i.course_id = t.course_id) AS n
+            FROM (SELECT n.course_id FROM new_rows n JOIN old_rows o ON o.id = n.id WHERE (n.course_id, n.user_id) IS DISTINCT FROM (o.course_id, o.user_id) UNION SELECT o.course_id FROM new_rows n JOIN old_rows o ON o.id = n.id WHERE (n.course_id, n.user_id) IS DISTINCT FROM (o.course_id, o.user_id)) t
+        ) d
+        WHERE c.id = d.course_id AND c.instructor_count <> d.n;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS instructors_count_insert ON instructors;
+DROP TRIGGER IF EXISTS instructors_count_update ON instructors;
+DROP TRIGGER IF EXISTS instructors_count_delete ON instructors;
+CREATE TRIGGER instructors_count_insert AFTER INSERT ON instructors
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_instructors();
+CREATE TRIGGER instructors_count_update AFTER UPDATE ON instructors
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_instructors();
+CREATE TRIGGER instructors_count_delete AFTER DELETE ON instructors
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_instructors();
+
+UPDATE courses c
+SET instructor_count = (SELECT count(DISTINCT i.user_id) FROM instructors i WHERE i.course_id = c.id);
@@ -1,5 +1,6 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, create_engine, func, literal_column, event, DDL, text
+from sqlalchemy.orm import Session
 from flask_sqlalchemy import SQLAlchemy
 import json
 
@@ -15,19 +16,63 @@ DB_PORT = os.getenv('DB_PORT')
 DB_NAME = os.getenv('DB_NAME')
 database_path = 'postgresql://{}:{}@{}:{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME)
 
+# psycopg2 (the default) or psycopg; psycopg prepares a statement
+# server-side once a connection has run it PREPARE_THRESHOLD times
+DB_DRIVER = os.getenv('DB_DRIVER', 'psycopg2')
+PREPARE_THRESHOLD = int(os.getenv('PREPARE_THRESHOLD', 5))
+STATEMENT_CACHE_SIZE = int(os.getenv('STATEMENT_CACHE_SIZE', 1200))
+
+THUMBNAIL_SIZES = tuple(int(size) for size in os.getenv('THUMBNAIL_SIZES', '64,128,256').split(','))
+
 db = SQLAlchemy()
 
+# the trigram indexes behind the ILIKE searches need pg_trgm
+event.listen(db.metadata, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
 """
 setup_db(app)
     binds a flask application and a SQLAlchemy service
 """
 def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    database_uri = database_path.replace('postgresql://', 'postgresql+{}://'.format(DB_DRIVER), 1)
+    engine_options = {'query_cache_size': STATEMENT_CACHE_SIZE}
+    if database_uri.startswith('postgresql+psycopg://'):
+        engine_options['connect_args'] = {'prepare_threshold': PREPARE_THRESHOLD}
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
     db.create_all()
 
+"""
+period(start, end)
+    the closed tsrange of two timestamp columns. range queries must build the
+    expression through this helper so Postgres matches it to the GiST indexes
+    declared on Student and Course. tsrange() raises on an end before its
+    start, which would make writing such a row fail inside the index, so
+    the bounds are put in order first.
+"""
+def period(start, end):
+    return func.tsrange(func.least(start, end), func.greatest(start, end), literal_column("'[]'"))
+
+"""
+picture_urls(digest)
+    profile pictures are stored by content digest (see nupatcodeclass/media.py),
+    so listings only carry links to the original and its thumbnails.
+    inline data: URIs are never echoed back.
+"""
+def picture_urls(digest):
+    if not digest or digest.startswith('data:'):
+        return None
+    if len(digest) != 64 or digest.strip('0123456789abcdef'):
+        return digest
+    
+    urls = {'original': '/media/{}'.format(digest)}
+    for size in THUMBNAIL_SIZES:
+        urls[str(size)] = '/media/{}/{}'.format(digest, size)
+    return urls
+
 """
 User
 """
@@ -45,13 +90,15 @@ class User(db.Model):
     actual_password = Column(String(300), unique=True, nullable=False)
     phone_number = Column(Integer)
     address = Column(String)
+    # the sub claim of the user's Auth0 tokens
+    auth_subject = Column(String(255), unique=True, nullable=True)
     students = db.relationship("Student", backref="author", lazy=True)
     sponsors = db.relationship("Sponsor", backref="author", lazy=True)
     courses = db.relationship("Course", backref="author", lazy=True)
     instructors = db.relationship("Instructor", backref="author", lazy=True)
     admins = db.relationship("Admin", backref="author", lazy=True)
     
-    def __init__(self,  first_name, last_name, other_names, role, email, username, default_password, actual_password, phone_number, address):
+    def __init__(self,  first_name, last_name, other_names, role, email, username, default_password, actual_password, phone_number, address, auth_subject=None):
         self.first_name = first_name
         self.last_name = last_name
         self.other_names = other_names
@@ -62,6 +109,7 @@ class User(db.Model):
         self.actual_password = actual_password
         self.phone_number = phone_number
         self.address = address
+        self.auth_subject = auth_subject
         
 
 
@@ -86,10 +134,9 @@ class User(db.Model):
             'role': self.role,
             'email': self.email,
             'username': self.username,
-            'default_password': self.default_password,
-            'actual_password': self.actual_password,
             'phone_number': self.phone_number,
-            'address': self.address
+            'address': self.address,
+            'auth_subject': self.auth_subject
         }
 
 """
@@ -111,11 +158,19 @@ class Student(db.Model):
     health_condition = Column(String)
     disability = Column(String)
     profile_picture = Column(String)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    course_id = db.Column(db.Integer, db.ForeignKey("courses.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
+    course_id = db.Column(db.Integer, db.ForeignKey("courses.id"), nullable=False, index=True)
     sponsors = db.relationship("Sponsor", backref="author", lazy=True)
     admins = db.relationship("Admin", backref="author", lazy=True)
     
+    __table_args__ = (
+        db.Index('ix_students_program_period', period(program_start_date, program_end_date), postgresql_using='gist'),
+        db.Index('ix_students_student_program', 'student_program', postgresql_include=['program_start_date', 'program_end_date']),
+        db.Index('ix_students_student_program_trgm', 'student_program', postgresql_using='gin', postgresql_ops={'student_program': 'gin_trgm_ops'}),
+        # /media looks a digest up here before serving it
+        db.Index('ix_students_profile_picture', 'profile_picture', postgresql_where=profile_picture.isnot(None)),
+    )
+    
     def __init__(self, user_id, course_id, date_of_birth, program_start_date, program_end_date, accommodation, amount_paid, gender, student_program, marital_status, health_condition, disability, profile_picture):
         self.user_id = user_id
         self.course_id = course_id
@@ -130,6 +185,17 @@ class Student(db.Model):
         self.health_condition = health_condition
         self.disability = disability
         self.profile_picture = profile_picture
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+        
+    def update(self):
+        db.session.commit()
+    
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
         
     def format(self):
         return {
@@ -146,7 +212,7 @@ class Student(db.Model):
             'marital_status': self.marital_status,
             'health_condition': self.health_condition,
             'disability': self.disability,
-            'profile_picture': self.profile_picture
+            'profile_picture': picture_urls(self.profile_picture)
         }
         
         
@@ -161,8 +227,8 @@ class Sponsor(db.Model):
     state_of_origin = Column(String)
     lga_of_origin = Column(String)
     home_address = Column(String)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    student_id = db.Column(db.Integer, db.ForeignKey("students.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
+    student_id = db.Column(db.Integer, db.ForeignKey("students.id"), nullable=False, index=True)
     admins = db.relationship("Admin", backref="author", lazy=True)
 
     def __init__(self, user_id, student_id, state_of_origin, lga_of_origin, home_address):
@@ -172,6 +238,17 @@ class Sponsor(db.Model):
         self.lga_of_origin = lga_of_origin
         self.home_address = home_address
 
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+        
+    def update(self):
+        db.session.commit()
+    
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+        
     def format(self):
         return {
             'id': self.id,
@@ -200,10 +277,24 @@ class Course(db.Model):
     course_end_date = Column(db.DateTime)
     course_project = Column(String)
     course_assignment = Column(String)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
+    # kept by the count_course_* triggers below; never set them from Python
+    student_count = Column(Integer, nullable=False, default=0, server_default='0')
+    instructor_count = Column(Integer, nullable=False, default=0, server_default='0')
     admins = db.relationship("Admin", backref="author", lazy=True)
     students = db.relationship("Student", backref="author", lazy=True)
     instructors = db.relationship("Instructor", backref="author", lazy=True)
+    materials = db.relationship("CourseMaterial", backref="course", lazy=True)
+    
+    __table_args__ = (
+        db.Index(
+            'ix_courses_course_period',
+            period(course_start_date, course_end_date),
+            postgresql_using='gist',
+            postgresql_where=course_start_date.isnot(None) & course_end_date.isnot(None),
+        ),
+        db.Index('ix_courses_course_title_trgm', 'course_title', postgresql_using='gin', postgresql_ops={'course_title': 'gin_trgm_ops'}),
+    )
     
     def __init__(self, user_id, course_title, course_description, course_instructor, course_outline, course_material, registered_students, course_start_date, course_end_date, course_project, course_assignment):
         self.user_id = user_id
@@ -217,6 +308,17 @@ class Course(db.Model):
         self.course_end_date = course_end_date
         self.course_project = course_project
         self.course_assignment = course_assignment
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+        
+    def update(self):
+        db.session.commit()
+    
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
         
     def format(self):
         return {
@@ -225,15 +327,63 @@ class Course(db.Model):
             'course_title': self.course_title,
             'course_description': self.course_description,
             'course_instructor': self.course_instructor,
-            'course_outline': self.course_outline,
-            'course_material': self.course_material,
+            'materials': '/courses/{}/materials'.format(self.id),
             'registered_students': self.registered_students,
+            'student_count': self.student_count,
+            'instructor_count': self.instructor_count,
             'course_start_date': self.course_start_date,
             'course_end_date': self.course_end_date,
             'course_project': self.course_project,
             'course_assignment': self.course_assignment
         }
     
+"""
+CourseMaterial
+    metadata for an uploaded course file. the bytes live in the
+    content-addressed blob store, so two courses sharing a file share one
+    copy on disk.
+"""
+class CourseMaterial(db.Model):
+    __tablename__ = 'course_materials'
+    
+    id = Column(Integer, primary_key=True)
+    digest = Column(String(64), nullable=False, index=True)
+    filename = Column(String)
+    content_type = Column(String)
+    size = Column(db.BigInteger, nullable=False)
+    created_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    course_id = db.Column(db.Integer, db.ForeignKey("courses.id"), nullable=False, index=True)
+    
+    def __init__(self, course_id, digest, filename, content_type, size):
+        self.course_id = course_id
+        self.digest = digest
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+        
+    def update(self):
+        db.session.commit()
+    
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+        
+    def format(self):
+        return {
+            'id': self.id,
+            'course_id': self.course_id,
+            'digest': self.digest,
+            'filename': self.filename,
+            'content_type': self.content_type,
+            'size': self.size,
+            'created_at': self.created_at,
+            'url': '/courses/{}/materials/{}'.format(self.course_id, self.id)
+        }
+    
 """
 Instructor
 
@@ -245,11 +395,19 @@ class Instructor(db.Model):
     instructor_course = Column(String)
     weekly_project = Column(String)
     project_grade = Column(String)
-    student_id = db.Column(db.Integer, db.ForeignKey("students.id"), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey("students.id"), nullable=False, index=True)
+    # indexed by ix_instructors_course_week, which leads with course_id
     course_id = db.Column(db.Integer, db.ForeignKey("courses.id"), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
     admins = db.relationship("Admin", backref="author", lazy=True)
     
+    __table_args__ = (
+        db.Index('ix_instructors_course_week', 'course_id', 'weekly_project', postgresql_include=['project_grade']),
+        db.Index('ix_instructors_instructor_course_trgm', 'instructor_course', postgresql_using='gin', postgresql_ops={'instructor_course': 'gin_trgm_ops'}),
+        # index-only recounts of courses.instructor_count
+        db.Index('ix_instructors_course_user', 'course_id', 'user_id'),
+    )
+    
     def __init__(self, user_id, student_id, course_id, instructor_course, weekly_project, project_grade):
         self.instructor_course = instructor_course
         self.weekly_project = weekly_project
@@ -257,7 +415,18 @@ class Instructor(db.Model):
         self.user_id = user_id
         self.student_id = student_id
         self.course_id = course_id
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+        
+    def update(self):
+        db.session.commit()
     
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+        
     def format(self):
         return {
             'id': self.id,
@@ -277,16 +446,27 @@ class Admin(db.Model):
     
     id = Column(Integer, primary_key=True)
     admin_password = Column(String)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    course_id = db.Column(db.Integer, db.ForeignKey("courses.id"), nullable=False)
-    student_id = db.Column(db.Integer, db.ForeignKey("students.id"), nullable=False)
-    instructor_id = db.Column(db.Integer, db.ForeignKey("instructors.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
+    course_id = db.Column(db.Integer, db.ForeignKey("courses.id"), nullable=False, index=True)
+    student_id = db.Column(db.Integer, db.ForeignKey("students.id"), nullable=False, index=True)
+    instructor_id = db.Column(db.Integer, db.ForeignKey("instructors.id"), nullable=False, index=True)
     
     def __init__(self, user_id, course_id, student_id, instructor_id):
         self.user_id = user_id
         self.course_id = course_id
         self.student_id = student_id
         self.instructor_id = instructor_id
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+        
+    def update(self):
+        db.session.commit()
+    
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
         
     def format(self):
         return {
@@ -295,4 +475,253 @@ class Admin(db.Model):
             'course_id': self.course_id,
             'student_id': self.student_id,
             'instructor_id': self.instructor_id
-        }
\ No newline at end of file
+        }
+
+"""
+Course counters
+    courses.student_count follows the students rows that point at each
+    course. courses.instructor_count is the number of distinct instructors
+    (user_id) grading in the course; an instructors row is one grade of one
+    student in one week, so that count is recomputed for the touched
+    courses rather than adjusted by the number of rows. statement-level
+    triggers read the transition tables, so a bulk INSERT, a move to another
+    course or a cascade delete updates each affected course once per
+    statement, in the writing transaction, whether the write came through
+    the ORM or not. migrations/0004_course_counters.sql and
+    0008_distinct_instructor_count.sql install them on an existing database
+    and the recount_courses job repairs drift.
+"""
+def course_counter_ddl(table, column):
+    return DDL("""
+CREATE OR REPLACE FUNCTION count_course_{table}() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE courses c SET {column} = c.{column} + d.n
+        FROM (SELECT course_id, count(*) AS n FROM new_rows GROUP BY course_id) d
+        WHERE c.id = d.course_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE courses c SET {column} = c.{column} - d.n
+        FROM (SELECT course_id, count(*) AS n FROM old_rows GROUP BY course_id) d
+        WHERE c.id = d.course_id;
+    ELSE
+        UPDATE courses c SET {column} = c.{column} + d.n
+        FROM (
+            SELECT course_id, sum(n) AS n FROM (
+                SELECT course_id, 1 AS n FROM new_rows
+                UNION ALL
+                SELECT course_id, -1 AS n FROM old_rows
+            ) moved
+            GROUP BY course_id HAVING sum(n) <> 0
+        ) d
+        WHERE c.id = d.course_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS {table}_count_insert ON {table};
+DROP TRIGGER IF EXISTS {table}_count_update ON {table};
+DROP TRIGGER IF EXISTS {table}_count_delete ON {table};
+CREATE TRIGGER {table}_count_insert AFTER INSERT ON {table}
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_{table}();
+CREATE TRIGGER {table}_count_update AFTER UPDATE ON {table}
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_{table}();
+CREATE TRIGGER {table}_count_delete AFTER DELETE ON {table}
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_{table}();
+""".format(table=table, column=column))
+
+def instructor_counter_ddl():
+    recount = """
+        UPDATE courses c SET instructor_count = d.n
+        FROM (
+            SELECT t.course_id, (SELECT count(DISTINCT i.user_id) FROM instructors i WHERE i.course_id = t.course_id) AS n
+            FROM ({touched}) t
+        ) d
+        WHERE c.id = d.course_id AND c.instructor_count <> d.n;"""
+    # a regraded row keeps its course and instructor; only moves count
+    moved = (
+        "SELECT n.course_id FROM new_rows n JOIN old_rows o ON o.id = n.id"
+        " WHERE (n.course_id, n.user_id) IS DISTINCT FROM (o.course_id, o.user_id)"
+        " UNION SELECT o.course_id FROM new_rows n JOIN old_rows o ON o.id = n.id"
+        " WHERE (n.course_id, n.user_id) IS DISTINCT FROM (o.course_id, o.user_id)"
+    )
+    return DDL("""
+CREATE OR REPLACE FUNCTION count_course_instructors() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN{insert}
+    ELSIF TG_OP = 'DELETE' THEN{delete}
+    ELSE{update}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS instructors_count_insert ON instructors;
+DROP TRIGGER IF EXISTS instructors_count_update ON instructors;
+DROP TRIGGER IF EXISTS instructors_count_delete ON instructors;
+CREATE TRIGGER instructors_count_insert AFTER INSERT ON instructors
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_instructors();
+CREATE TRIGGER instructors_count_update AFTER UPDATE ON instructors
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_instructors();
+CREATE TRIGGER instructors_count_delete AFTER DELETE ON instructors
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE count_course_instructors();
+""".format(
+        insert=recount.format(touched="SELECT DISTINCT course_id FROM new_rows"),
+        delete=recount.format(touched="SELECT DISTINCT course_id FROM old_rows"),
+        update=recount.format(touched=moved),
+    ))
+
+event.listen(Student.__table__, 'after_create', course_counter_ddl('students', 'student_count'))
+event.listen(Instructor.__table__, 'after_create', instructor_counter_ddl())
+
+"""
+Job
+    a unit of background work (export, cascade delete, report) run by the
+    worker runner in nupatcodeclass/jobs.py. payload and result are JSON text;
+    while a job runs, result holds its last checkpoint, if it keeps one.
+"""
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(60), nullable=False)
+    status = Column(String(20), nullable=False, default='queued')
+    payload = Column(db.Text)
+    result = Column(db.Text)
+    error = Column(db.Text)
+    progress = Column(db.Float, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    cancel_requested = Column(db.Boolean, nullable=False, default=False)
+    run_after = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    created_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    updated_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    finished_at = Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_after', 'status', 'run_after'),
+    )
+    
+    def __init__(self, kind, payload, max_attempts=3):
+        self.kind = kind
+        self.payload = json.dumps(payload)
+        self.max_attempts = max_attempts
+        
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+        
+    def update(self):
+        db.session.commit()
+    
+    def format(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'cancel_requested': self.cancel_requested,
+            'payload': json.loads(self.payload) if self.payload else None,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+            'finished_at': self.finished_at
+        }
+
+"""
+Change
+    the append-only change log behind /changes. one row per inserted,
+    updated or deleted model row, collected by the flush hook below and
+    written when the transaction of the mutation itself commits. version is a bigserial, so it
+    only ever grows.
+"""
+class Change(db.Model):
+    __tablename__ = 'changes'
+    
+    version = Column(db.BigInteger, primary_key=True)
+    entity = Column(String(40), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    operation = Column(String(10), nullable=False)
+    changed_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_changes_entity', 'entity', 'entity_id', 'version'),
+    )
+    
+    def format(self):
+        return {
+            'version': self.version,
+            'entity': self.entity,
+            'id': self.entity_id,
+            'operation': self.operation,
+            'changed_at': self.changed_at
+        }
+
+CHANGE_CHANNEL = 'nupat_changes'
+
+# every appended change is announced on CHANGE_CHANNEL; Postgres delivers the
+# notification only when the writing transaction commits. existing databases
+# get the trigger from migrations/0005_changes_notify.sql
+event.listen(Change.__table__, 'after_create', DDL("""
+CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('""" + CHANGE_CHANNEL + """', json_build_object(
+        'version', NEW.version, 'entity', NEW.entity, 'id', NEW.entity_id, 'operation', NEW.operation
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER changes_notify AFTER INSERT ON changes
+    FOR EACH ROW EXECUTE PROCEDURE notify_change();
+"""))
+
+TRACKED_TABLES = ('users', 'students', 'sponsors', 'courses', 'course_materials', 'instructors', 'admins')
+CHANGE_LOG_LOCK = 0x6e757061
+
+"""
+record_changes(session, rows)
+    queues rows of {'entity', 'entity_id', 'operation'} for the change log of
+    the session's transaction. nothing is written until the transaction
+    commits: the flush hook and bulk statements that bypass the ORM only
+    buffer here, and write_changes appends the whole buffer just before the
+    commit, under a transaction-level advisory lock. writers therefore
+    append one transaction at a time, so versions become visible in commit
+    order and a reader polling ?since= never skips a late-committing lower
+    version, but a transaction holds the lock only for its own insert and
+    commit, not for all the work before it.
+"""
+def record_changes(session, rows):
+    if rows:
+        session.info.setdefault('change_log', []).extend(rows)
+
+@event.listens_for(Session, 'after_flush')
+def record_flushed_changes(session, flush_context):
+    rows = []
+    for operation, instances in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for instance in instances:
+            if getattr(instance, '__tablename__', None) not in TRACKED_TABLES:
+                continue
+            if operation == 'update' and not session.is_modified(instance, include_collections=False):
+                continue
+            rows.append({'entity': instance.__tablename__, 'entity_id': instance.id, 'operation': operation})
+    record_changes(session, rows)
+
+@event.listens_for(Session, 'before_commit')
+def write_changes(session):
+    # commit flushes only after this hook runs; flush first so the last
+    # changes are in the buffer too
+    session.flush()
+    rows = session.info.pop('change_log', None)
+    if not rows:
+        return
+    connection = session.connection()
+    connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': CHANGE_LOG_LOCK})
+    connection.execute(Change.__table__.insert(), rows)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    session.info.pop('change_log', None)
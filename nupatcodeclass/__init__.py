@@ -1,7 +1,7 @@
 import os
+import datetime
 import psycopg2
-from flask import Flask, request, session, abort, jsonify, render_template, redirect, flash, url_for
-from flask_session import Session
+from flask import Flask, Response, request, session, abort, jsonify, render_template, redirect, flash, url_for, send_file
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import random
@@ -10,8 +10,11 @@ import sys
 from dotenv import load_dotenv
 load_dotenv()
 
-from models import setup_db, Student, User, Course, Instructor, Admin, Sponsor
-from auth.auth import AuthError, requires_auth
+from models import setup_db, db, period, Student, User, Course, CourseMaterial, Instructor, Admin, Sponsor, Job, TRACKED_TABLES
+from auth.auth import AuthError, requires_auth, auth_verified
+from auth.passwords import PasswordHashBusy, verify_password, verify_dummy_password, hash_password_pooled
+from nupatcodeclass.sessions import SqliteSessionInterface
+from nupatcodeclass import media, materials, grades, cohorts, changes, events, compression, jobs, admission, metrics, results, facets, logs, deadlines, statements, principals, schemas, duplicates, schedule
 
 def get_db_connection():
     DB_USER = os.getenv('DB_USER')
@@ -37,13 +40,62 @@ def paginage_students(request, selection):
     
     return current_students
 
+def paginate_query(request, query):
+    page = max(request.args.get("page", 1, type=int), 1)
+    start = (page - 1) * STUDENTS_PER_PAGE
+    
+    return [item.format() for item in query.offset(start).limit(STUDENTS_PER_PAGE)]
+
+def cached_page(request, model, column=None, search=None):
+    page = request.args.get("page", 1, type=int)
+    return results.search_page(model, column, search, page, STUDENTS_PER_PAGE)
+
+def date_arg(request, name, default=None):
+    value = request.args.get(name, None)
+    if value is None:
+        return default
+    try:
+        return schemas.decode_date(value)
+    except schemas.Invalid:
+        abort(400)
+
+def facet_value(column, value):
+    if value in ("", "null"):
+        return None
+    try:
+        return schemas.students.decode(column, value)
+    except schemas.Invalid:
+        abort(400)
+
+def day_bounds(first_day, last_day):
+    return datetime.datetime.combine(first_day, datetime.time.min), datetime.datetime.combine(last_day, datetime.time.max)
+
 def create_app(test_cobfig=None):
     # create and configure the app
     app = Flask(__name__)
     
     #Set up CORS. Allow '*' for origins.
     setup_db(app)
+    app.session_interface = SqliteSessionInterface()
+    app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE") == "1"
     cors = CORS(app, resources={r"/*": {"origins": "*"}})
+    logs.setup_logging(app)
+    app.after_request(compression.compress_response)
+    app.before_request(admission.admit)
+    app.before_request(deadlines.start_deadline)
+    app.teardown_request(admission.release)
+    auth_verified.connect(admission.limit_subject)
+    
+    metrics.register("admission", admission.stats)
+    metrics.register("compression", compression.cache.stats)
+    metrics.register("events", events.broadcaster.stats)
+    metrics.register("results", results.cache.stats)
+    metrics.register("facets", facets.stats)
+    metrics.register("logging", logs.handler.stats)
+    metrics.register("deadlines", deadlines.stats)
+    metrics.register("principals", principals.stats)
+    metrics.register("duplicates", duplicates.stats)
+    metrics.register("schedule", schedule.stats)
     
     #The afterr_request decorator to set Access-Control-Allow
     @app.after_request
@@ -56,71 +108,104 @@ def create_app(test_cobfig=None):
         )
         return response
     
+    @app.before_request
+    def start_background_tasks():
+        changes.ensure_compactor(app)
+    
     """
     Login in
     """
     @app.route('/login', methods=["GET", "POST"])
     def login():
-        body = request.get_json()
+        body = request.get_json(silent=True) or {}
         
         new_email = body.get("email", None)
         new_username = body.get("username", None)
         new_password = body.get("password", None)
-        new_role = body.get("role", None)
         
-        search = body.get("search", None)
+        if not (new_email or new_username) or not new_password:
+            abort(400)
+        
+        # one lookup on a unique (indexed) column; never a scan over users
+        if new_email:
+            user = User.query.filter(User.email == new_email).one_or_none()
+        else:
+            user = User.query.filter(User.username == new_username).one_or_none()
         
         try:
-            if search is None:
+            if user is None:
+                verify_dummy_password(new_password)
                 abort(403)
             
-            if new_email != User.email or new_username != User.username or new_password != User.password or new_role != User.role:
+            matches, needs_rehash = verify_password(new_password, user.actual_password)
+            if not matches:
                 abort(403)
-                
-            if search:
-                selection = User.query.order_by(User.id).filter(User.role.ilike("%{}%".format(search)))
-                current_user = paginage_students(request, selection)
-                
-                # users = User(email=new_email, username=new_username, password=new_password, role=new_role)
-                
-                conn = get_db_connection()
-                cur = conn.cursor()
-                cur.execute(selection)
-                
-                user = cur.fetchall()
-                
-                cur.close()
-                conn.close()
-                
-                if user:
-                    session['loggedin'] = True
-                    session['new_email'] = User('new_email')
-                    session['new_username'] = User('new_username')
-                    session['new_password'] = User('new_password')
-                    session['new_role'] = User('new_role')
-                
-                return jsonify(
-                    {
-                        "success": True,
-                        "user": current_user,
-                        "total_users": len(selection.all()),
-                    }
+            
+            if needs_rehash:
+                user.actual_password = hash_password_pooled(new_password)
+                user.update()
+        
+        except PasswordHashBusy:
+            abort(503)
+        
+        session.regenerate()
+        session['loggedin'] = True
+        session['user_id'] = user.id
+        session['role'] = user.role
+        
+        return jsonify(
+            {
+                "success": True,
+                "user": user.format(),
+            }
+        )
+    
+    """
+    Duplicate users
+    """
+    @app.route("/users/duplicates")
+    @requires_auth("get:users")
+    def retrieve_duplicate_users(payload):
+        min_score = request.args.get("min_score", duplicates.DUPLICATE_THRESHOLD, type=float)
+        page = max(request.args.get("page", 1, type=int), 1)
+        
+        found = duplicates.scan(min_score)
+        start = (page - 1) * STUDENTS_PER_PAGE
+        
+        return jsonify(
+            {
+                "success": True,
+                "duplicates": found[start:start + STUDENTS_PER_PAGE],
+                "total_duplicates": len(found),
+                "flagged": duplicates.flagged()
+            }
+        )
+    
+    @app.route("/users/duplicates/check", methods=["POST"])
+    @requires_auth("post:users")
+    def check_duplicate_user(payload):
+        fields = schemas.users.load(request.get_json(silent=True) or {}, partial=True)
+        if not (fields.get("first_name") or fields.get("last_name") or fields.get("email")):
+            abort(400)
+        
+        return jsonify(
+            {
+                "success": True,
+                "duplicates": duplicates.check(
+                    fields.get("first_name"), fields.get("last_name"), fields.get("email"), fields.get("phone_number"),
+                    exclude_id=request.args.get("user_id", None, type=int),
                 )
-            else:
-                abort(403)
-                
-        except Exception as e:
-            print(e)
-            abort(403)
+            }
+        )
     
     """
     Students
     """
     @app.route("/students")
     @requires_auth("get:students")
-    def get_students():
-        selection = Student.query.order_by(Student.id).all()
-        current_students = paginage_students(request, selection)
+    def get_students(payload):
+        page = cached_page(request, Student)
+        current_students = page["items"]
         
         if len(current_students) == 0:
             abort(404)
@@ -129,196 +214,263 @@ def create_app(test_cobfig=None):
             {
                 "success": True,
                 "students": current_students,
-                "total_students": len(Student.query.all())
+                "total_students": page["total"]
             }
         )
     
     @app.route("/students", methods=["POST"])
     @requires_auth("post:students")
     def create_students(payload):
-        body = request.get_json()
-        
-        new_date_of_birth = body.get("date_of_birth", None)
-        new_program_start_date = body.get("program_start_date", None)
-        new_program_end_date = body.get("program_end_date", None)
-        new_accommodation = body.get("accommodation", None)
-        new_amount_paid = body.get("amount_paid", None)
-        new_gender = body.get("gender", None)
-        new_student_program = body.get("student_program", None)
-        new_marital_status = body.get("marital_status", None)
-        new_health_condition = body.get("health_condition", None)
-        new_disability = body.get("disability", None)
-        new_profile_picture = body.get("profile_picture", None)
+        body = request.get_json(silent=True) or {}
         
         search = body.get("search", None)
+        fields = None if search else schemas.students.load(body)
         
         try:
             if search:
-                selection = Student.query.order_by(Student.id).filter(Student.student_program.ilike("%{}%".format(search)))
-                current_students = paginage_students(request, selection)
+                page = cached_page(request, Student, Student.student_program, search)
+                current_students = page["items"]
                 
                 return jsonify(
                     {
                         "success": True,
                         "students": current_students,
-                        "total_students": len(selection.all()),
+                        "total_students": page["total"],
                     }
                 )
                 
             else:
-                students = Student(date_of_birth=new_date_of_birth, program_start_date=new_program_start_date, program_end_date=new_program_end_date, accommodation=new_accommodation, amount_paid=new_amount_paid, gender=new_gender, student_program=new_student_program, marital_status=new_marital_status, health_condition=new_health_condition, disability=new_disability, profile_picture=new_profile_picture)
+                principal = principals.current_principal()
+                students = Student(user_id=principal.user_id if principal else None, **fields)
                 
                 students.insert()
                 
-                selection = Student.query.order_by(Student.id).all()
-                current_students = paginage_students(request, selection)
+                page = cached_page(request, Student)
+                current_students = page["items"]
                 
                 return jsonify(
                     {
                         "success": True,
                         "updated": students.id,
                         "students": current_students,
-                        "total_students": len(Student.query.all())
+                        "total_students": page["total"]
                     }
                 )
                 
-        except Exception as e:
-            print(e)
+        except Exception:
+            app.logger.exception("%s failed", request.endpoint)
             abort(422)
 
     @app.route("/students/<int:student_id>/edit", methods=["PATCH"])
     @requires_auth("patch:students")
     def edit_student_submission(payload, student_id):
-        body = request.get_json()
-        
-        new_date_of_birth = body.get("date_of_birth", None)
-        new_program_start_date = body.get("program_start_date", None)
-        new_program_end_date = body.get("program_end_date", None)
-        new_accommodation = body.get("accommodation", None)
-        new_amount_paid = body.get("amount_paid", None)
-        new_gender = body.get("gender", None)
-        new_student_program = body.get("student_program", None)
-        new_marital_status = body.get("marital_status", None)
-        new_health_condition = body.get("health_condition", None)
-        new_disability = body.get("disability", None)
-        new_profile_picture = body.get("profile_picture", None)
+        body = request.get_json(silent=True) or {}
         
         search = body.get("search", None)
+        if not search:
+            students = statements.get(Student, student_id)
+            if students is None:
+                abort(404)
+            fields = schemas.students.load(body, partial=True, current=students)
         
         try:
             if search:
-                selection = Student.query.order_by(Student.id).filter(Student.student_program.ilike("%{}%".format(search)))
-                current_students = paginage_students(request, selection)
+                page = cached_page(request, Student, Student.student_program, search)
+                current_students = page["items"]
                 
                 return jsonify(
                     {
                         "success": True,
                         "students": current_students,
-                        "total_students": len(selection.all()),
+                        "total_students": page["total"],
                     }
                 )
                 
             else:
-            
-                students = Student(date_of_birth=new_date_of_birth, program_start_date=new_program_start_date, program_end_date=new_program_end_date, accommodation=new_accommodation, amount_paid=new_amount_paid, gender=new_gender, student_program=new_student_program, marital_status=new_marital_status, health_condition=new_health_condition, disability=new_disability, profile_picture=new_profile_picture)
+                for name, value in fields.items():
+                    setattr(students, name, value)
                 
                 students.update()
                 
-                selection = Student.query.order_by(Student.id).all()
-                current_students = paginage_students(request, selection)
+                page = cached_page(request, Student)
+                current_students = page["items"]
                 
                 return jsonify(
                     {
                         "success": True,
                         "updated": students.id,
                         "students": current_students,
-                        "total_students": len(Student.query.all())
+                        "total_students": page["total"]
                     }
                 )
-        except Exception as e:
-            print(e)
+        except Exception:
+            app.logger.exception("%s failed", request.endpoint)
             abort(422)
     
     @app.route("/students/<int:student_id>", methods=["DELETE"])
     @requires_auth("delete:students")
-    def delete_student(student_id):
+    def delete_student(payload, student_id):
         try:
-            student = Student.query.filter(Student.id == student_id).one_or_none()
+            student = statements.get(Student, student_id)
             
             if student is None:
                 abort(404)
                 
             student.delete()
             
-            selection = Student.query.order_by(Student.id).all()
-            current_students = paginage_students(request, selection)
+            page = cached_page(request, Student)
+            current_students = page["items"]
             
             return jsonify(
                 {
                     "success": True,
                     "deleted": student_id,
                     "students": current_students,
-                    "total_students": len(Student.query.all())
+                    "total_students": page["total"]
                 }
             )
             
-        except Exception as e:
-            print(e)
+        except Exception:
+            app.logger.exception("%s failed", request.endpoint)
             abort(422)
     
     
+    @app.route("/students/active")
+    @requires_auth("get:students")
+    def retrieve_active_students(payload):
+        day = date_arg(request, "date", datetime.date.today())
+        program = request.args.get("program", None)
+        
+        if program:
+            # hot cohorts are answered from an in-process interval tree
+            ids = cohorts.active_student_ids(program, day)
+            page = max(request.args.get("page", 1, type=int), 1)
+            page_ids = ids[(page - 1) * STUDENTS_PER_PAGE:page * STUDENTS_PER_PAGE]
+            selection = Student.query.filter(Student.id.in_(page_ids)).order_by(Student.id).all() if page_ids else []
+            current_students = [student.format() for student in selection]
+            total_students = len(ids)
+        else:
+            start, end = day_bounds(day, day)
+            selection = Student.query.filter(
+                period(Student.program_start_date, Student.program_end_date).op("&&")(period(start, end))
+            ).order_by(Student.id)
+            current_students = paginate_query(request, selection)
+            total_students = selection.order_by(None).count()
+        
+        return jsonify(
+            {
+                "success": True,
+                "date": day.isoformat(),
+                "students": current_students,
+                "total_students": total_students
+            }
+        )
+    
+    @app.route("/students/facets")
+    @requires_auth("get:students")
+    def retrieve_student_facets(payload):
+        filters = {
+            column: [facet_value(column, value) for value in request.args.getlist(column)]
+            for column in facets.FACET_COLUMNS
+            if column in request.args
+        }
+        page = max(request.args.get("page", 1, type=int), 1)
+        
+        result = facets.search(filters, (page - 1) * STUDENTS_PER_PAGE, STUDENTS_PER_PAGE)
+        selection = Student.query.filter(Student.id.in_(result["ids"])).order_by(Student.id) if result["ids"] else []
+        
+        return jsonify(
+            {
+                "success": True,
+                "students": [student.format() for student in selection],
+                "total_students": result["total"],
+                "facets": result["facets"]
+            }
+        )
+    
+    @app.route("/students/<int:student_id>/profile-picture", methods=["POST", "PUT"])
+    @requires_auth("patch:students")
+    def upload_profile_picture(payload, student_id):
+        student = statements.get(Student, student_id)
+        
+        if student is None:
+            abort(404)
+        
+        upload = request.files.get("file")
+        stream = upload.stream if upload is not None else request.stream
+        
+        try:
+            digest = media.store_image(stream)
+        except media.MediaError as e:
+            return (
+                jsonify({"success": False, "error": e.status_code, "message": e.message}),
+                e.status_code,
+            )
+        
+        student.profile_picture = digest
+        student.update()
+        
+        return jsonify(
+            {
+                "success": True,
+                "updated": student.id,
+                "profile_picture": student.format()["profile_picture"]
+            }
+        )
+    
+    @app.route("/media/<digest>")
+    def get_media(digest):
+        return media.send_blob(digest)
+    
+    @app.route("/media/<digest>/<int:size>")
+    def get_media_thumbnail(digest, size):
+        return media.send_blob(digest, size)
+    
+    
     """
     Courses
     """
     @app.route("/courses", methods=["POST"])
     @requires_auth("post:courses")
-    def create_course():
-        body = request.get_json()
-        
-        new_course_title = body.get("course_title", None)
-        new_course_description = body.get("course_description", None)
-        new_course_instructor = body.get("course_instructor", None)
-        new_course_outline = body.get("course_outline", None)
-        new_course_material = body.get("course_material", None)
-        new_registered_students = body.get("registered_students", None)
-        new_course_start_date = body.get("course_start_date", None)
-        new_course_end_date = body.get("course_end_date", None)
-        new_course_project = body.get("course_project", None)
-        new_course_assignment = body.get("course_assignment", None)
+    def create_course(payload):
+        body = request.get_json(silent=True) or {}
         
         search = body.get("search", None)
+        fields = None if search else schemas.courses.load(body)
         
         try:
             if search:
-                selection = Course.query.order_by(Course.id).filter(Course.course_title.ilike("%{}%".format(search)))
-                current_courses = paginage_students(request, selection)
+                page = cached_page(request, Course, Course.course_title, search)
+                current_courses = page["items"]
                 
                 return jsonify(
                     {
                         "success": True,
                         "created": current_courses,
-                        "total_courses": len(selection.all())
+                        "total_courses": page["total"]
                     }
                 )
                 
             else:
-                courses = Course(course_title=new_course_title, course_description=new_course_description, course_instructor=new_course_instructor, course_outline=new_course_outline, course_material=new_course_material, registered_students=new_registered_students, course_start_date=new_course_start_date, course_end_date=new_course_end_date, course_project=new_course_project, course_assignment=new_course_assignment)
+                principal = principals.current_principal()
+                courses = Course(user_id=principal.user_id if principal else None, **fields)
                 
                 courses.insert()
                 
-                selection = Course.query.order_by(Course.id).all()
-                current_courses = paginage_students(request, selection)
+                page = cached_page(request, Course)
+                current_courses = page["items"]
                 
                 return jsonify(
                     {
                         "success": True,
                         "created": current_courses,
-                        "total_courses": len(Course.query.all())
+                        "total_courses": page["total"],
+                        "conflicts": schedule.course_conflicts(courses.id)
                     }
                 )
                 
-        except Exception as e:
-            print(e)
+        except Exception:
+            app.logger.exception("%s failed", request.endpoint)
             abort(422)
             
             #Testing with postman
@@ -326,9 +478,9 @@ def create_app(test_cobfig=None):
     
     @app.route("/courses")
     @requires_auth()
-    def retrieve_courses():
-        selection = Course.query.order_by(Course.id).all()
-        current_courses = paginage_students(request, selection)
+    def retrieve_courses(payload):
+        page = cached_page(request, Course)
+        current_courses = page["items"]
         
         if len(current_courses) == 0:
             abort(404)
@@ -337,94 +489,314 @@ def create_app(test_cobfig=None):
             {
                 "success": True,
                 "courses": current_courses,
-                "total_courses": len(Course.query.all())
+                "total_courses": page["total"]
+            }
+        )
+    
+    @app.route("/courses/running")
+    @requires_auth("get:courses")
+    def retrieve_running_courses(payload):
+        week = date_arg(request, "week", None)
+        
+        if week is not None:
+            first_day = week - datetime.timedelta(days=week.weekday())
+            last_day = first_day + datetime.timedelta(days=6)
+        else:
+            first_day = date_arg(request, "start", datetime.date.today())
+            last_day = date_arg(request, "end", first_day)
+        
+        if last_day < first_day:
+            abort(400)
+        
+        start, end = day_bounds(first_day, last_day)
+        selection = Course.query.filter(
+            Course.course_start_date.isnot(None),
+            Course.course_end_date.isnot(None),
+            period(Course.course_start_date, Course.course_end_date).op("&&")(period(start, end))
+        ).order_by(Course.id)
+        
+        return jsonify(
+            {
+                "success": True,
+                "start": first_day.isoformat(),
+                "end": last_day.isoformat(),
+                "courses": paginate_query(request, selection),
+                "total_courses": selection.order_by(None).count()
             }
         )
     
     @app.route("/courses/<int:course_id>", methods=["DELETE"])
     def delete_course(course_id):
         try:
-            course = Course.query.filter(Course.id == course_id).one_or_none()
+            course = statements.get(Course, course_id)
             
             if course is None:
                 abort(404)
                 
             course.delete()
             
-            selection = Course.query.order_by(Course.id).all()
-            current_courses = paginage_students(request, selection)
+            page = cached_page(request, Course)
+            current_courses = page["items"]
             
             return jsonify(
                 {
                     "success": True,
                     "deleted": course_id,
                     "courses": current_courses,
-                    "total_courses": len(Course.query.all())
+                    "total_courses": page["total"]
                 }
             )
             
-        except Exception as e:
-            print(e)
+        except Exception:
+            app.logger.exception("%s failed", request.endpoint)
             abort(422)
         
     @app.route("/courses/<int:course_id>/edit", methods=["POST"])
     def edit_courses(course_id):
-        body = request.get_json()
-        
-        new_course_title = body.get("course_title", None)
-        new_course_description = body.get("course_description", None)
-        new_course_instructor = body.get("course_instructor", None)
-        new_course_outline = body.get("course_outline", None)
-        new_registered_students = body.get("registered_students", None)
-        new_course_start_date = body.get("course_start_date", None)
-        new_course_end_date = body.get("course_end_date", None)
-        new_course_project = body.get("course_project", None)
-        new_course_assignment = body.get("course_assignment", None)
+        body = request.get_json(silent=True) or {}
         
         search = body.get("search", None)
+        if not search:
+            courses = statements.get(Course, course_id)
+            if courses is None:
+                abort(404)
+            fields = schemas.courses.load(body, partial=True, current=courses)
         
         try:
             if search:
-                selection = Student.query.order_by(Student.id).filter(Student.course_title.ilike("%{}%".format(search)))
-                current_courses = paginage_students(request, selection)
+                page = cached_page(request, Course, Course.course_title, search)
+                current_courses = page["items"]
                 
                 return jsonify(
                     {
                         "success": True,
                         "courses": current_courses,
-                        "total_courses": len(selection.all()),
+                        "total_courses": page["total"],
                     }
                 )
                 
             else:
-            
-                courses = Course(course_title=new_course_title, course_description=new_course_description, course_instructor=new_course_instructor, course_outline=new_course_outline, registered_students=new_registered_students, course_start_date=new_course_start_date, course_end_date=new_course_end_date, course_project=new_course_project, course_assignment=new_course_assignment)
+                for name, value in fields.items():
+                    setattr(courses, name, value)
                 
                 courses.update()
                 
-                selection = Course.query.order_by(Course.id).all()
-                current_courses = paginage_students(request, selection)
+                page = cached_page(request, Course)
+                current_courses = page["items"]
                 
                 return jsonify(
                     {
                         "success": True,
                         "updated": courses.id,
                         "courses": current_courses,
-                        "total_courses": len(Course.query.all())
+                        "total_courses": page["total"],
+                        "conflicts": schedule.course_conflicts(courses.id)
                     }
                 )
                 
-        except Exception as e:
-            print(e)
+        except Exception:
+            app.logger.exception("%s failed", request.endpoint)
             abort(422)
             
+    @app.route("/schedule/conflicts")
+    @requires_auth("get:courses")
+    def retrieve_schedule_conflicts(payload):
+        first_day = date_arg(request, "start")
+        last_day = date_arg(request, "end")
+        
+        if first_day is None or last_day is None or last_day < first_day:
+            abort(400)
+        
+        conflicts = schedule.term_conflicts(*day_bounds(first_day, last_day))
+        
+        return jsonify(
+            {
+                "success": True,
+                "start": first_day.isoformat(),
+                "end": last_day.isoformat(),
+                "instructor_conflicts": conflicts["instructors"],
+                "student_conflicts": conflicts["students"],
+                "total_conflicts": len(conflicts["instructors"]) + len(conflicts["students"])
+            }
+        )
+            
+    """
+    Course materials
+    """
+    @app.route("/courses/<int:course_id>/materials")
+    @requires_auth("get:courses")
+    def retrieve_course_materials(payload, course_id):
+        course = statements.get(Course, course_id)
+        
+        if course is None:
+            abort(404)
+        
+        selection = CourseMaterial.query.filter(CourseMaterial.course_id == course_id).order_by(CourseMaterial.id).all()
+        
+        return jsonify(
+            {
+                "success": True,
+                "course_id": course_id,
+                "course_outline": course.course_outline,
+                "course_material": course.course_material,
+                "materials": [material.format() for material in selection],
+            }
+        )
+    
+    @app.route("/courses/<int:course_id>/materials/<int:material_id>")
+    @requires_auth("get:courses")
+    def download_course_material(payload, course_id, material_id):
+        material = CourseMaterial.query.filter(CourseMaterial.id == material_id, CourseMaterial.course_id == course_id).one_or_none()
+        
+        if material is None:
+            abort(404)
+        
+        return send_file(
+            media.blob_path(material.digest),
+            mimetype=material.content_type,
+            as_attachment=True,
+            download_name=material.filename,
+            conditional=True,
+            etag=material.digest,
+        )
+    
+    @app.route("/courses/<int:course_id>/materials/uploads", methods=["POST"])
+    @requires_auth("post:courses")
+    def create_course_material_upload(payload, course_id):
+        body = request.get_json(silent=True) or {}
+        
+        if statements.get(Course, course_id) is None:
+            abort(404)
+        
+        filename = body.get("filename", None)
+        content_type = body.get("content_type", None)
+        
+        # content this caller already has attached: link it, skip the upload
+        principal = principals.current_principal()
+        size = materials.linkable_blob(body.get("sha256", None), course_id, principal.user_id if principal else None)
+        if size is not None:
+            material = CourseMaterial(course_id=course_id, digest=body["sha256"], filename=filename, content_type=content_type, size=size)
+            material.insert()
+            
+            return jsonify({"success": True, "complete": True, "material": material.format()}), 201
+        
+        try:
+            upload = materials.create_upload(course_id, filename, content_type, body.get("size", None))
+        except materials.UploadError as e:
+            return upload_error(e)
+        
+        upload["complete"] = False
+        return jsonify({"success": True, "upload": upload}), 201
+    
+    @app.route("/courses/<int:course_id>/materials/uploads/<upload_id>")
+    @requires_auth("post:courses")
+    def get_course_material_upload(payload, course_id, upload_id):
+        try:
+            upload = materials.load_upload(upload_id)
+        except materials.UploadError as e:
+            return upload_error(e)
+        
+        if upload["course_id"] != course_id:
+            abort(404)
+        
+        return jsonify({"success": True, "upload": upload}), 200, {"Upload-Offset": str(upload["offset"])}
+    
+    @app.route("/courses/<int:course_id>/materials/uploads/<upload_id>", methods=["PUT", "PATCH"])
+    @requires_auth("post:courses")
+    def append_course_material_chunk(payload, course_id, upload_id):
+        try:
+            upload = materials.load_upload(upload_id)
+            if upload["course_id"] != course_id:
+                abort(404)
+            
+            start, length = materials.parse_content_range(request.headers.get("Content-Range"), upload["size"])
+            upload = materials.append_chunk(upload_id, start, length, request.stream)
+            
+            if not upload["complete"]:
+                return jsonify({"success": True, "upload": upload}), 202, {"Upload-Offset": str(upload["offset"])}
+            
+            upload, digest = materials.finish_upload(upload_id)
+        except materials.UploadError as e:
+            return upload_error(e)
+        
+        material = CourseMaterial(course_id=course_id, digest=digest, filename=upload["filename"], content_type=upload["content_type"], size=upload["size"])
+        material.insert()
+        
+        return jsonify({"success": True, "complete": True, "material": material.format()}), 201
+    
+    def upload_error(e):
+        headers = {} if e.offset is None else {"Upload-Offset": str(e.offset)}
+        return (
+            jsonify({"success": False, "error": e.status_code, "message": e.message, "offset": e.offset}),
+            e.status_code,
+            headers,
+        )
+    
+    
+    """
+    Grade analytics
+    """
+    @app.route("/courses/<int:course_id>/grades/analytics")
+    @requires_auth("get:courses")
+    def retrieve_grade_analytics(payload, course_id):
+        if statements.get(Course, course_id) is None:
+            abort(404)
+        
+        cohort = request.args.get("cohort", None)
+        
+        return jsonify(
+            {
+                "success": True,
+                "analytics": grades.course_analytics(course_id, cohort),
+            }
+        )
+    
+    
+    @app.route("/courses/<int:course_id>/grades", methods=["POST"])
+    @requires_auth("post:instructors")
+    def bulk_grade(payload, course_id):
+        course = statements.get(Course, course_id)
+        
+        if course is None:
+            abort(404)
+        
+        body = request.get_json(silent=True) or {}
+        week = grades.normalize_week(body.get("week", None))
+        # grades are always attributed to the caller, never to a named user
+        principal = principals.current_principal()
+        
+        try:
+            if "user_id" in body:
+                raise grades.GradingError("user_id is taken from the token and must not be sent")
+            if principal is None:
+                raise grades.GradingError("no user is linked to this token", 403)
+            if week is None:
+                raise grades.GradingError("week is required")
+            user_id = principal.user_id
+            graded = grades.validate_grades(course_id, body.get("grades", None))
+            summary = grades.upsert_grades(course, week, user_id, graded)
+        except grades.GradingError as e:
+            db.session.rollback()
+            return (
+                jsonify({"success": False, "error": e.status_code, "message": e.message, "errors": e.errors}),
+                e.status_code,
+            )
+        
+        return jsonify(
+            {
+                "success": True,
+                "summary": summary
+            }
+        )
+    
+    
     """
     Instructor
     """
     @app.route("/instructos")
     def retrieve_instructos():
-        selection = Instructor.query.order_by(Instructor.id).all()
-        current_instructors = paginage_students(request, selection)
+        page = cached_page(request, Instructor)
+        current_instructors = page["items"]
         
         if len(current_instructors) == 0:
             abort(404)
@@ -433,123 +805,268 @@ def create_app(test_cobfig=None):
             {
                 "success": True,
                 "instructors": current_instructors,
-                "total_instructors": len(Instructor.query.all())
+                "total_instructors": page["total"]
             }
         )
     
     @app.route("/instructors", methods=["POST"])
     def create_instructors():
-        body = request.get_json()
-        
-        new_instructor_course = body.get("instructor_course", None)
-        new_weekly_project = body.get("weekly_project", None)
-        new_project_grade = body.get("project_grade", None)
+        body = request.get_json(silent=True) or {}
         
         search = body.get("search", None)
+        fields = None if search else schemas.instructors.load(body)
         
         try:
             if search:
-                selection = Instructor.query.order_by(Instructor.id).filter(Instructor.instructor_course.ilike("%{}%".format(search)))
-                current_instructors = paginage_students(request, selection)
+                page = cached_page(request, Instructor, Instructor.instructor_course, search)
+                current_instructors = page["items"]
                 
                 return jsonify(
                     {
                         "success": True,
                         "created": current_instructors,
-                        "total_instructors": len(selection.all())
+                        "total_instructors": page["total"]
                     }
                 )
                 
             else:
-                instructors = Instructor(instructor_course=new_instructor_course, weekly_project=new_weekly_project, project_grade=new_project_grade)
+                principal = principals.current_principal()
+                instructors = Instructor(user_id=principal.user_id if principal else None, **fields)
                 
                 instructors.insert()
                 
-                selection = Instructor.query.order_by(Instructor.id).all()
-                current_instructors = paginage_students(request, selection)
+                page = cached_page(request, Instructor)
+                current_instructors = page["items"]
                 
                 return jsonify(
                     {
                         "success": True,
                         "created": current_instructors,
-                        "total_instructors": len(Instructor.query.all())
+                        "total_instructors": page["total"]
                     }
                 )
                 
-        except Exception as e:
-            print(e)
+        except Exception:
+            app.logger.exception("%s failed", request.endpoint)
             abort(422)
     
     @app.route("/instructors/<int:instructor_id>/edit", methods=["POST"])
     def edit_instructor(instructor_id):
-        body = request.get_json()
-        
-        new_instructor_course = body.get("instructor_course", None)
-        new_weekly_project = body.get("weekly_project", None)
-        new_project_grade = body.get("project_grade", None)
+        body = request.get_json(silent=True) or {}
         
         search = body.get("search", None)
+        if not search:
+            fields = schemas.instructors.load(body, partial=True)
+            instructors = statements.get(Instructor, instructor_id)
+            if instructors is None:
+                abort(404)
         
         try:
             if search:
-                selection = Instructor.query.order_by(Instructor.id).filter(Instructor.instructor_course.ilike("%{}%".format(search)))
-                current_instructors = paginage_students(request, selection)
+                page = cached_page(request, Instructor, Instructor.instructor_course, search)
+                current_instructors = page["items"]
                 
                 return jsonify(
                     {
                         "success": True,
                         "created": current_instructors,
-                        "total_instructors": len(selection.all())
+                        "total_instructors": page["total"]
                     }
                 )
                 
             else:
-                instructors = Instructor(instructor_course=new_instructor_course, weekly_project=new_weekly_project, project_grade=new_project_grade)
+                for name, value in fields.items():
+                    setattr(instructors, name, value)
                 
                 instructors.update()
                 
-                selection = Instructor.query.order_by(Instructor.id).all()
-                current_instructors = paginage_students(request, selection)
+                page = cached_page(request, Instructor)
+                current_instructors = page["items"]
                 
                 return jsonify(
                     {
                         "success": True,
                         "created": current_instructors,
-                        "total_instructors": len(Instructor.query.all())
+                        "total_instructors": page["total"]
                     }
                 )
                 
-        except Exception as e:
-            print(e)
+        except Exception:
+            app.logger.exception("%s failed", request.endpoint)
             abort(422)
             
     @app.route("/instructors/<int:instructor_id>", methods=["DELETE"])
     def delete_instructor(instructor_id):
         try:
-            instructor = Instructor.query.filter(Instructor.id == instructor_id).one_or_none()
+            instructor = statements.get(Instructor, instructor_id)
             
             if instructor is None:
                 abort(404)
                 
             instructor.delete()
             
-            selection = Instructor.query.order_by(Instructor.id).all()
-            current_instructors = paginage_students(request, selection)
+            page = cached_page(request, Instructor)
+            current_instructors = page["items"]
             
             return jsonify(
                 {
                     "success": True,
                     "deleted": instructor_id,
                     "instructors": current_instructors,
-                    "total_instructors": len(Instructor.query.all())
+                    "total_instructors": page["total"]
                 }
             )
             
-        except Exception as e:
-            print(e)
+        except Exception:
+            app.logger.exception("%s failed", request.endpoint)
             abort(422)
         
             
+    """
+    Change feed
+    """
+    @app.route("/changes")
+    @requires_auth()
+    def retrieve_changes(payload):
+        since = request.args.get("since", 0, type=int)
+        limit = min(max(request.args.get("limit", changes.CHANGES_PER_PAGE, type=int), 1), changes.CHANGES_PER_PAGE)
+        
+        current_changes, next_since, has_more = changes.changes_since(since, limit)
+        
+        return jsonify(
+            {
+                "success": True,
+                "since": since,
+                "next_since": next_since,
+                "has_more": has_more,
+                "changes": current_changes
+            }
+        )
+        
+            
+    """
+    Live updates
+    """
+    @app.route("/events")
+    @requires_auth()
+    def stream_events(payload):
+        entities = [entity for entity in request.args.get("entities", "").split(",") if entity] or None
+        operations = [operation for operation in request.args.get("operations", "").split(",") if operation] or None
+        
+        if entities and not set(entities) <= set(TRACKED_TABLES):
+            abort(400)
+        if operations and not set(operations) <= {"insert", "update", "delete"}:
+            abort(400)
+        
+        subscriber = events.broadcaster.subscribe(entities, operations)
+        if subscriber is None:
+            abort(503)
+        
+        # replay what a reconnecting client missed; subscribing first means
+        # nothing falls between the replay and the live stream
+        try:
+            backlog, resync = [], False
+            last_event_id = request.headers.get("Last-Event-ID", request.args.get("since", ""))
+            if last_event_id.isdigit():
+                backlog, _, resync = changes.changes_since(int(last_event_id))
+                backlog = [change for change in backlog if subscriber.wants(change)]
+        except Exception:
+            events.broadcaster.unsubscribe(subscriber)
+            raise
+        
+        return Response(
+            events.stream(subscriber, backlog, resync),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        
+            
+    """
+    Background jobs
+    """
+    @app.route("/jobs", methods=["POST"])
+    @requires_auth("post:jobs")
+    def create_job(payload):
+        body = request.get_json(silent=True) or {}
+        kind = body.get("kind")
+        
+        if kind not in jobs.JOBS or not isinstance(body.get("payload", {}), dict):
+            abort(400)
+        
+        # payload and max_attempts are checked here, not when a worker runs the job
+        principal = principals.current_principal()
+        new_job = jobs.enqueue(kind, body.get("payload"), body.get("max_attempts", 3), principal.user_id if principal else None)
+        
+        response = jsonify(
+            {
+                "success": True,
+                "job": new_job.format()
+            }
+        )
+        response.status_code = 202
+        response.headers["Location"] = url_for("retrieve_job", job_id=new_job.id)
+        return response
+    
+    @app.route("/jobs/<int:job_id>")
+    @requires_auth("get:jobs")
+    def retrieve_job(payload, job_id):
+        job = statements.get(Job, job_id)
+        
+        if job is None:
+            abort(404)
+        
+        return jsonify(
+            {
+                "success": True,
+                "job": job.format()
+            }
+        )
+    
+    @app.route("/jobs/<int:job_id>/cancel", methods=["POST"])
+    @requires_auth("post:jobs")
+    def cancel_job(payload, job_id):
+        job = statements.get(Job, job_id)
+        
+        if job is None:
+            abort(404)
+        
+        return jsonify(
+            {
+                "success": True,
+                "job": jobs.cancel(job).format()
+            }
+        )
+    
+    @app.route("/jobs/<int:job_id>/download")
+    @requires_auth("get:jobs")
+    def download_job_result(payload, job_id):
+        job = statements.get(Job, job_id)
+        
+        if job is None or job.status != "succeeded":
+            abort(404)
+        
+        path = (job.format()["result"] or {}).get("path")
+        if path is None or not os.path.exists(path):
+            abort(404)
+        
+        return send_file(path, mimetype="application/gzip", as_attachment=True, conditional=True)
+        
+            
+    """
+    Metrics
+    """
+    @app.route("/metrics")
+    @requires_auth("get:metrics")
+    def retrieve_metrics(payload):
+        return jsonify(
+            {
+                "success": True,
+                "pid": os.getpid(),
+                "metrics": metrics.snapshot()
+            }
+        )
+        
+            
     """
     Here are the error handlers for all expected errors
     including 404 and 422.
@@ -563,6 +1080,8 @@ def create_app(test_cobfig=None):
 
     @app.errorhandler(422)
     def unprocessable(error):
+        if deadlines.exceeded():
+            return deadline_exceeded(error)
         return (
             jsonify({"success": False, "error": 422, "message": "unprocessable"}),
             422,
@@ -581,8 +1100,48 @@ def create_app(test_cobfig=None):
             jsonify({"success": False, "error": 400, "message": "bad request"}), 400
         )
         
+    @app.errorhandler(403)
+    def forbidden(error):
+        return (
+            jsonify({"success": False, "error": 403, "message": "forbidden"}),
+            403,
+        )
+
+    @app.errorhandler(503)
+    def unavailable(error):
+        return (
+            jsonify({"success": False, "error": 503, "message": "service unavailable"}),
+            503,
+            {"Retry-After": "1"},
+        )
+
+    @app.errorhandler(schemas.SchemaError)
+    def invalid_body(error):
+        return (
+            jsonify({"success": False, "error": error.status_code, "message": error.message, "errors": error.errors}),
+            error.status_code,
+        )
+
+    @app.errorhandler(admission.Overloaded)
+    def overloaded(error):
+        return (
+            jsonify({"success": False, "error": error.status_code, "message": error.message}),
+            error.status_code,
+            {"Retry-After": str(error.retry_after)},
+        )
+
+    @app.errorhandler(504)
+    @app.errorhandler(deadlines.DeadlineExceeded)
+    def deadline_exceeded(error):
+        return (
+            jsonify({"success": False, "error": 504, "message": "deadline exceeded"}),
+            504,
+        )
+
     @app.errorhandler(500)
     def bad_request(error):
+        if deadlines.exceeded():
+            return deadline_exceeded(error)
         return (
             jsonify({"success": False, "error": 400, "message": "server error"}), 500
         )
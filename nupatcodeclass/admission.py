@@ -0,0 +1,198 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, request
+
+# group=limit:queue:timeout -- at most limit requests of the group run at
+# once per worker, up to queue more wait at most timeout seconds for a slot
+ADMISSION_GROUPS = os.getenv("ADMISSION_GROUPS", "reads=32:64:2,writes=8:32:2,login=4:16:1,exports=2:8:5")
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", 10))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", 40))
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", 10000))
+
+# endpoints outside the read/write split; /events holds its connection for
+# minutes on the streaming process (server.py --streams), where each worker
+# is bounded by EVENTS_MAX_SUBSCRIBERS connections instead
+ENDPOINT_GROUPS = {
+    "login": "login",
+    "create_job": "exports",
+    "download_job_result": "exports",
+    "download_course_material": "exports",
+    "stream_events": None,
+    "static": None,
+}
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class Overloaded(Exception):
+    def __init__(self, status_code, retry_after, message):
+        self.status_code = status_code
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.message = message
+
+
+'''
+Gate
+    a concurrency limit with a bounded waiting room. a request that finds
+    every slot taken waits for one; if the waiting room is full, or no slot
+    frees up before the deadline, it is turned away at once instead of
+    piling onto a worker that is already behind.
+'''
+class Gate:
+    def __init__(self, name, limit, queue_size, timeout):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.waited = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            if self.active < self.limit:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                return False
+
+            self.waiting += 1
+            started = time.monotonic()
+            deadline = started + self.timeout
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+                self.waited += time.monotonic() - started
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "queue_size": self.queue_size,
+                "timeout": self.timeout,
+                "active": self.active,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "waited_seconds": round(self.waited, 3),
+            }
+
+
+'''
+TokenBuckets
+    one token bucket per client key (the JWT subject): RATE_LIMIT_BURST
+    requests at once, refilled at RATE_LIMIT_PER_SECOND. idle clients are
+    evicted least recently seen first once RATE_LIMIT_MAX_CLIENTS is reached.
+'''
+class TokenBuckets:
+    def __init__(self, rate, burst, max_clients=RATE_LIMIT_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.allowed = 0
+        self.limited = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Takes a token for key; returns 0, or the seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+                self.allowed += 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.limited += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "clients": len(self._buckets),
+                "allowed": self.allowed,
+                "limited": self.limited,
+            }
+
+
+def parse_groups(spec):
+    gates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, settings = item.partition("=")
+        limit, queue_size, timeout = settings.split(":")
+        gates[name] = Gate(name, int(limit), int(queue_size), float(timeout))
+    return gates
+
+
+gates = parse_groups(ADMISSION_GROUPS)
+buckets = TokenBuckets(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST) if RATE_LIMIT_PER_SECOND > 0 else None
+
+
+def group_for(endpoint, method):
+    if endpoint in ENDPOINT_GROUPS:
+        return ENDPOINT_GROUPS[endpoint]
+    return "reads" if method in READ_METHODS else "writes"
+
+
+def admit():
+    """before_request hook: waits for a slot in the request's group or raises Overloaded."""
+    gate = gates.get(group_for(request.endpoint, request.method))
+    if gate is None:
+        return
+    if not gate.acquire():
+        raise Overloaded(503, gate.timeout, "service overloaded")
+    g.admission_gate = gate
+
+
+def release(error=None):
+    gate = g.pop("admission_gate", None)
+    if gate is not None:
+        gate.release()
+
+
+def limit_subject(sender, payload, **extra):
+    """auth_verified receiver: applies the per-client token bucket once the JWT is known."""
+    if buckets is None or not payload.get("sub"):
+        return
+    wait = buckets.take(payload["sub"])
+    if wait:
+        raise Overloaded(429, wait, "too many requests")
+
+
+def stats():
+    return {
+        "groups": {name: gate.stats() for name, gate in gates.items()},
+        "rate_limit": buckets.stats() if buckets is not None else None,
+    }
@@ -0,0 +1,117 @@
+import datetime
+import os
+import threading
+import time
+
+from sqlalchemy import text
+
+from models import db, Change, User, Student, Sponsor, Course, CourseMaterial, Instructor, Admin, CHANGE_LOG_LOCK
+
+CHANGES_PER_PAGE = int(os.getenv("CHANGES_PER_PAGE", 500))
+CHANGE_COMPACT_AFTER = int(os.getenv("CHANGE_COMPACT_AFTER", 60 * 60 * 24))
+CHANGE_COMPACT_INTERVAL = int(os.getenv("CHANGE_COMPACT_INTERVAL", 60 * 10))
+CHANGE_COMPACT_BATCH = int(os.getenv("CHANGE_COMPACT_BATCH", 5000))
+
+MODELS = {model.__tablename__: model for model in (User, Student, Sponsor, Course, CourseMaterial, Instructor, Admin)}
+
+'''
+changes_since(since, limit)
+    one page of the change log after version since. a row changed several
+    times within the page is reported once, at its latest version, together
+    with its current formatted state (loaded with one query per entity), so
+    a client can apply the page to its local mirror as is.
+    returns (changes, next_since, has_more)
+'''
+def changes_since(since, limit=CHANGES_PER_PAGE):
+    rows = Change.query.filter(Change.version > since).order_by(Change.version).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        return [], since, False
+
+    latest = {}
+    for row in rows:
+        latest[(row.entity, row.entity_id)] = row
+
+    ids = {}
+    for entity, entity_id in latest:
+        ids.setdefault(entity, []).append(entity_id)
+
+    current = {}
+    for entity, entity_ids in ids.items():
+        model = MODELS[entity]
+        for instance in model.query.filter(model.id.in_(entity_ids)):
+            current[(entity, instance.id)] = instance.format()
+
+    changes = []
+    for key, row in sorted(latest.items(), key=lambda item: item[1].version):
+        change = row.format()
+        change["data"] = current.get(key)
+        if change["data"] is None:
+            change["operation"] = "delete"
+        changes.append(change)
+
+    return changes, rows[-1].version, has_more
+
+
+'''
+compact(horizon)
+    drops change rows older than horizon that a later row for the same
+    entity supersedes. a client catching up from an old version still ends
+    with the right state, it just skips the intermediate steps. only one
+    process compacts at a time (advisory lock); returns rows removed.
+'''
+def compact(horizon, batch=CHANGE_COMPACT_BATCH):
+    removed = 0
+    connection = db.session.connection()
+    if not connection.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": CHANGE_LOG_LOCK + 1}).scalar():
+        db.session.rollback()
+        return 0
+
+    while True:
+        deleted = connection.execute(
+            text(
+                "DELETE FROM changes WHERE version IN ("
+                " SELECT c.version FROM changes c"
+                " WHERE c.changed_at < :horizon AND EXISTS ("
+                "  SELECT 1 FROM changes n"
+                "  WHERE n.entity = c.entity AND n.entity_id = c.entity_id AND n.version > c.version)"
+                " LIMIT :batch)"
+            ),
+            {"horizon": horizon, "batch": batch},
+        ).rowcount
+        removed += deleted
+        if deleted < batch:
+            break
+
+    db.session.commit()
+    return removed
+
+
+_compactor_pid = None
+_compactor_lock = threading.Lock()
+
+
+def _compact_forever(app):
+    while True:
+        time.sleep(CHANGE_COMPACT_INTERVAL)
+        with app.app_context():
+            try:
+                compact(datetime.datetime.utcnow() - datetime.timedelta(seconds=CHANGE_COMPACT_AFTER))
+            except Exception:
+                app.logger.exception("change log compaction failed")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+
+def ensure_compactor(app):
+    """Starts the background compactor once per worker process."""
+    global _compactor_pid
+    if _compactor_pid == os.getpid() or CHANGE_COMPACT_INTERVAL <= 0:
+        return
+    with _compactor_lock:
+        if _compactor_pid == os.getpid():
+            return
+        threading.Thread(target=_compact_forever, args=(app,), name="change-compactor", daemon=True).start()
+        _compactor_pid = os.getpid()
@@ -0,0 +1,144 @@
+import datetime
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import db, Student
+from nupatcodeclass.intervals import IntervalTree
+
+COHORT_INDEX_SIZE = int(os.getenv("COHORT_INDEX_SIZE", 16))
+COHORT_INDEX_TTL = int(os.getenv("COHORT_INDEX_TTL", 300))
+
+'''
+Hot cohort indexes
+    one IntervalTree of (program_start_date, program_end_date, student id)
+    per student_program, built on first use and kept in a small LRU. commits
+    that touch Student rows are applied to the cached trees in place, so a
+    busy cohort is not rebuilt after every edit. the TTL bounds how long a
+    worker can miss a change committed by another worker process.
+'''
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def _ordered(start, end):
+    # the same span models.period() indexes for rows whose dates are swapped
+    return min(start, end), max(start, end)
+
+
+def _build(program):
+    rows = (
+        db.session.query(Student.id, Student.program_start_date, Student.program_end_date)
+        .filter(Student.student_program == program)
+        .all()
+    )
+    tree = IntervalTree()
+    for student_id, start, end in rows:
+        if start is not None and end is not None:
+            tree.insert(*_ordered(start, end), student_id)
+    return tree
+
+
+def cohort_index(program):
+    now = time.monotonic()
+    with _lock:
+        cached = _indexes.get(program)
+        if cached is not None and now - cached[0] < COHORT_INDEX_TTL:
+            _indexes.move_to_end(program)
+            return cached[1]
+
+    tree = _build(program)
+    with _lock:
+        _indexes[program] = (now, tree)
+        _indexes.move_to_end(program)
+        while len(_indexes) > COHORT_INDEX_SIZE:
+            _indexes.popitem(last=False)
+    return tree
+
+
+def active_student_ids(program, day):
+    """Sorted ids of the students of a program active at any time on day."""
+    start = datetime.datetime.combine(day, datetime.time.min)
+    end = datetime.datetime.combine(day, datetime.time.max)
+    tree = cohort_index(program)
+    with _lock:
+        return sorted(value for _, _, value in tree.overlapping(start, end))
+
+
+def invalidate(*programs):
+    """Drops the trees of these programs; they are rebuilt on next use."""
+    with _lock:
+        for program in programs:
+            _indexes.pop(program, None)
+
+
+_UNKNOWN = object()
+
+
+def _previous(state, name):
+    history = state.attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return state.dict.get(name, _UNKNOWN)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_student_changes(session, flush_context):
+    changes = session.info.setdefault("cohort_changes", [])
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(instance, Student):
+            continue
+        state = inspect(instance)
+        if instance not in session.new:
+            changes.append((
+                "remove",
+                _previous(state, "student_program"),
+                _previous(state, "program_start_date"),
+                _previous(state, "program_end_date"),
+                instance.id,
+            ))
+        if instance not in session.deleted:
+            changes.append((
+                "insert",
+                instance.student_program,
+                instance.program_start_date,
+                instance.program_end_date,
+                instance.id,
+            ))
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_student_changes(session):
+    changes = session.info.pop("cohort_changes", None)
+    if not changes:
+        return
+
+    with _lock:
+        for op, program, start, end, student_id in changes:
+            if _UNKNOWN in (program, start, end):
+                # the old values were never loaded; rebuild on next use
+                if program is _UNKNOWN:
+                    _indexes.clear()
+                else:
+                    _indexes.pop(program, None)
+                continue
+            cached = _indexes.get(program)
+            if cached is None:
+                continue
+            if start is None or end is None:
+                continue
+            if op == "remove":
+                cached[1].remove(*_ordered(start, end), student_id)
+            else:
+                cached[1].insert(*_ordered(start, end), student_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_student_changes(session):
+    session.info.pop("cohort_changes", None)
@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", 6))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", 5))
+COMPRESS_CACHE_BYTES = int(os.getenv("COMPRESS_CACHE_BYTES", 32 * 1024 * 1024))
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/csv", "text/plain", "text/html"}
+
+'''
+CompressedCache
+    compressed bodies keyed by (digest of the uncompressed body, encoding),
+    bounded by total compressed bytes with LRU eviction. a page that comes
+    out byte-identical (same table version, same query) is compressed once;
+    every later poll pays only for hashing the body, which is an order of
+    magnitude cheaper than compressing it. a changed table changes the body
+    and so the key, so nothing ever needs invalidating.
+'''
+class CompressedCache:
+    def __init__(self, max_bytes=COMPRESS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= len(previous)
+            self._entries[key] = value
+            self.bytes += len(value)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+cache = CompressedCache()
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+
+def choose_encoding(accept_encodings):
+    candidates = []
+    if brotli is not None and accept_encodings["br"]:
+        candidates.append((accept_encodings["br"], 1, "br"))
+    if accept_encodings["gzip"]:
+        candidates.append((accept_encodings["gzip"], 0, "gzip"))
+    return max(candidates)[2] if candidates else None
+
+
+'''
+compress_response(response)
+    after_request hook: compresses buffered JSON/text bodies of at least
+    COMPRESS_MIN_SIZE bytes with the best encoding the client accepts.
+    files and streams (send_file, /events) pass through untouched.
+'''
+def compress_response(response):
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code != 200
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(request.accept_encodings)
+    body = response.get_data()
+    if encoding is None or len(body) < COMPRESS_MIN_SIZE:
+        return response
+
+    if request.method == "GET":
+        key = (hashlib.blake2b(body, digest_size=16).digest(), encoding)
+        compressed = cache.get(key)
+        if compressed is None:
+            compressed = compress(body, encoding)
+            cache.put(key, compressed)
+    else:
+        compressed = compress(body, encoding)
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from nupatcodeclass.admission import group_for
+
+# name=seconds pairs; a name is an endpoint or an admission group, the
+# endpoint wins. 0 means no deadline
+DEADLINE_BUDGETS = os.getenv("DEADLINE_BUDGETS", "reads=5,writes=10,login=3,exports=30")
+
+QUERY_CANCELED = "57014"
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def parse_budgets(spec):
+    budgets = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, seconds = item.partition("=")
+        budgets[name] = float(seconds)
+    return budgets
+
+
+budgets = parse_budgets(DEADLINE_BUDGETS)
+
+_exceeded = Counter()
+_cancelled = 0
+_lock = threading.Lock()
+
+
+def budget_for(endpoint, method):
+    if endpoint in budgets:
+        return budgets[endpoint]
+    return budgets.get(group_for(endpoint, method), 0)
+
+
+def start_deadline():
+    """before_request hook: fixes the request's deadline from its route budget."""
+    budget = budget_for(request.endpoint, request.method)
+    g.deadline = time.perf_counter() + budget if budget > 0 else None
+
+
+def exceeded():
+    return has_request_context() and g.get("deadline_exceeded", False)
+
+
+def _record_exceeded(cancelled=False):
+    global _cancelled
+    if g.get("deadline_exceeded"):
+        return
+    g.deadline_exceeded = True
+    with _lock:
+        _exceeded[request.endpoint] += 1
+        if cancelled:
+            _cancelled += 1
+
+
+'''
+Statement timeouts
+    every transaction a request opens gets SET LOCAL statement_timeout to
+    what is left of the request's budget, so Postgres itself cancels a
+    query that would overrun it, and the timeout ends with the transaction.
+    a transaction begun after the budget is spent fails before it reaches
+    the database.
+'''
+@event.listens_for(Session, "after_begin")
+def _apply_deadline(session, transaction, connection):
+    if not has_request_context() or g.get("deadline") is None:
+        return
+    remaining = g.deadline - time.perf_counter()
+    if remaining <= 0:
+        _record_exceeded()
+        raise DeadlineExceeded()
+    connection.execute(
+        text("SELECT set_config('statement_timeout', :timeout, true)"),
+        {"timeout": str(max(int(remaining * 1000), 1))},
+    )
+
+
+@event.listens_for(Engine, "handle_error")
+def _detect_cancelled(context):
+    # handlers that catch the error and abort(422) still answer 504: the
+    # error handlers check exceeded()
+    if getattr(context.original_exception, "pgcode", None) == QUERY_CANCELED and has_request_context():
+        _record_exceeded(cancelled=True)
+
+
+def stats():
+    with _lock:
+        return {
+            "budgets": dict(budgets),
+            "exceeded": sum(_exceeded.values()),
+            "exceeded_by_endpoint": dict(_exceeded),
+            "cancelled_statements": _cancelled,
+        }
@@ -0,0 +1,367 @@
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import defaultdict, deque, namedtuple
+from functools import lru_cache
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import User
+
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", 0.85))
+DUPLICATE_INDEX_TTL = int(os.getenv("DUPLICATE_INDEX_TTL", 600))
+# blocks larger than this (a common surname and initial) are not compared
+# pairwise; their members still meet through their other keys
+DUPLICATE_MAX_BLOCK = int(os.getenv("DUPLICATE_MAX_BLOCK", 200))
+DUPLICATE_FLAGGED_SIZE = int(os.getenv("DUPLICATE_FLAGGED_SIZE", 100))
+
+logger = logging.getLogger(__name__)
+
+SOUNDEX_CODES = {
+    letter: digit
+    for digit, letters in (("1", "bfpv"), ("2", "cgjkqsxz"), ("3", "dt"), ("4", "l"), ("5", "mn"), ("6", "r"))
+    for letter in letters
+}
+
+
+def normalize_name(name):
+    """lowercase ASCII letters only: "Adébáyọ̀ O'Neil" -> "adebayooneil"."""
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    return "".join(ch for ch in decomposed.lower() if "a" <= ch <= "z")
+
+
+def email_local(email):
+    """the mailbox part of an address without dots and +tags: "Ada.Obi+x@mail.com" -> "adaobi"."""
+    local = (email or "").lower().split("@", 1)[0].split("+", 1)[0]
+    return local.replace(".", "").strip()
+
+
+def soundex(name):
+    if not name:
+        return ""
+    code = name[0]
+    previous = SOUNDEX_CODES.get(name[0], "")
+    for ch in name[1:]:
+        digit = SOUNDEX_CODES.get(ch, "")
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        if ch not in "hw":
+            previous = digit
+    return code.ljust(4, "0")
+
+
+def jaro(a, b):
+    if a == b:
+        return 1.0 if a else 0.0
+    if not a or not b:
+        return 0.0
+    window = max(max(len(a), len(b)) // 2 - 1, 0)
+    taken = bytearray(len(b))
+    a_matches = []
+    for i, ch in enumerate(a):
+        # str.find does the scan of the match window in C
+        end = i + window + 1
+        j = b.find(ch, max(i - window, 0), end)
+        while j != -1 and taken[j]:
+            j = b.find(ch, j + 1, end)
+        if j != -1:
+            taken[j] = 1
+            a_matches.append(ch)
+    matches = len(a_matches)
+    if not matches:
+        return 0.0
+    b_matches = [ch for ch, hit in zip(b, taken) if hit]
+    transpositions = sum(x != y for x, y in zip(a_matches, b_matches)) / 2
+    return (matches / len(a) + matches / len(b) + (matches - transpositions) / matches) / 3
+
+
+def jaro_winkler(a, b, prefix_scale=0.1):
+    score = jaro(a, b)
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return score + prefix * prefix_scale * (1 - score)
+
+
+# names repeat a lot (every Ada meets every other Ada), so name pairs are
+# memoised; mailboxes are nearly unique and are not
+name_similarity = lru_cache(maxsize=65536)(jaro_winkler)
+
+
+Record = namedtuple("Record", "user_id first_name last_name email phone_number first last local")
+
+
+def make_record(user_id, first_name, last_name, email, phone_number):
+    return Record(
+        user_id, first_name, last_name, email, phone_number,
+        normalize_name(first_name), normalize_name(last_name), email_local(email),
+    )
+
+
+def blocking_keys(record):
+    """
+    the blocks a record goes into: its surname's sound with the first
+    initial, the sounds of both names in either order (so "Ada Obi" meets
+    "Obi Ada"), its mailbox and its phone number.
+    """
+    keys = set()
+    if record.first and record.last:
+        keys.add("n:{}{}".format(soundex(record.last), record.first[0]))
+        keys.add("s:{}:{}".format(*sorted((soundex(record.first), soundex(record.last)))))
+    if record.local:
+        keys.add("e:" + record.local)
+    if record.phone_number:
+        keys.add("p:{}".format(record.phone_number))
+    return keys
+
+
+'''
+score(a, b)
+    how likely two records are the same person, from 0 to 1: Jaro-Winkler
+    similarity of the names (in either order, a swap costs a little) and of
+    the email mailboxes, plus a bonus for the same phone number. returns
+    the score and the reasons behind it.
+'''
+def score(a, b, threshold=0.0):
+    straight = (name_similarity(a.first, b.first) + name_similarity(a.last, b.last)) / 2
+    swapped = (name_similarity(a.first, b.last) + name_similarity(a.last, b.first)) / 2 - 0.02
+    name = max(straight, swapped)
+    same_phone = bool(a.phone_number) and a.phone_number == b.phone_number
+    if 0.6 * name + 0.4 + (0.1 if same_phone else 0) < threshold:
+        # cannot reach the threshold even with identical emails
+        return 0.0, []
+    email = jaro_winkler(a.local, b.local)
+
+    total = 0.6 * name + 0.4 * email
+    reasons = []
+    if a.local and a.local == b.local:
+        reasons.append("same email mailbox")
+    elif email >= 0.9:
+        reasons.append("similar email")
+    if name >= 0.9:
+        reasons.append("swapped names" if swapped > straight else "similar names")
+    if same_phone:
+        total += 0.1
+        reasons.append("same phone number")
+    return min(total, 1.0), reasons
+
+
+def _summary(record):
+    return {"id": record.user_id, "first_name": record.first_name, "last_name": record.last_name, "email": record.email}
+
+
+def suggestion(a, b, value, reasons):
+    # keep the older account, merge the newer (or not yet saved) one into it
+    if a.user_id is None or (b.user_id is not None and b.user_id < a.user_id):
+        keep, merge = b, a
+    else:
+        keep, merge = a, b
+    return {
+        "keep": keep.user_id,
+        "merge": merge.user_id,
+        "score": round(value, 4),
+        "reasons": reasons,
+        "users": [_summary(keep), _summary(merge)],
+    }
+
+
+'''
+DuplicateIndex
+    every user's record and the blocks it belongs to. a lookup or a scan
+    only scores pairs that share a block, instead of every pair of users.
+'''
+class DuplicateIndex:
+    def __init__(self):
+        self.records = {}
+        self.blocks = defaultdict(set)
+        self.built_at = time.monotonic()
+        self.compared = 0
+
+    @classmethod
+    def build(cls, rows):
+        index = cls()
+        for row in rows:
+            index.upsert(make_record(*row))
+        return index
+
+    def upsert(self, record):
+        self.remove(record.user_id)
+        self.records[record.user_id] = record
+        for key in blocking_keys(record):
+            self.blocks[key].add(record.user_id)
+
+    def remove(self, user_id):
+        record = self.records.pop(user_id, None)
+        if record is None:
+            return
+        for key in blocking_keys(record):
+            block = self.blocks.get(key)
+            if block is not None:
+                block.discard(user_id)
+                if not block:
+                    del self.blocks[key]
+
+    def candidates(self, record):
+        ids = set()
+        for key in blocking_keys(record):
+            block = self.blocks.get(key, ())
+            if len(block) <= DUPLICATE_MAX_BLOCK:
+                ids.update(block)
+        ids.discard(record.user_id)
+        return ids
+
+    def matches(self, record, threshold=DUPLICATE_THRESHOLD):
+        """suggestions pairing record with every indexed user it likely duplicates, best first."""
+        found = []
+        for user_id in self.candidates(record):
+            other = self.records[user_id]
+            self.compared += 1
+            value, reasons = score(record, other, threshold)
+            if value >= threshold:
+                found.append(suggestion(record, other, value, reasons))
+        return sorted(found, key=lambda item: -item["score"])
+
+    def scan(self, threshold=DUPLICATE_THRESHOLD):
+        """every likely duplicate pair, best first; each pair is scored once however many blocks it shares."""
+        seen = set()
+        found = []
+        for block in self.blocks.values():
+            if len(block) < 2 or len(block) > DUPLICATE_MAX_BLOCK:
+                continue
+            members = sorted(block)
+            for i, a in enumerate(members):
+                for b in members[i + 1:]:
+                    if (a, b) in seen:
+                        continue
+                    seen.add((a, b))
+                    self.compared += 1
+                    value, reasons = score(self.records[a], self.records[b], threshold)
+                    if value >= threshold:
+                        found.append(suggestion(self.records[a], self.records[b], value, reasons))
+        return sorted(found, key=lambda item: (-item["score"], item["keep"], item["merge"]))
+
+    def oversized_blocks(self):
+        return sum(1 for block in self.blocks.values() if len(block) > DUPLICATE_MAX_BLOCK)
+
+
+'''
+The process-wide index
+    built on first use and rebuilt after DUPLICATE_INDEX_TTL. committed
+    User changes are applied to it directly from the flushed attributes;
+    rows whose attributes were not loaded are re-read on the next use.
+    every newly inserted user is checked against the index as it is
+    committed, and its matches are kept in a short list of recent flags.
+'''
+_index = None
+_pending = set()
+_flagged = deque(maxlen=DUPLICATE_FLAGGED_SIZE)
+_lock = threading.Lock()
+_builds = 0
+
+COLUMNS = (User.id, User.first_name, User.last_name, User.email, User.phone_number)
+
+
+def current_index():
+    global _index, _builds
+    with _lock:
+        if _index is None or time.monotonic() - _index.built_at > DUPLICATE_INDEX_TTL:
+            _pending.clear()
+            _index = DuplicateIndex.build(User.query.with_entities(*COLUMNS).order_by(User.id).yield_per(5000))
+            _builds += 1
+        elif _pending:
+            ids = list(_pending)
+            _pending.clear()
+            found = set()
+            for row in User.query.with_entities(*COLUMNS).filter(User.id.in_(ids)):
+                _index.upsert(make_record(*row))
+                found.add(row[0])
+            for user_id in set(ids) - found:
+                _index.remove(user_id)
+        return _index
+
+
+def check(first_name, last_name, email, phone_number=None, exclude_id=None, threshold=DUPLICATE_THRESHOLD):
+    """Existing users a new (or edited) user would likely duplicate."""
+    index = current_index()
+    with _lock:
+        return index.matches(make_record(exclude_id, first_name, last_name, email, phone_number), threshold)
+
+
+def scan(threshold=DUPLICATE_THRESHOLD):
+    index = current_index()
+    with _lock:
+        return index.scan(threshold)
+
+
+def flagged():
+    with _lock:
+        return list(_flagged)
+
+
+def stats():
+    with _lock:
+        index = _index
+        return {
+            "users": len(index.records) if index is not None else 0,
+            "blocks": len(index.blocks) if index is not None else 0,
+            "oversized_blocks": index.oversized_blocks() if index is not None else 0,
+            "compared_pairs": index.compared if index is not None else 0,
+            "pending": len(_pending),
+            "flagged": len(_flagged),
+            "builds": _builds,
+        }
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_user_changes(session, flush_context):
+    changed = session.info.setdefault("duplicate_users", {})
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(instance, User) or instance.id is None:
+            continue
+        if instance in session.deleted:
+            changed[instance.id] = None
+            continue
+        loaded = inspect(instance).dict
+        if all(name in loaded for name in ("first_name", "last_name", "email", "phone_number")):
+            record = make_record(instance.id, loaded["first_name"], loaded["last_name"], loaded["email"], loaded["phone_number"])
+        else:
+            record = instance.id
+        # keep "new" across several flushes of one transaction
+        is_new = instance in session.new or (changed.get(instance.id) or (None, False))[1]
+        changed[instance.id] = (record, is_new)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_user_changes(session):
+    changed = session.info.pop("duplicate_users", None)
+    if not changed:
+        return
+    with _lock:
+        if _index is None:
+            return
+        for user_id, change in changed.items():
+            if change is None:
+                _index.remove(user_id)
+                _pending.discard(user_id)
+                continue
+            record, is_new = change
+            if not isinstance(record, Record):
+                _pending.add(user_id)
+                continue
+            if is_new:
+                for match in _index.matches(record):
+                    _flagged.append(match)
+                    logger.info("possible duplicate user %s of %s", match["merge"], match["keep"], extra={"fields": match})
+            _index.upsert(record)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_user_changes(session):
+    session.info.pop("duplicate_users", None)
@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import database_path, CHANGE_CHANNEL, TRACKED_TABLES
+
+EVENTS_BACKEND = os.getenv("EVENTS_BACKEND", "postgres")
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", 256))
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", 15))
+EVENTS_MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", 1000))
+
+logger = logging.getLogger(__name__)
+
+'''
+Subscriber
+    one open /events stream. events are queued without blocking the
+    broadcaster; when a slow client lets its queue fill up, further events
+    are dropped and the subscriber is marked lagged. the stream then tells
+    the client to resync from /changes?since= instead of falling further
+    behind.
+'''
+class Subscriber:
+    def __init__(self, entities=None, operations=None, maxsize=EVENTS_QUEUE_SIZE):
+        self.entities = set(entities) if entities else None
+        self.operations = set(operations) if operations else None
+        self.queue = queue.Queue(maxsize)
+        self.lagged = False
+        self.dropped = 0
+
+    def wants(self, change):
+        if self.entities is not None and change["entity"] not in self.entities:
+            return False
+        if self.operations is not None and change["operation"] not in self.operations:
+            return False
+        return True
+
+    def offer(self, change):
+        try:
+            self.queue.put_nowait(change)
+        except queue.Full:
+            self.lagged = True
+            self.dropped += 1
+
+    def drain(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+
+'''
+Broadcaster
+    the single in-process fan-out point. however many dashboards are
+    connected to a worker, the change stream is read once (one LISTEN
+    connection, or the local commit hook) and copied to each subscriber.
+    max_streams counts connections: the streaming process's gevent workers
+    park an idle stream for the price of a greenlet (see server.py).
+'''
+class Broadcaster:
+    def __init__(self, backend=EVENTS_BACKEND, max_streams=EVENTS_MAX_SUBSCRIBERS):
+        self.backend = backend
+        self.max_streams = max_streams
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._listener_pid = None
+        self.published = 0
+
+    def subscribe(self, entities=None, operations=None):
+        self.ensure_listener()
+        with self._lock:
+            if len(self._subscribers) >= self.max_streams:
+                return None
+            subscriber = Subscriber(entities, operations)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, change):
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self.published += 1
+        for subscriber in subscribers:
+            if subscriber.wants(change):
+                subscriber.offer(change)
+
+    def stats(self):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        return {
+            "backend": self.backend,
+            "subscribers": len(subscribers),
+            "max_streams": self.max_streams,
+            "published": self.published,
+            "lagged": sum(1 for subscriber in subscribers if subscriber.lagged),
+            "queued": sum(subscriber.queue.qsize() for subscriber in subscribers),
+        }
+
+    def ensure_listener(self):
+        # the LISTEN thread does not survive fork; start one per worker
+        if self.backend != "postgres" or self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            threading.Thread(target=self._listen_forever, name="change-listener", daemon=True).start()
+            self._listener_pid = os.getpid()
+
+    def _listen_forever(self):
+        backoff = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(database_path)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute("LISTEN {}".format(CHANGE_CHANNEL))
+                backoff = 1
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.publish(json.loads(conn.notifies.pop(0).payload))
+            except Exception:
+                # whatever went wrong (not only a psycopg2 error), this is the
+                # worker's only listener: reconnect, never exit
+                logger.exception("change listener failed; reconnecting in %ss", backoff)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+
+broadcaster = Broadcaster()
+
+
+def format_event(change):
+    lines = []
+    if change.get("version") is not None:
+        lines.append("id: {}".format(change["version"]))
+    lines.append("event: {}".format(change["entity"]))
+    lines.append("data: {}".format(json.dumps(change, default=str)))
+    return "\n".join(lines) + "\n\n"
+
+
+'''
+stream(subscriber, backlog)
+    the body of an /events response: first any changes the client missed
+    while disconnected, then live events, with a comment line as heartbeat
+    whenever nothing happened for EVENTS_HEARTBEAT seconds.
+'''
+def stream(subscriber, backlog=(), resync=False):
+    try:
+        yield "retry: 3000\n\n"
+        for change in backlog:
+            yield format_event(change)
+        if resync:
+            yield "event: resync\ndata: {}\n\n"
+
+        while True:
+            if subscriber.lagged:
+                subscriber.drain()
+                subscriber.lagged = False
+                yield "event: resync\ndata: {}\n\n"
+            try:
+                change = subscriber.queue.get(timeout=EVENTS_HEARTBEAT)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+            yield format_event(change)
+    finally:
+        broadcaster.unsubscribe(subscriber)
+
+
+'''
+The local stand-in
+    with EVENTS_BACKEND=local there is no LISTEN connection; this worker's
+    own commits are published straight from the session hooks. that is
+    enough for development and tests, where one process serves everything.
+'''
+@event.listens_for(Session, "after_flush")
+def _collect_local_events(session, flush_context):
+    if broadcaster.backend != "local":
+        return
+    pending = session.info.setdefault("pending_events", [])
+    for operation, instances in (("insert", session.new), ("update", session.dirty), ("delete", session.deleted)):
+        for instance in instances:
+            if getattr(instance, "__tablename__", None) not in TRACKED_TABLES:
+                continue
+            if operation == "update" and not session.is_modified(instance, include_collections=False):
+                continue
+            pending.append({"version": None, "entity": instance.__tablename__, "id": instance.id, "operation": operation})
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_local_events(session):
+    for change in session.info.pop("pending_events", ()):
+        broadcaster.publish(change)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_local_events(session):
+    session.info.pop("pending_events", None)
@@ -0,0 +1,264 @@
+import os
+import sys
+import threading
+import time
+from array import array
+
+import numpy as np
+from sqlalchemy import event, func, or_
+from sqlalchemy.orm import Session
+
+from models import db, Student
+
+FACET_INDEX = os.getenv("FACET_INDEX", "1") == "1"
+FACET_INDEX_TTL = int(os.getenv("FACET_INDEX_TTL", 300))
+
+FACET_COLUMNS = ("gender", "student_program", "accommodation", "marital_status", "disability", "course_id")
+
+
+def popcount(bitmap):
+    return bitmap.bit_count() if hasattr(bitmap, "bit_count") else bin(bitmap).count("1")
+
+
+'''
+FacetIndex
+    a columnar snapshot of the Student facet columns. every row gets a
+    slot; each column stores one small integer code per slot and, for every
+    distinct value, a bitmap (a Python int, bit n = slot n) of the rows
+    holding it. a combined filter is an OR of the chosen values' bitmaps
+    per column ANDed across columns, and a facet count is the popcount of
+    that mask ANDed with a value's bitmap; no row is ever visited.
+    deleted rows leave a cleared slot behind until the next rebuild.
+'''
+class FacetIndex:
+    def __init__(self, columns=FACET_COLUMNS):
+        self.columns = columns
+        self.ids = array("q")
+        self.slots = {}
+        self.codes = {column: array("i") for column in columns}
+        self.values = {column: [] for column in columns}
+        self.value_codes = {column: {} for column in columns}
+        self.bitmaps = {column: [] for column in columns}
+        self.alive = 0
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def build(cls, rows, columns=FACET_COLUMNS):
+        index = cls(columns)
+        for row in rows:
+            index.upsert(row[0], row[1:])
+        return index
+
+    def _code(self, column, value):
+        code = self.value_codes[column].get(value)
+        if code is None:
+            code = len(self.values[column])
+            self.value_codes[column][value] = code
+            self.values[column].append(value)
+            self.bitmaps[column].append(0)
+        return code
+
+    def upsert(self, student_id, values):
+        slot = self.slots.get(student_id)
+        if slot is None:
+            slot = len(self.ids)
+            self.ids.append(student_id)
+            self.slots[student_id] = slot
+            bit = 1 << slot
+            for column, value in zip(self.columns, values):
+                code = self._code(column, value)
+                self.codes[column].append(code)
+                self.bitmaps[column][code] |= bit
+        else:
+            bit = 1 << slot
+            for column, value in zip(self.columns, values):
+                old, new = self.codes[column][slot], self._code(column, value)
+                if old != new:
+                    self.bitmaps[column][old] &= ~bit
+                    self.bitmaps[column][new] |= bit
+                    self.codes[column][slot] = new
+        self.alive |= 1 << slot
+
+    def remove(self, student_id):
+        slot = self.slots.pop(student_id, None)
+        if slot is None:
+            return
+        bit = 1 << slot
+        for column in self.columns:
+            self.bitmaps[column][self.codes[column][slot]] &= ~bit
+        self.alive &= ~bit
+
+    def match(self, filters, skip=None):
+        mask = self.alive
+        for column, wanted in filters.items():
+            if column == skip:
+                continue
+            union = 0
+            for value in wanted:
+                code = self.value_codes[column].get(value)
+                if code is not None:
+                    union |= self.bitmaps[column][code]
+            mask &= union
+        return mask
+
+    def ids_of(self, mask):
+        if not mask:
+            return np.empty(0, dtype=np.int64)
+        bits = np.unpackbits(np.frombuffer(mask.to_bytes((len(self.ids) + 7) // 8, "little"), dtype=np.uint8), bitorder="little")
+        return np.frombuffer(self.ids, dtype=np.int64)[np.flatnonzero(bits[:len(self.ids)])]
+
+    def facet_counts(self, filters):
+        facets = {}
+        for column in self.columns:
+            base = self.match(filters, skip=column)
+            counts = []
+            for value, bitmap in zip(self.values[column], self.bitmaps[column]):
+                count = popcount(base & bitmap)
+                if count:
+                    counts.append({"value": value, "count": count})
+            facets[column] = counts
+        return facets
+
+    def search(self, filters, offset=0, limit=None):
+        mask = self.match(filters)
+        ids = self.ids_of(mask)
+        end = None if limit is None else offset + limit
+        return {
+            "total": popcount(mask),
+            "ids": ids[offset:end].tolist(),
+            "facets": self.facet_counts(filters),
+        }
+
+    @property
+    def tombstones(self):
+        return len(self.ids) - len(self.slots)
+
+    def memory_bytes(self):
+        size = sys.getsizeof(self.ids) + sys.getsizeof(self.slots) + sys.getsizeof(self.alive)
+        for column in self.columns:
+            size += sys.getsizeof(self.codes[column]) + sys.getsizeof(self.value_codes[column])
+            size += sum(sys.getsizeof(bitmap) for bitmap in self.bitmaps[column])
+        return size
+
+
+'''
+The shared index
+    built on first use and rebuilt after FACET_INDEX_TTL (which bounds how
+    long a worker can miss another process's commits) or once deleted
+    slots outnumber live rows. commits in this process only note the ids
+    of the Student rows they touched; the next search refetches just those
+    rows in one query and patches the bitmaps.
+'''
+_index = None
+_pending = set()
+_lock = threading.Lock()
+_builds = 0
+_refreshes = 0
+
+
+def _rows(query):
+    return query.with_entities(Student.id, *(getattr(Student, column) for column in FACET_COLUMNS))
+
+
+def current_index():
+    global _index, _builds, _refreshes
+    with _lock:
+        if (
+            _index is None
+            or time.monotonic() - _index.built_at > FACET_INDEX_TTL
+            or _index.tombstones > max(len(_index.slots), 1024)
+        ):
+            _pending.clear()
+            _index = FacetIndex.build(_rows(Student.query.order_by(Student.id)).yield_per(5000))
+            _builds += 1
+        elif _pending:
+            ids = list(_pending)
+            _pending.clear()
+            found = set()
+            for row in _rows(Student.query.filter(Student.id.in_(ids))):
+                _index.upsert(row[0], row[1:])
+                found.add(row[0])
+            for student_id in set(ids) - found:
+                _index.remove(student_id)
+            _refreshes += 1
+        return _index
+
+
+def _database_search(filters, offset, limit):
+    def filtered(skip=None):
+        query = Student.query
+        for column, wanted in filters.items():
+            if column == skip:
+                continue
+            attribute = getattr(Student, column)
+            values = [value for value in wanted if value is not None]
+            condition = attribute.in_(values)
+            if None in wanted:
+                condition = or_(condition, attribute.is_(None))
+            query = query.filter(condition)
+        return query
+
+    ids = [row[0] for row in filtered().with_entities(Student.id).order_by(Student.id).offset(offset).limit(limit)]
+    facets = {}
+    for column in FACET_COLUMNS:
+        attribute = getattr(Student, column)
+        counts = filtered(skip=column).with_entities(attribute, func.count(Student.id)).group_by(attribute).order_by(attribute)
+        facets[column] = [{"value": value, "count": count} for value, count in counts]
+    return {"total": filtered().count(), "ids": ids, "facets": facets}
+
+
+'''
+search(filters, offset, limit)
+    filters maps facet columns to lists of accepted values (None matches
+    NULL). returns the total, one page of matching ids in id order and, per
+    facet, the count of each value under all the other filters.
+'''
+def search(filters, offset=0, limit=None):
+    if not FACET_INDEX:
+        return _database_search(filters, offset, limit)
+    index = current_index()
+    with _lock:
+        return index.search(filters, offset, limit)
+
+
+def invalidate(*student_ids):
+    """Marks rows changed outside the session (bulk statements) for the next refresh."""
+    with _lock:
+        if _index is not None:
+            _pending.update(student_ids)
+
+
+def stats():
+    with _lock:
+        index = _index
+        return {
+            "enabled": FACET_INDEX,
+            "rows": len(index.slots) if index is not None else 0,
+            "tombstones": index.tombstones if index is not None else 0,
+            "values": {column: len(index.values[column]) for column in FACET_COLUMNS} if index is not None else {},
+            "bytes": index.memory_bytes() if index is not None else 0,
+            "pending": len(_pending),
+            "builds": _builds,
+            "refreshes": _refreshes,
+        }
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_facet_changes(session, flush_context):
+    changed = session.info.setdefault("facet_students", set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Student):
+            changed.add(instance.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _queue_facet_changes(session):
+    changed = session.info.pop("facet_students", None)
+    if changed and _index is not None:
+        with _lock:
+            _pending.update(changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_facet_changes(session):
+    session.info.pop("facet_students", None)
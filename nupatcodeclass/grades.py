@@ -0,0 +1,321 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from decimal import Decimal
+
+import numpy as np
+from sqlalchemy import Float, Integer, bindparam, cast, event, func, inspect, literal, select, text
+from sqlalchemy.orm import Session
+
+from models import db, record_changes, Instructor, Student
+from nupatcodeclass import results, schemas
+
+GRADE_CACHE_SIZE = int(os.getenv("GRADE_CACHE_SIZE", 256))
+GRADE_CACHE_TTL = int(os.getenv("GRADE_CACHE_TTL", 60))
+BULK_GRADE_LIMIT = int(os.getenv("BULK_GRADE_LIMIT", 1000))
+GRADE_MAX = float(os.getenv("GRADE_MAX", 100))
+
+# advisory lock keyspace for bulk grading, second key is the course id
+GRADING_LOCK = 0x67726164
+
+PERCENTILES = (10, 25, 50, 75, 90)
+HISTOGRAM_BINS = np.arange(0, 101, 10)
+
+'''
+load_grades(course_id, cohort)
+    fetches every grade of a course (optionally only students of one
+    student_program) as two float arrays: week number and grade.
+    Postgres pulls the leading number out of the free-text weekly_project
+    ("Week 3") and project_grade ("85", "85%", "85/100") columns, so rows
+    arrive already numeric; anything unparseable comes back as NaN.
+'''
+def load_grades(course_id, cohort=None):
+    week = func.coalesce(cast(func.substring(Instructor.weekly_project, r"([0-9]+)"), Integer), literal(-1))
+    grade = func.coalesce(
+        cast(func.substring(Instructor.project_grade, r"^\s*([0-9]+(?:\.[0-9]+)?)"), Float),
+        cast(literal("NaN"), Float),
+    )
+
+    query = db.session.query(week, grade).filter(Instructor.course_id == course_id)
+    if cohort:
+        query = query.join(Student, Student.id == Instructor.student_id).filter(Student.student_program == cohort)
+
+    rows = np.array(query.all(), dtype=float).reshape(-1, 2)
+    return rows[:, 0], rows[:, 1]
+
+
+def _round(values):
+    return [round(float(v), 2) for v in values]
+
+
+'''
+summarize(weeks, grades)
+    distribution statistics over the graded rows, overall and per week,
+    computed with whole-array NumPy operations.
+'''
+def summarize(weeks, grades):
+    graded = ~np.isnan(grades)
+    weeks = weeks[graded]
+    grades = grades[graded]
+
+    result = {
+        "count": int(grades.size),
+        "ungraded": int((~graded).sum()),
+    }
+    if grades.size == 0:
+        result.update(mean=None, median=None, std=None, percentiles={}, histogram={}, weeks=[])
+        return result
+
+    counts, edges = np.histogram(np.clip(grades, 0, 100), bins=HISTOGRAM_BINS)
+    result.update(
+        mean=round(float(grades.mean()), 2),
+        median=round(float(np.median(grades)), 2),
+        std=round(float(grades.std()), 2),
+        min=round(float(grades.min()), 2),
+        max=round(float(grades.max()), 2),
+        percentiles=dict(zip((str(p) for p in PERCENTILES), _round(np.percentile(grades, PERCENTILES)))),
+        histogram={"edges": _round(edges), "counts": counts.tolist()},
+    )
+
+    # per-week groups: sort by (week, grade) once, then read every group's
+    # mean and median off the sorted array by offsets
+    order = np.lexsort((grades, weeks))
+    weeks = weeks[order]
+    grades = grades[order]
+    week_numbers, starts, week_counts = np.unique(weeks, return_index=True, return_counts=True)
+    means = np.add.reduceat(grades, starts) / week_counts
+    medians = (grades[starts + (week_counts - 1) // 2] + grades[starts + week_counts // 2]) / 2
+    # week-over-week change of the mean, skipping rows with no week number
+    known = np.flatnonzero(week_numbers >= 0)
+    changes = np.full(means.shape, np.nan)
+    changes[known[1:]] = np.diff(means[known])
+
+    result["weeks"] = [
+        {
+            "week": int(week) if week >= 0 else None,
+            "count": int(count),
+            "mean": round(float(mean), 2),
+            "median": round(float(median), 2),
+            "change": None if np.isnan(change) else round(float(change), 2),
+        }
+        for week, count, mean, median, change in zip(week_numbers, week_counts, means, medians, changes)
+    ]
+    return result
+
+
+'''
+The analytics cache
+    results are cached per (course, cohort) and tagged with the course's
+    grade version. committing any Instructor row bumps the version of its
+    course, so the next request recomputes. the TTL bounds how long another
+    worker process can serve a result computed before a change it did not
+    see.
+'''
+_cache = OrderedDict()
+_versions = defaultdict(int)
+_lock = threading.Lock()
+
+
+def invalidate_course(*course_ids):
+    with _lock:
+        for course_id in course_ids:
+            _versions[course_id] += 1
+
+
+def course_analytics(course_id, cohort=None):
+    key = (course_id, cohort or None)
+    now = time.monotonic()
+
+    with _lock:
+        version = _versions[course_id]
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == version and now - cached[1] < GRADE_CACHE_TTL:
+            _cache.move_to_end(key)
+            return cached[2]
+
+    weeks, grades = load_grades(course_id, cohort)
+    result = summarize(weeks, grades)
+    result.update(course_id=course_id, cohort=cohort or None)
+
+    with _lock:
+        if _versions[course_id] == version:
+            _cache[key] = (version, now, result)
+            _cache.move_to_end(key)
+            while len(_cache) > GRADE_CACHE_SIZE:
+                _cache.popitem(last=False)
+    return result
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_grade_changes(session, flush_context):
+    changed = session.info.setdefault("grade_courses", set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Instructor):
+            changed.add(instance.course_id)
+            changed.update(inspect(instance).attrs.course_id.history.deleted or ())
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_grade_changes(session):
+    changed = session.info.pop("grade_courses", None)
+    if changed:
+        invalidate_course(*changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_grade_changes(session):
+    session.info.pop("grade_courses", None)
+
+
+'''
+Bulk grading
+    a week of grades for a course in one transaction: rows that already
+    exist for (course, student, week), whichever way their week was
+    written ("3", "week 3"), get their project_grade updated, every
+    duplicate legacy row included; the rest are inserted with one
+    multi-row INSERT. concurrent submissions for
+    the same course are serialized with an advisory lock, so two of them
+    never both insert the same student's row.
+'''
+class GradingError(Exception):
+    def __init__(self, message, status_code=400, errors=None):
+        self.message = message
+        self.status_code = status_code
+        self.errors = errors or []
+
+
+# "3", "week 3" and "Week 03" all name the third week
+WEEK_PATTERN = re.compile(r"^\s*(?:week\s*)?0*([0-9]+)\s*$", re.IGNORECASE)
+
+
+def normalize_week(week):
+    if isinstance(week, bool) or week is None:
+        return None
+    if isinstance(week, int):
+        return "Week {}".format(week) if week >= 0 else None
+    match = WEEK_PATTERN.match(str(week))
+    if match:
+        return "Week {}".format(int(match.group(1)))
+    return str(week).strip() or None
+
+
+def same_week(column, week):
+    """Matches the rows of this week however their weekly_project is spelled."""
+    match = WEEK_PATTERN.match(week)
+    if match is None:
+        return column == week
+    return column.op("~*")(r"^\s*(week\s*)?0*{}\s*$".format(int(match.group(1))))
+
+
+def format_grade(grade):
+    # fixed-point: "{:g}" writes 0.00001 as "1e-05", which analytics reads as 1
+    return format(Decimal(str(grade)).normalize(), "f")
+
+
+GRADE_ENTRY = schemas.Schema([
+    schemas.Field("student_id", schemas.decode_integer, True),
+    schemas.Field("grade", schemas.decode_number(0, GRADE_MAX), True),
+])
+
+
+def validate_grades(course_id, entries):
+    """Returns {student_id: grade text} or raises GradingError listing every bad entry."""
+    if not isinstance(entries, list) or not entries:
+        raise GradingError("grades must be a non-empty list")
+    if len(entries) > BULK_GRADE_LIMIT:
+        raise GradingError("at most {} grades per request".format(BULK_GRADE_LIMIT), 413)
+
+    rows, errors = GRADE_ENTRY.validate_many(entries)
+    grades = {}
+    indexes = {}
+    for index, row in enumerate(rows):
+        if row is None:
+            continue
+        student_id = row["student_id"]
+        if student_id in grades:
+            errors.append({"index": index, "field": "student_id", "student_id": student_id, "message": "duplicate student"})
+        else:
+            grades[student_id] = format_grade(row["grade"])
+            indexes[student_id] = index
+
+    if grades:
+        enrolled = {
+            row[0] for row in db.session.query(Student.id).filter(Student.course_id == course_id, Student.id.in_(list(grades)))
+        }
+        for student_id in grades.keys() - enrolled:
+            errors.append({"index": indexes[student_id], "field": "student_id", "student_id": student_id, "message": "student is not enrolled in this course"})
+
+    if errors:
+        raise GradingError("invalid grades", 400, sorted(errors, key=lambda error: error["index"]))
+    return grades
+
+
+def upsert_grades(course, week, user_id, grades):
+    table = Instructor.__table__
+    connection = db.session.connection()
+    connection.execute(text("SELECT pg_advisory_xact_lock(:space, :course)"), {"space": GRADING_LOCK, "course": course.id})
+
+    # legacy data can hold several rows for one (course, student, week);
+    # every one of them gets the new grade, or the stale ones keep counting
+    existing = defaultdict(list)
+    for row in connection.execute(
+        select(table.c.id, table.c.student_id, table.c.project_grade).where(
+            table.c.course_id == course.id,
+            same_week(table.c.weekly_project, week),
+            table.c.student_id.in_(list(grades)),
+        )
+    ):
+        existing[row.student_id].append(row)
+
+    changed = [
+        {"row_id": row.id, "grade": grade}
+        for student_id, grade in grades.items()
+        for row in existing.get(student_id, ())
+        if row.project_grade != grade
+    ]
+    updated = {
+        student_id for student_id, grade in grades.items()
+        if any(row.project_grade != grade for row in existing.get(student_id, ()))
+    }
+    if changed:
+        connection.execute(
+            table.update().where(table.c.id == bindparam("row_id")).values(project_grade=bindparam("grade")),
+            changed,
+        )
+
+    missing = [
+        {
+            "user_id": user_id,
+            "student_id": student_id,
+            "course_id": course.id,
+            "instructor_course": course.course_title,
+            "weekly_project": week,
+            "project_grade": grade,
+        }
+        for student_id, grade in grades.items()
+        if student_id not in existing
+    ]
+    inserted = []
+    if missing:
+        inserted = [row[0] for row in connection.execute(table.insert().values(missing).returning(table.c.id))]
+
+    # Core statements bypass the session hooks; log and invalidate by hand
+    record_changes(db.session, [
+        {"entity": table.name, "entity_id": row_id, "operation": "insert"} for row_id in inserted
+    ] + [
+        {"entity": table.name, "entity_id": row["row_id"], "operation": "update"} for row in changed
+    ])
+    db.session.commit()
+    invalidate_course(course.id)
+    results.cache.invalidate(table.name)
+
+    return {
+        "course_id": course.id,
+        "week": week,
+        "submitted": len(grades),
+        "inserted": len(inserted),
+        "updated": len(updated),
+        "unchanged": len(grades) - len(inserted) - len(updated),
+    }
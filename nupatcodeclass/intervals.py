@@ -0,0 +1,133 @@
+import random
+
+'''
+IntervalTree
+    a dynamic interval tree: a treap ordered by (start, end, value) where
+    every node also carries the largest end in its subtree. insert and remove
+    take O(log n) expected time; an overlap query visits O(log n) nodes plus
+    one per match, because whole subtrees whose max_end falls before the
+    query are skipped.
+
+    intervals are closed, [start, end]. start/end may be anything ordered
+    (dates, datetimes, numbers) and value must be orderable too, e.g. a row id.
+'''
+class _Node:
+    __slots__ = ("start", "end", "value", "priority", "max_end", "left", "right")
+
+    def __init__(self, start, end, value):
+        self.start = start
+        self.end = end
+        self.value = value
+        self.priority = random.random()
+        self.max_end = end
+        self.left = None
+        self.right = None
+
+    def key(self):
+        return (self.start, self.end, self.value)
+
+    def update(self):
+        max_end = self.end
+        if self.left is not None and self.left.max_end > max_end:
+            max_end = self.left.max_end
+        if self.right is not None and self.right.max_end > max_end:
+            max_end = self.right.max_end
+        self.max_end = max_end
+
+
+def _split(node, key):
+    """Splits into (keys < key, keys >= key)."""
+    if node is None:
+        return None, None
+    if node.key() < key:
+        node.right, right = _split(node.right, key)
+        node.update()
+        return node, right
+    left, node.left = _split(node.left, key)
+    node.update()
+    return left, node
+
+
+def _merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.update()
+        return left
+    right.left = _merge(left, right.left)
+    right.update()
+    return right
+
+
+class IntervalTree:
+    def __init__(self, intervals=()):
+        self._root = None
+        self._size = 0
+        for start, end, value in intervals:
+            self.insert(start, end, value)
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        stack, node = [], self._root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.start, node.end, node.value
+            node = node.right
+
+    def insert(self, start, end, value):
+        if end < start:
+            raise ValueError("interval ends before it starts")
+        node = _Node(start, end, value)
+        left, right = _split(self._root, node.key())
+        self._root = _merge(_merge(left, node), right)
+        self._size += 1
+
+    def remove(self, start, end, value):
+        """Removes one matching interval; returns False if there was none."""
+        key = (start, end, value)
+        parent, node = None, self._root
+        path = []
+        while node is not None and node.key() != key:
+            path.append(node)
+            parent = node
+            node = node.left if key < node.key() else node.right
+        if node is None:
+            return False
+
+        replacement = _merge(node.left, node.right)
+        if parent is None:
+            self._root = replacement
+        elif parent.left is node:
+            parent.left = replacement
+        else:
+            parent.right = replacement
+        for ancestor in reversed(path):
+            ancestor.update()
+        self._size -= 1
+        return True
+
+    def overlapping(self, lo, hi):
+        """Every (start, end, value) with start <= hi and end >= lo."""
+        found = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None or node.max_end < lo:
+                continue
+            stack.append(node.left)
+            if node.start <= hi:
+                if node.end >= lo:
+                    found.append((node.start, node.end, node.value))
+                stack.append(node.right)
+        return found
+
+    def at(self, point):
+        return self.overlapping(point, point)
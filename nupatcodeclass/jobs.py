@@ -0,0 +1,429 @@
+import argparse
+import datetime
+import gzip
+import inspect
+import json
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from sqlalchemy import delete, or_, text, update
+
+from models import db, record_changes, Job, Course, CourseMaterial, Student, Sponsor, Instructor, Admin
+from nupatcodeclass import cohorts, facets, grades, media, results, schedule, schemas
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", os.cpu_count() or 2))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1))
+JOB_RETRY_DELAY = int(os.getenv("JOB_RETRY_DELAY", 30))
+JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", 60 * 60))
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", 1000))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 10))
+JOB_IMPORT_LIMIT = int(os.getenv("JOB_IMPORT_LIMIT", 5000))
+
+EXPORT_DIR = os.path.join(media.MEDIA_ROOT, "exports")
+
+JOBS = {}
+VALIDATORS = {}
+
+
+'''
+@job(kind, validate)
+    registers a function as a job kind. it is called in a worker process,
+    inside an app context, as fn(ctx, **payload) and returns a JSON-able
+    result. long jobs should call ctx.progress() now and then; that is also
+    where a requested cancellation takes effect.
+
+    validate(payload) runs when the job is enqueued and returns the payload
+    to store (only the arguments fn takes) or raises SchemaError, so a bad
+    payload is refused with 400 instead of failing in the worker. a job
+    that takes a user_id gets the enqueuing caller's, never the client's.
+'''
+def job(kind, validate):
+    def register(fn):
+        JOBS[kind] = fn
+        VALIDATORS[kind] = validate
+        return fn
+    return register
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobContext:
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def progress(self, fraction):
+        # on its own connection, so the job's open transaction is not committed
+        with db.engine.begin() as connection:
+            cancel_requested = connection.execute(
+                update(Job.__table__)
+                .where(Job.__table__.c.id == self.job_id)
+                .values(progress=min(max(fraction, 0), 1), updated_at=datetime.datetime.utcnow())
+                .returning(Job.__table__.c.cancel_requested)
+            ).scalar()
+        if cancel_requested:
+            raise JobCancelled()
+
+    def checkpoint(self, state):
+        """Saves state in the job's result, in the job's own transaction, so it commits with the work it describes."""
+        db.session.execute(
+            update(Job.__table__).where(Job.__table__.c.id == self.job_id).values(result=json.dumps(state))
+        )
+
+    def resume(self):
+        """The state of the last committed checkpoint, {} on a first run."""
+        saved = db.session.query(Job.result).filter(Job.id == self.job_id).scalar()
+        return json.loads(saved) if saved else {}
+
+
+def enqueue(kind, payload=None, max_attempts=3, user_id=None):
+    if kind not in JOBS:
+        raise ValueError("unknown job kind: {}".format(kind))
+
+    errors = []
+    try:
+        max_attempts = schemas.decode_integer(max_attempts)
+        if not 1 <= max_attempts <= JOB_MAX_ATTEMPTS:
+            raise schemas.Invalid("must be an integer from 1 to {}".format(JOB_MAX_ATTEMPTS))
+    except schemas.Invalid as e:
+        errors.append({"field": "max_attempts", "message": str(e)})
+    try:
+        payload = VALIDATORS[kind](payload or {})
+    except schemas.SchemaError as e:
+        errors.extend(dict(error, field="payload.{}".format(error["field"]) if error["field"] else "payload") for error in e.errors)
+    else:
+        if "user_id" in inspect.signature(JOBS[kind]).parameters:
+            if user_id is None:
+                errors.append({"field": None, "message": "this job needs a caller linked to a user"})
+            payload["user_id"] = user_id
+    if errors:
+        raise schemas.SchemaError(errors, 400, "bad request")
+
+    new_job = Job(kind=kind, payload=payload, max_attempts=max_attempts)
+    new_job.insert()
+    return new_job
+
+
+def cancel(existing_job):
+    if existing_job.status == "queued":
+        existing_job.status = "cancelled"
+        existing_job.finished_at = datetime.datetime.utcnow()
+    elif existing_job.status == "running":
+        existing_job.cancel_requested = True
+    existing_job.update()
+    return existing_job
+
+
+'''
+claim_next()
+    marks the oldest runnable job as running and returns its id. FOR UPDATE
+    SKIP LOCKED lets any number of runners poll the same table without ever
+    handing one job to two of them.
+'''
+def claim_next():
+    job_id = db.session.execute(
+        text(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = :now"
+            " WHERE id = ("
+            "  SELECT id FROM jobs WHERE status = 'queued' AND run_after <= :now"
+            "  ORDER BY id FOR UPDATE SKIP LOCKED LIMIT 1)"
+            " RETURNING id"
+        ),
+        {"now": datetime.datetime.utcnow()},
+    ).scalar()
+    db.session.commit()
+    return job_id
+
+
+def requeue_stale():
+    """Puts back jobs whose runner died mid-run (no progress for JOB_STALE_AFTER)."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=JOB_STALE_AFTER)
+    db.session.execute(
+        update(Job.__table__)
+        .where(Job.__table__.c.status == "running", Job.__table__.c.updated_at < cutoff)
+        .values(status="queued")
+    )
+    db.session.commit()
+
+
+_worker_app = None
+
+
+def _init_worker():
+    global _worker_app
+    from nupatcodeclass import create_app
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_app = create_app()
+
+
+def run_job(job_id):
+    with _worker_app.app_context():
+        try:
+            current = Job.query.filter(Job.id == job_id).one()
+            fn = JOBS.get(current.kind)
+            try:
+                if fn is None:
+                    raise ValueError("unknown job kind: {}".format(current.kind))
+                result = fn(JobContext(job_id), **json.loads(current.payload or "{}"))
+            except JobCancelled:
+                db.session.rollback()
+                current = Job.query.filter(Job.id == job_id).one()
+                current.status = "cancelled"
+            except Exception as e:
+                db.session.rollback()
+                current = Job.query.filter(Job.id == job_id).one()
+                current.error = "{}: {}".format(type(e).__name__, e)
+                if current.attempts < current.max_attempts and not current.cancel_requested:
+                    current.status = "queued"
+                    current.run_after = datetime.datetime.utcnow() + datetime.timedelta(
+                        seconds=JOB_RETRY_DELAY * 2 ** (current.attempts - 1))
+                else:
+                    current.status = "failed"
+            else:
+                current = Job.query.filter(Job.id == job_id).one()
+                current.status = "succeeded"
+                current.progress = 1
+                current.result = json.dumps(result, default=str)
+
+            if current.status != "queued":
+                current.finished_at = datetime.datetime.utcnow()
+            current.update()
+            return current.status
+        finally:
+            db.session.remove()
+
+
+'''
+run_worker(workers)
+    the runner loop: claims jobs while it has free processes and hands
+    them to a process pool. SIGTERM/SIGINT stop the claiming and let the
+    running jobs finish. run it next to the web workers:
+
+        python -m nupatcodeclass.jobs --workers 4
+'''
+def run_worker(workers=JOB_WORKERS):
+    from nupatcodeclass import create_app
+    app = create_app()
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+    signal.signal(signal.SIGINT, lambda *args: stopping.append(True))
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker) as pool:
+        running = set()
+        while not stopping or running:
+            if not stopping:
+                with app.app_context():
+                    try:
+                        requeue_stale()
+                        while len(running) < workers:
+                            job_id = claim_next()
+                            if job_id is None:
+                                break
+                            running.add(pool.submit(run_job, job_id))
+                    finally:
+                        db.session.remove()
+
+            if running:
+                done, running = wait(running, timeout=JOB_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(JOB_POLL_INTERVAL)
+
+
+"""
+Built-in jobs
+"""
+def _known_table(value):
+    from nupatcodeclass.changes import MODELS
+    if value not in MODELS:
+        raise schemas.Invalid("must be one of {}".format(", ".join(sorted(MODELS))))
+    return value
+
+
+@job("export", schemas.Schema([schemas.Field("table", _known_table, True)]).load)
+def export_table(ctx, table):
+    from nupatcodeclass.changes import MODELS
+    model = MODELS.get(table)
+    if model is None:
+        raise ValueError("unknown table: {}".format(table))
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, "{}-{}.jsonl.gz".format(table, ctx.job_id))
+    total = model.query.count() or 1
+    rows = 0
+
+    with gzip.open(path + ".tmp", "wt") as out:
+        for row in model.query.order_by(model.id).yield_per(JOB_BATCH_SIZE):
+            out.write(json.dumps(row.format(), default=str))
+            out.write("\n")
+            rows += 1
+            if rows % JOB_BATCH_SIZE == 0:
+                ctx.progress(rows / total)
+    os.replace(path + ".tmp", path)
+
+    return {"table": table, "rows": rows, "path": path}
+
+
+'''
+_forget_deleted(table, rows)
+    Core deletes bypass the session hooks, so the in-process caches are told
+    about the deleted rows by hand, the way upsert_grades does. rows are the
+    deleted rows as returned by DELETE ... RETURNING. no users are deleted
+    here, so the principal and duplicate caches are unaffected.
+'''
+def _forget_deleted(table, rows):
+    ids = [row.id for row in rows]
+    results.cache.invalidate(table)
+    if table == "students":
+        facets.invalidate(*ids)
+        cohorts.invalidate(*{row.student_program for row in rows})
+        schedule.invalidate(student_ids=ids)
+    elif table == "instructors":
+        grades.invalidate_course(*{row.course_id for row in rows})
+        schedule.invalidate(student_ids={row.student_id for row in rows})
+    elif table == "courses":
+        grades.invalidate_course(*ids)
+        schedule.invalidate(course_ids=ids)
+
+
+def _delete_in_batches(ctx, model, condition, done, total):
+    table = model.__table__
+    while True:
+        ids = [row[0] for row in db.session.query(model.id).filter(condition).limit(JOB_BATCH_SIZE)]
+        if not ids:
+            return done
+        deleted = db.session.execute(delete(table).where(table.c.id.in_(ids)).returning(*table.c)).all()
+        record_changes(db.session, [
+            {"entity": table.name, "entity_id": row.id, "operation": "delete"} for row in deleted
+        ])
+        db.session.commit()
+        _forget_deleted(table.name, deleted)
+        done += len(ids)
+        ctx.progress(done / total)
+
+
+@job("delete_course", schemas.Schema([schemas.Field("course_id", schemas.decode_integer, True)]).load)
+def delete_course(ctx, course_id):
+    course_students = db.session.query(Student.id).filter(Student.course_id == course_id)
+    course_instructors = db.session.query(Instructor.id).filter(
+        or_(Instructor.course_id == course_id, Instructor.student_id.in_(course_students)))
+
+    # children before parents, so every batch satisfies the foreign keys
+    steps = [
+        (Admin, or_(Admin.course_id == course_id, Admin.student_id.in_(course_students), Admin.instructor_id.in_(course_instructors))),
+        (Instructor, or_(Instructor.course_id == course_id, Instructor.student_id.in_(course_students))),
+        (Sponsor, Sponsor.student_id.in_(course_students)),
+        (Student, Student.course_id == course_id),
+        (CourseMaterial, CourseMaterial.course_id == course_id),
+        (Course, Course.id == course_id),
+    ]
+    total = sum(db.session.query(model.id).filter(condition).count() for model, condition in steps) or 1
+
+    done = 0
+    for model, condition in steps:
+        done = _delete_in_batches(ctx, model, condition, done, total)
+    return {"course_id": course_id, "deleted_rows": done}
+
+
+# the counters of the courses in :ids, recomputed from the rows; only
+# courses whose counters were off are written
+RECOUNT_COURSES = text("""
+    UPDATE courses c
+    SET student_count = counts.students, instructor_count = counts.instructors
+    FROM (
+        SELECT c.id,
+               (SELECT count(*) FROM students s WHERE s.course_id = c.id) AS students,
+               (SELECT count(DISTINCT i.user_id) FROM instructors i WHERE i.course_id = c.id) AS instructors
+        FROM courses c WHERE c.id = ANY(:ids)
+    ) counts
+    WHERE c.id = counts.id
+      AND (c.student_count, c.instructor_count) IS DISTINCT FROM (counts.students, counts.instructors)
+""")
+
+
+@job("recount_courses", schemas.Schema([]).load)
+def recount_courses(ctx):
+    """Recomputes every course's student and distinct-instructor counters, a batch of courses per transaction."""
+    course_ids = [row[0] for row in db.session.query(Course.id).order_by(Course.id)]
+    repaired = 0
+    for start in range(0, len(course_ids), JOB_BATCH_SIZE):
+        batch = course_ids[start:start + JOB_BATCH_SIZE]
+        # the triggers update these rows too, so holding their locks keeps a
+        # concurrent enrollment from landing between the count and the write
+        db.session.execute(
+            text("SELECT id FROM courses WHERE id = ANY(:ids) ORDER BY id FOR UPDATE"), {"ids": batch})
+        repaired += db.session.execute(RECOUNT_COURSES, {"ids": batch}).rowcount
+        db.session.commit()
+        ctx.progress(min(start + JOB_BATCH_SIZE, len(course_ids)) / (len(course_ids) or 1))
+    return {"courses": len(course_ids), "repaired": repaired}
+
+
+@job("grade_report", schemas.Schema([schemas.Field("cohort", schemas.decode_string(), False)]).load)
+def grade_report(ctx, cohort=None):
+    course_ids = [row[0] for row in db.session.query(Course.id).order_by(Course.id)]
+    report = []
+    for done, course_id in enumerate(course_ids, 1):
+        report.append(grades.course_analytics(course_id, cohort))
+        ctx.progress(done / len(course_ids))
+    return {"cohort": cohort, "courses": report}
+
+
+def _check_import(payload):
+    students = payload.get("students")
+    program = payload.get("student_program")
+    errors = []
+    if program is not None and not isinstance(program, str):
+        errors.append({"field": "student_program", "message": "must be a string"})
+    if not isinstance(students, list) or not students:
+        errors.append({"field": "students", "message": "must be a non-empty list"})
+    elif len(students) > JOB_IMPORT_LIMIT:
+        errors.append({"field": "students", "message": "at most {} students per import".format(JOB_IMPORT_LIMIT)})
+    if errors:
+        raise schemas.SchemaError(errors)
+
+    if program is not None:
+        students = [dict(entry, student_program=program) if isinstance(entry, dict) else entry for entry in students]
+    rows, errors = schemas.students.validate_many(students)
+    course_ids = {row["course_id"] for row in rows if row is not None}
+    known = {row[0] for row in db.session.query(Course.id).filter(Course.id.in_(course_ids))} if course_ids else set()
+    for index, row in enumerate(rows):
+        if row is not None and row["course_id"] not in known:
+            errors.append({"index": index, "field": "course_id", "message": "unknown course"})
+    if errors:
+        raise schemas.SchemaError([dict(error, field="students.{}".format(error["field"]) if error["field"] else "students") for error in errors])
+    # the raw entries are stored (dates stay ISO strings) and decoded again by the job
+    return {"students": students, "student_program": program}
+
+
+'''
+import_cohort(students, student_program)
+    inserts a cohort of students, given as the bodies POST /students takes;
+    student_program, when given, applies to all of them. every batch is its
+    own transaction, committed together with a checkpoint of how many rows
+    are in, so no transaction (and no change-log lock) lasts longer than a
+    batch, and a retried import resumes after the last committed batch. a
+    cancelled or failed import keeps the batches it committed; its result
+    says how many. the ORM session hooks keep the change log and the caches
+    current.
+'''
+@job("import_cohort", _check_import)
+def import_cohort(ctx, students, user_id, student_program=None):
+    rows = schemas.students.load_many(students)
+    imported = ctx.resume().get("imported", 0)
+    for start in range(imported, len(rows), JOB_BATCH_SIZE):
+        db.session.add_all(Student(user_id=user_id, **row) for row in rows[start:start + JOB_BATCH_SIZE])
+        imported = min(start + JOB_BATCH_SIZE, len(rows))
+        ctx.checkpoint({"student_program": student_program, "imported": imported})
+        db.session.commit()
+        ctx.progress(imported / len(rows))
+    return {"student_program": student_program, "imported": imported}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run background jobs.")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS)
+    run_worker(parser.parse_args().workers)
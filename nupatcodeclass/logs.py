@@ -0,0 +1,202 @@
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+from flask import g, has_request_context, request
+from flask.logging import default_handler
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_SLOW_MS = float(os.getenv("LOG_SLOW_MS", 500))
+# endpoint=rate pairs; access records of the listed endpoints are kept with
+# that probability, others always. errors and slow requests are always kept
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+REQUEST_ID_HEADER = "X-Request-ID"
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,128}$")
+
+access_log = logging.getLogger("nupatcodeclass.access")
+
+
+def parse_rates(spec):
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        endpoint, _, rate = item.partition("=")
+        rates[endpoint] = float(rate)
+    return rates
+
+
+SAMPLE_RATES = parse_rates(LOG_SAMPLE_RATES)
+
+
+'''
+JsonFormatter
+    one JSON object per line: time, level, logger, message, the request
+    fields the RequestContextFilter attached, any fields passed as
+    extra={"fields": {...}}, and the traceback when there is one.
+'''
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name in ("request_id", "method", "route"):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get("request_id")
+            record.method = request.method
+            record.route = request.url_rule.rule if request.url_rule is not None else request.path
+        return True
+
+
+'''
+AsyncQueueHandler
+    the handler the app's loggers write to: it only puts the record on a
+    bounded in-memory queue, and a listener thread formats and writes it.
+    a request never waits on stdout; when the writer falls behind, records
+    are dropped and counted rather than blocking the request.
+'''
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, target):
+        super().__init__(queue.Queue(LOG_QUEUE_SIZE))
+        self.target = target
+        self.dropped = 0
+        self.sampled_out = 0
+        self._listener = None
+        self._listener_pid = None
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # resolve everything that depends on the calling thread now, but
+        # leave the JSON formatting to the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record):
+        self.ensure_listener()
+        super().emit(record)
+
+    def ensure_listener(self):
+        # the listener thread does not survive fork; start one per process
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self.queue = queue.Queue(LOG_QUEUE_SIZE)
+            self._listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._listener_pid = os.getpid()
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+        }
+
+
+_stream = logging.StreamHandler(sys.stdout)
+_stream.setFormatter(JsonFormatter())
+handler = AsyncQueueHandler(_stream)
+handler.addFilter(RequestContextFilter())
+
+
+def setup_logging(app):
+    """Routes the app's loggers through the queue and installs request tracing."""
+    app.logger.removeHandler(default_handler)
+    for logger in (app.logger, access_log):
+        if handler not in logger.handlers:
+            logger.addHandler(handler)
+        logger.setLevel(LOG_LEVEL)
+        logger.propagate = False
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+
+def start_request():
+    request_id = request.headers.get(REQUEST_ID_HEADER, "")
+    g.request_id = request_id if REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+
+
+def finish_request(response):
+    response.headers[REQUEST_ID_HEADER] = g.get("request_id", "")
+    started = g.get("request_started")
+    if started is None:
+        return response
+
+    latency = (time.perf_counter() - started) * 1000
+    rate = SAMPLE_RATES.get(request.endpoint, 1.0)
+    if response.status_code < 500 and latency < LOG_SLOW_MS and rate < 1.0 and random.random() >= rate:
+        handler.sampled_out += 1
+        return response
+
+    access_log.info(
+        "%s %s %s", request.method, request.path, response.status_code,
+        extra={"fields": {
+            "endpoint": request.endpoint,
+            "status": response.status_code,
+            "latency_ms": round(latency, 2),
+            "sql_count": g.get("sql_count", 0),
+            "sql_ms": round(g.get("sql_time", 0.0) * 1000, 2),
+            "bytes": response.content_length,
+            "sample_rate": rate,
+        }},
+    )
+    return response
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.sql_count = g.get("sql_count", 0) + 1
+        conn.info["query_started"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _time_statement(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("query_started", None)
+    if started is not None and has_request_context():
+        g.sql_time = g.get("sql_time", 0.0) + time.perf_counter() - started
@@ -0,0 +1,175 @@
+import fcntl
+import json
+import os
+import re
+import secrets
+import time
+
+from models import db, Course, CourseMaterial
+from nupatcodeclass import media
+
+MATERIAL_MAX_BYTES = int(os.getenv("MATERIAL_MAX_BYTES", 512 * 1024 * 1024))
+UPLOAD_TTL = int(os.getenv("UPLOAD_TTL", 60 * 60 * 24))
+
+UPLOAD_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{22}$")
+CONTENT_RANGE_PATTERN = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+'''
+UploadError Exception
+raised for chunks that do not fit the upload they are sent to. offset is
+the number of bytes the server already holds, so the client can resume.
+'''
+class UploadError(Exception):
+    def __init__(self, message, status_code, offset=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.offset = offset
+
+
+def _upload_dir():
+    path = os.path.join(media.MEDIA_ROOT, "uploads")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _paths(upload_id):
+    if not UPLOAD_ID_PATTERN.match(upload_id):
+        raise UploadError("unknown upload", 404)
+    base = os.path.join(_upload_dir(), upload_id)
+    return base + ".part", base + ".json"
+
+
+def load_upload(upload_id):
+    part_path, meta_path = _paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta["offset"] = os.path.getsize(part_path)
+    except FileNotFoundError:
+        raise UploadError("unknown upload", 404)
+    return meta
+
+
+'''
+create_upload(course_id, filename, content_type, size)
+    starts a resumable upload and returns its state. the client then sends
+    the bytes in any number of chunks with append_chunk.
+'''
+def create_upload(course_id, filename, content_type, size):
+    if not isinstance(size, int) or size <= 0 or size > MATERIAL_MAX_BYTES:
+        raise UploadError("size must be between 1 and {} bytes".format(MATERIAL_MAX_BYTES), 413)
+
+    sweep_uploads()
+    upload_id = secrets.token_urlsafe(16)
+    part_path, meta_path = _paths(upload_id)
+    meta = {
+        "upload_id": upload_id,
+        "course_id": course_id,
+        "filename": os.path.basename(filename or "material"),
+        "content_type": content_type or "application/octet-stream",
+        "size": size,
+        "created": time.time(),
+    }
+    open(part_path, "wb").close()
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    meta["offset"] = 0
+    return meta
+
+
+def parse_content_range(header, size):
+    """Returns (start, length) from a "bytes start-end/total" header."""
+    match = CONTENT_RANGE_PATTERN.match(header or "")
+    if match is None:
+        raise UploadError("Content-Range header is required", 400)
+    start, end, total = (int(group) for group in match.groups())
+    if total != size or end < start or end >= size:
+        raise UploadError("Content-Range does not match the upload", 416)
+    return start, end - start + 1
+
+
+'''
+append_chunk(upload_id, start, length, stream)
+    appends one chunk at byte offset start. a chunk that starts anywhere but
+    at the current end of the file is refused with the current offset, which
+    is all a client needs to resume after a dropped connection.
+    returns the upload state; "complete" is true once every byte is in.
+'''
+def append_chunk(upload_id, start, length, stream):
+    meta = load_upload(upload_id)
+    part_path, _ = _paths(upload_id)
+
+    with open(part_path, "ab") as out:
+        fcntl.flock(out, fcntl.LOCK_EX)
+        offset = os.fstat(out.fileno()).st_size
+        if start != offset:
+            raise UploadError("chunk does not start at the current offset", 409, offset)
+
+        remaining = length
+        while remaining > 0:
+            chunk = stream.read(min(media.CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            out.write(chunk)
+            remaining -= len(chunk)
+        out.flush()
+        meta["offset"] = os.fstat(out.fileno()).st_size
+
+    if remaining > 0:
+        raise UploadError("chunk body is shorter than its Content-Range", 400, meta["offset"])
+
+    meta["complete"] = meta["offset"] == meta["size"]
+    return meta
+
+
+'''
+finish_upload(upload_id)
+    moves a complete upload into the content-addressed blob store. content
+    that is stored already is not kept twice. returns (meta, digest)
+'''
+def finish_upload(upload_id):
+    meta = load_upload(upload_id)
+    part_path, meta_path = _paths(upload_id)
+    digest, _ = media.store_file(part_path)
+    os.unlink(meta_path)
+    return meta, digest
+
+
+'''
+linkable_blob(digest, course_id, user_id)
+    the size of a stored blob the caller may attach without sending its
+    bytes, or None. naming a digest proves nothing about holding the
+    content (and digests are listed with every material), so only a blob
+    already attached to this course or to a course the caller created
+    qualifies; anything else goes through a normal upload, which is still
+    deduplicated when it finishes.
+'''
+def linkable_blob(digest, course_id, user_id):
+    if not digest or not media.DIGEST_PATTERN.match(digest):
+        return None
+    path = media.blob_path(digest)
+    if not os.path.exists(path):
+        return None
+
+    readable = Course.id == course_id
+    if user_id is not None:
+        readable = readable | (Course.user_id == user_id)
+    linked = (
+        db.session.query(CourseMaterial.id)
+        .join(Course, Course.id == CourseMaterial.course_id)
+        .filter(CourseMaterial.digest == digest, readable)
+        .first()
+    )
+    return os.path.getsize(path) if linked is not None else None
+
+
+def sweep_uploads():
+    cutoff = time.time() - UPLOAD_TTL
+    for name in os.listdir(_upload_dir()):
+        path = os.path.join(_upload_dir(), name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
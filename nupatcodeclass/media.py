@@ -0,0 +1,252 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import abort, send_file
+from PIL import Image
+
+from models import db, Student, THUMBNAIL_SIZES
+
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "media"))
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", 10 * 1024 * 1024))
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", os.cpu_count() or 2))
+THUMBNAIL_TIMEOUT = float(os.getenv("THUMBNAIL_TIMEOUT", 30))
+CHUNK_SIZE = 64 * 1024
+
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+'''
+MediaError Exception
+raised for uploads that are too large or are not a supported image
+'''
+class MediaError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+'''
+blob_path(digest, variant)
+    content-addressed location of a stored blob. identical uploads map to
+    the same file, and the digest doubles as a strong ETag.
+'''
+def blob_path(digest, variant=None):
+    name = digest if variant is None else "{}.{}".format(digest, variant)
+    return os.path.join(MEDIA_ROOT, "blobs", digest[:2], digest[2:4], name)
+
+
+def _publish(tmp_path, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(tmp_path)
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+
+'''
+store_stream(stream, max_bytes)
+    copies a request stream into the blob store in fixed-size chunks,
+    hashing as it goes, so an upload is never held in memory.
+    returns (digest, size, created); created is False when the same content
+    was stored already
+'''
+def store_stream(stream, max_bytes=MEDIA_MAX_BYTES):
+    tmp_dir = os.path.join(MEDIA_ROOT, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    sha = hashlib.sha256()
+    size = 0
+
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise MediaError("upload exceeds {} bytes".format(max_bytes), 413)
+                sha.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    digest = sha.hexdigest()
+    created = _publish(tmp_path, blob_path(digest))
+    return digest, size, created
+
+
+'''
+store_file(path)
+    moves an already-written file (e.g. a finished chunked upload) into the
+    blob store. if the same content is stored already, the file is dropped.
+    returns (digest, size)
+'''
+def store_file(path):
+    sha = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            sha.update(chunk)
+
+    digest = sha.hexdigest()
+    _publish(path, blob_path(digest))
+    return digest, size
+
+
+def sniff_image_type(path):
+    with open(path, "rb") as f:
+        head = f.read(12)
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+'''
+make_thumbnails(digest, sizes)
+    runs in a worker process: decodes the original once and writes a JPEG
+    thumbnail per size next to it.
+'''
+def make_thumbnails(digest, sizes):
+    with Image.open(blob_path(digest)) as original:
+        original.draft("RGB", (max(sizes), max(sizes)))
+        image = original.convert("RGB")
+
+    for size in sizes:
+        path = blob_path(digest, size)
+        if os.path.exists(path):
+            continue
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(MEDIA_ROOT, "tmp"))
+        with os.fdopen(fd, "wb") as out:
+            thumbnail.save(out, "JPEG", quality=85, optimize=True)
+        _publish(tmp_path, path)
+    return list(sizes)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _executor():
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pool = ProcessPoolExecutor(THUMBNAIL_WORKERS)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def _reset_executor(pool):
+    global _pool_pid
+    with _pool_lock:
+        if _pool is pool:
+            _pool_pid = None
+    pool.shutdown(wait=False)
+
+
+def generate_thumbnails(digest):
+    pool = _executor()
+    try:
+        future = pool.submit(make_thumbnails, digest, THUMBNAIL_SIZES)
+        return future.result(timeout=THUMBNAIL_TIMEOUT)
+    # before OSError: on Python 3.11+ the timeout is a subclass of it
+    except FutureTimeout:
+        future.cancel()
+        raise MediaError("thumbnailing timed out", 503)
+    except BrokenProcessPool:
+        # a worker died (e.g. killed for memory); later uploads get a new pool
+        _reset_executor(pool)
+        raise MediaError("thumbnailing failed", 503)
+    except Exception:
+        # Pillow raises OSError, SyntaxError, ValueError... for corrupt files
+        raise MediaError("not a readable image", 422)
+
+
+def _discard(digest):
+    for variant in (None,) + tuple(THUMBNAIL_SIZES):
+        try:
+            os.unlink(blob_path(digest, variant))
+        except FileNotFoundError:
+            pass
+
+
+'''
+store_image(stream)
+    stores an uploaded image and its thumbnails. returns the digest that
+    goes into Student.profile_picture
+'''
+def store_image(stream):
+    digest, size, created = store_stream(stream)
+    try:
+        if sniff_image_type(blob_path(digest)) is None:
+            raise MediaError("unsupported image type", 415)
+        generate_thumbnails(digest)
+    except BaseException:
+        # content stored before this upload may be in use elsewhere; keep it
+        if created:
+            _discard(digest)
+        raise
+    return digest
+
+
+'''
+is_profile_picture(digest)
+    /media is public, but the blob store also holds course materials, and
+    their digests are listed to anyone who can read a course. only content
+    some student uses as a profile picture is served there; materials go
+    through the authenticated download route.
+'''
+def is_profile_picture(digest):
+    return db.session.query(Student.id).filter(Student.profile_picture == digest).first() is not None
+
+
+'''
+send_blob(digest, size)
+    serves an original or a thumbnail. send_file answers If-None-Match with
+    304 and Range requests with 206, and hands the open file to the server's
+    wsgi.file_wrapper (sendfile under gunicorn), or to the front proxy when
+    USE_X_SENDFILE is on. blobs never change, so they are cached for a year.
+'''
+def send_blob(digest, size=None):
+    if not DIGEST_PATTERN.match(digest) or (size is not None and size not in THUMBNAIL_SIZES):
+        abort(404)
+    if not is_profile_picture(digest):
+        abort(404)
+
+    path = blob_path(digest, size)
+    if not os.path.exists(path):
+        abort(404)
+
+    mimetype = "image/jpeg" if size is not None else sniff_image_type(path)
+    return send_file(
+        path,
+        mimetype=mimetype or "application/octet-stream",
+        conditional=True,
+        etag=digest if size is None else "{}-{}".format(digest, size),
+        max_age=60 * 60 * 24 * 365,
+    )
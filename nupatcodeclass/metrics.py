@@ -0,0 +1,21 @@
+import threading
+
+'''
+The metrics registry
+    each subsystem registers a function returning a dict of its current
+    numbers (cache sizes, queue depths, hit rates); /metrics calls them all.
+    the values are per worker process.
+'''
+_sources = {}
+_lock = threading.Lock()
+
+
+def register(name, stats):
+    with _lock:
+        _sources[name] = stats
+
+
+def snapshot():
+    with _lock:
+        sources = dict(_sources)
+    return {name: stats() for name, stats in sorted(sources.items())}
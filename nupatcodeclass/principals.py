@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from itertools import chain
+
+from flask import g, has_request_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import db, User
+
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", 300))
+# how long "no user has this subject" is remembered
+PRINCIPAL_MISS_TTL = int(os.getenv("PRINCIPAL_MISS_TTL", 30))
+
+Principal = namedtuple("Principal", "user_id subject role email username")
+
+'''
+The principal cache
+    maps a JWT subject (the sub claim, stored on User.auth_subject) to a
+    compact, immutable Principal instead of a session-bound User object,
+    so it can be shared by every thread of the worker. committing a change
+    to a User row drops its entry; the TTL bounds how long another worker
+    process can keep a principal whose row changed.
+'''
+_cache = OrderedDict()
+_lock = threading.Lock()
+_hits = 0
+_misses = 0
+
+
+def _load(subject):
+    row = (
+        db.session.query(User.id, User.auth_subject, User.role, User.email, User.username)
+        .filter(User.auth_subject == subject)
+        .one_or_none()
+    )
+    return Principal(*row) if row is not None else None
+
+
+def resolve(subject):
+    global _hits, _misses
+    now = time.monotonic()
+    with _lock:
+        cached = _cache.get(subject)
+        if cached is not None and cached[0] > now:
+            _cache.move_to_end(subject)
+            _hits += 1
+            return cached[1]
+        _misses += 1
+
+    principal = _load(subject)
+    with _lock:
+        _cache[subject] = (now + (PRINCIPAL_CACHE_TTL if principal is not None else PRINCIPAL_MISS_TTL), principal)
+        _cache.move_to_end(subject)
+        while len(_cache) > PRINCIPAL_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return principal
+
+
+def current_principal():
+    """The caller's Principal, or None; resolved at most once per request."""
+    if not has_request_context():
+        return None
+    if "principal" not in g:
+        payload = g.get("auth_payload") or {}
+        g.principal = resolve(payload["sub"]) if payload.get("sub") else None
+    return g.principal
+
+
+_ALL = object()
+
+
+def invalidate(*subjects):
+    with _lock:
+        if _ALL in subjects:
+            _cache.clear()
+            return
+        for subject in subjects:
+            _cache.pop(subject, None)
+
+
+def stats():
+    with _lock:
+        lookups = _hits + _misses
+        return {
+            "entries": len(_cache),
+            "hits": _hits,
+            "misses": _misses,
+            "hit_rate": round(_hits / lookups, 4) if lookups else None,
+        }
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_user_changes(session, flush_context):
+    changed = session.info.setdefault("principal_subjects", set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(instance, User):
+            continue
+        state = inspect(instance)
+        if "auth_subject" not in state.dict and instance not in session.new:
+            # the subject was never loaded; we cannot tell which entry to drop
+            changed.add(_ALL)
+            continue
+        history = state.attrs.auth_subject.history
+        changed.update(subject for subject in chain(history.added or (), history.deleted or (), history.unchanged or ()) if subject)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_user_changes(session):
+    changed = session.info.pop("principal_subjects", None)
+    if changed:
+        invalidate(*changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_user_changes(session):
+    session.info.pop("principal_subjects", None)
@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from flask import json
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from nupatcodeclass import statements
+
+RESULT_CACHE_BYTES = int(os.getenv("RESULT_CACHE_BYTES", 16 * 1024 * 1024))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 30))
+
+# tables whose writes change columns of another table through triggers:
+# students and instructors rows move the counters on courses
+TRIGGERED_TABLES = {
+    "students": ("courses",),
+    "instructors": ("courses",),
+}
+
+'''
+ResultCache
+    serialized pages of list and search results, each stored with the
+    version of every table it was read from. committing a change to a table
+    bumps that table's version, so the next lookup sees the entry as stale
+    and recomputes it. bounded by the size of the serialized entries, least
+    recently used first; the TTL bounds how long another worker process can
+    serve a page computed before a change it did not see.
+'''
+class ResultCache:
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES, ttl=RESULT_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._entries = OrderedDict()
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def invalidate(self, *tables):
+        with self._lock:
+            for table in set(tables).union(*(TRIGGERED_TABLES.get(table, ()) for table in tables)):
+                self._versions[table] += 1
+
+    def fetch(self, key, tables, compute):
+        now = time.monotonic()
+        with self._lock:
+            versions = tuple(self._versions[table] for table in tables)
+            cached = self._entries.get(key)
+            if cached is not None:
+                if cached[0] == versions and now - cached[1] < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(cached[2])
+                self.stale += 1
+            self.misses += 1
+
+        result = compute()
+        # the app's own encoder, so a cached page renders exactly like a fresh one
+        serialized = json.dumps(result)
+
+        with self._lock:
+            # a commit while computing means the result may already be old
+            if versions == tuple(self._versions[table] for table in tables):
+                self._store(key, (versions, now, serialized))
+        return result
+
+    def _store(self, key, entry):
+        size = len(entry[2])
+        if size > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.bytes -= len(previous[2])
+        self._entries[key] = entry
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= len(evicted[2])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+cache = ResultCache()
+
+
+def normalize_search(search):
+    # cache key only: ILIKE ignores ASCII case, so "Data" and "data" share a
+    # page. spacing and non-ASCII case can change what ILIKE matches, so those
+    # terms are keyed as sent
+    if not search:
+        return None
+    search = str(search)
+    return search.lower() if search.isascii() else search
+
+
+def make_key(model, search=None, filters=None, page=1, fields=None):
+    return (
+        model.__tablename__,
+        normalize_search(search),
+        tuple(sorted((filters or {}).items())),
+        max(page, 1),
+        tuple(sorted(fields)) if fields else None,
+    )
+
+
+'''
+search_page(model, column, search, page, per_page)
+    one page of model rows, ordered by id and, when search is given,
+    filtered by column ILIKE %search%, together with the total number of
+    matching rows. returns {"items": [...], "total": n}.
+'''
+def search_page(model, column, search, page, per_page):
+    key = make_key(model, search, {"column": column.key} if search else None, page) + (per_page,)
+
+    def compute():
+        search_column, pattern = (column, "%{}%".format(search)) if search else (None, None)
+        items = statements.page(model, (key[3] - 1) * per_page, per_page, search_column, pattern)
+        return {"items": [item.format() for item in items], "total": statements.count(model, search_column, pattern)}
+
+    return cache.fetch(key, (model.__tablename__,), compute)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_tables(session, flush_context):
+    changed = session.info.setdefault("result_tables", set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(instance, "__tablename__", None)
+        if table is not None:
+            changed.add(table)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_tables(session):
+    changed = session.info.pop("result_tables", None)
+    if changed:
+        cache.invalidate(*changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changed_tables(session):
+    session.info.pop("result_tables", None)
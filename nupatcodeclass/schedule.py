@@ -0,0 +1,278 @@
+import os
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import db, Course, Instructor, Student
+from nupatcodeclass.intervals import IntervalTree
+
+SCHEDULE_INDEX_TTL = int(os.getenv("SCHEDULE_INDEX_TTL", 300))
+
+Slot = namedtuple("Slot", "course_id title instructor start end")
+
+
+def instructor_key(name):
+    """course_instructor is free text; "  Ada  Obi" and "ada obi" are the same person."""
+    return " ".join((name or "").split()).casefold()
+
+
+def _scheduled(start, end):
+    return start is not None and end is not None and start <= end
+
+
+def _slot_summary(slot):
+    return {
+        "id": slot.course_id,
+        "course_title": slot.title,
+        "course_instructor": slot.instructor,
+        "course_start_date": slot.start,
+        "course_end_date": slot.end,
+    }
+
+
+def _conflict(a, b, **fields):
+    a, b = sorted((a, b), key=lambda slot: slot.course_id)
+    fields.update(
+        courses=[_slot_summary(a), _slot_summary(b)],
+        overlap={"start": max(a.start, b.start), "end": min(a.end, b.end)},
+    )
+    return fields
+
+
+'''
+Schedule
+    the dated courses, with one IntervalTree of (start, end, course id) per
+    instructor and one per student over the courses the student is in
+    (Student.course_id and the courses of their Instructor rows). checking
+    a course against its instructor's other courses is one overlap query,
+    O(log n) plus the conflicts found, and a term's conflicts are one query
+    per course instead of a comparison of every pair.
+'''
+class Schedule:
+    def __init__(self):
+        self.slots = {}
+        self.by_instructor = defaultdict(IntervalTree)
+        self.enrollments = defaultdict(set)
+        self.students_of = defaultdict(set)
+        self.by_student = {}
+        self.built_at = time.monotonic()
+
+    def set_course(self, course_id, title, instructor, start, end):
+        self.remove_course(course_id, keep_enrollments=True)
+        if not _scheduled(start, end):
+            return
+        slot = Slot(course_id, title, instructor, start, end)
+        self.slots[course_id] = slot
+        if instructor_key(instructor):
+            self.by_instructor[instructor_key(instructor)].insert(start, end, course_id)
+        for student_id in self.students_of.get(course_id, ()):
+            self.by_student.setdefault(student_id, IntervalTree()).insert(start, end, course_id)
+
+    def remove_course(self, course_id, keep_enrollments=False):
+        slot = self.slots.pop(course_id, None)
+        if slot is not None:
+            key = instructor_key(slot.instructor)
+            tree = self.by_instructor.get(key)
+            if tree is not None:
+                tree.remove(slot.start, slot.end, course_id)
+                if not len(tree):
+                    del self.by_instructor[key]
+            for student_id in self.students_of.get(course_id, ()):
+                tree = self.by_student.get(student_id)
+                if tree is not None:
+                    tree.remove(slot.start, slot.end, course_id)
+        if not keep_enrollments:
+            for student_id in self.students_of.pop(course_id, ()):
+                self.enrollments[student_id].discard(course_id)
+
+    def set_enrollments(self, student_id, course_ids):
+        for course_id in self.enrollments.pop(student_id, ()):
+            self.students_of[course_id].discard(student_id)
+        self.by_student.pop(student_id, None)
+        if not course_ids:
+            return
+        self.enrollments[student_id] = set(course_ids)
+        tree = IntervalTree()
+        for course_id in course_ids:
+            self.students_of[course_id].add(student_id)
+            slot = self.slots.get(course_id)
+            if slot is not None:
+                tree.insert(slot.start, slot.end, course_id)
+        self.by_student[student_id] = tree
+
+    def course_conflicts(self, course_id):
+        """The other courses of this course's instructor that overlap it."""
+        slot = self.slots.get(course_id)
+        if slot is None:
+            return []
+        tree = self.by_instructor.get(instructor_key(slot.instructor))
+        if tree is None:
+            return []
+        return [
+            _conflict(slot, self.slots[other], instructor=slot.instructor)
+            for _, _, other in tree.overlapping(slot.start, slot.end)
+            if other != course_id
+        ]
+
+    def _pairs(self, tree, lo, hi):
+        pairs = set()
+        for start, end, course_id in tree.overlapping(lo, hi):
+            for _, _, other in tree.overlapping(start, end):
+                if other != course_id:
+                    pairs.add((min(course_id, other), max(course_id, other)))
+        return sorted(pairs)
+
+    def term_conflicts(self, lo, hi):
+        """Every pair of overlapping courses running in [lo, hi] that share an instructor or a student."""
+        instructors = []
+        for tree in self.by_instructor.values():
+            for a, b in self._pairs(tree, lo, hi):
+                instructors.append(_conflict(self.slots[a], self.slots[b], instructor=self.slots[a].instructor))
+        students = []
+        for student_id, tree in self.by_student.items():
+            if len(tree) < 2:
+                continue
+            for a, b in self._pairs(tree, lo, hi):
+                students.append(_conflict(self.slots[a], self.slots[b], student_id=student_id))
+        instructors.sort(key=lambda conflict: (conflict["overlap"]["start"], conflict["courses"][0]["id"]))
+        students.sort(key=lambda conflict: (conflict["student_id"], conflict["overlap"]["start"]))
+        return {"instructors": instructors, "students": students}
+
+
+'''
+The process-wide schedule
+    built on first use and rebuilt after SCHEDULE_INDEX_TTL. commits that
+    touch courses, students or instructor rows mark the affected course and
+    student ids, and the next use re-reads only those rows. the TTL bounds
+    how long a worker can miss a change made by another process.
+'''
+_schedule = None
+_pending_courses = set()
+_pending_students = set()
+_lock = threading.Lock()
+_builds = 0
+_refreshes = 0
+
+COURSE_COLUMNS = (Course.id, Course.course_title, Course.course_instructor, Course.course_start_date, Course.course_end_date)
+
+
+def _enrollments(student_ids=None):
+    from_students = db.session.query(Student.id, Student.course_id)
+    from_instructors = db.session.query(Instructor.student_id, Instructor.course_id)
+    if student_ids is not None:
+        from_students = from_students.filter(Student.id.in_(student_ids))
+        from_instructors = from_instructors.filter(Instructor.student_id.in_(student_ids))
+    enrollments = defaultdict(set)
+    for student_id, course_id in from_students.union(from_instructors):
+        enrollments[student_id].add(course_id)
+    return enrollments
+
+
+def current_schedule():
+    global _schedule, _builds, _refreshes
+    with _lock:
+        if _schedule is None or time.monotonic() - _schedule.built_at > SCHEDULE_INDEX_TTL:
+            _pending_courses.clear()
+            _pending_students.clear()
+            schedule = Schedule()
+            for row in db.session.query(*COURSE_COLUMNS).yield_per(5000):
+                schedule.set_course(*row)
+            for student_id, course_ids in _enrollments().items():
+                schedule.set_enrollments(student_id, course_ids)
+            _schedule = schedule
+            _builds += 1
+        elif _pending_courses or _pending_students:
+            course_ids, student_ids = list(_pending_courses), list(_pending_students)
+            _pending_courses.clear()
+            _pending_students.clear()
+            found = set()
+            if course_ids:
+                for row in db.session.query(*COURSE_COLUMNS).filter(Course.id.in_(course_ids)):
+                    _schedule.set_course(*row)
+                    found.add(row[0])
+                for course_id in set(course_ids) - found:
+                    _schedule.remove_course(course_id)
+            if student_ids:
+                enrollments = _enrollments(student_ids)
+                for student_id in student_ids:
+                    _schedule.set_enrollments(student_id, enrollments.get(student_id))
+            _refreshes += 1
+        return _schedule
+
+
+def course_conflicts(course_id):
+    schedule = current_schedule()
+    with _lock:
+        return schedule.course_conflicts(course_id)
+
+
+def term_conflicts(lo, hi):
+    schedule = current_schedule()
+    with _lock:
+        return schedule.term_conflicts(lo, hi)
+
+
+def invalidate(course_ids=(), student_ids=()):
+    """Marks courses and students changed outside the session (bulk statements) for the next refresh."""
+    with _lock:
+        if _schedule is None:
+            return
+        _pending_courses.update(course_ids)
+        _pending_students.update(student_ids)
+
+
+def stats():
+    with _lock:
+        schedule = _schedule
+        return {
+            "courses": len(schedule.slots) if schedule is not None else 0,
+            "instructors": len(schedule.by_instructor) if schedule is not None else 0,
+            "students": len(schedule.by_student) if schedule is not None else 0,
+            "pending_courses": len(_pending_courses),
+            "pending_students": len(_pending_students),
+            "builds": _builds,
+            "refreshes": _refreshes,
+        }
+
+
+def _previous_student(instance):
+    history = inspect(instance).attrs.student_id.history
+    return list(history.deleted or ())
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_schedule_changes(session, flush_context):
+    courses = session.info.setdefault("schedule_courses", set())
+    students = session.info.setdefault("schedule_students", set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Course):
+            courses.add(instance.id)
+        elif isinstance(instance, Student):
+            students.add(instance.id)
+        elif isinstance(instance, Instructor):
+            students.add(instance.student_id)
+            # an instructor row moved to another student leaves the old one
+            students.update(_previous_student(instance))
+    students.discard(None)
+
+
+@event.listens_for(Session, "after_commit")
+def _mark_schedule_changes(session):
+    courses = session.info.pop("schedule_courses", None)
+    students = session.info.pop("schedule_students", None)
+    if not courses and not students:
+        return
+    with _lock:
+        if _schedule is None:
+            return
+        _pending_courses.update(courses or ())
+        _pending_students.update(students or ())
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_schedule_changes(session):
+    session.info.pop("schedule_courses", None)
+    session.info.pop("schedule_students", None)
@@ -0,0 +1,247 @@
+import datetime
+import re
+from collections import namedtuple
+
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, Numeric, String, inspect
+
+from models import Course, Instructor, Student, User
+
+INTEGER_PATTERN = re.compile(r"^\s*[+-]?[0-9]+\s*$")
+NUMBER_PATTERN = re.compile(r"^\s*[+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)\s*$")
+
+
+class Invalid(ValueError):
+    pass
+
+
+class SchemaError(Exception):
+    def __init__(self, errors, status_code=422, message="unprocessable"):
+        self.errors = errors
+        self.status_code = status_code
+        self.message = message
+
+
+'''
+Decoders
+    each takes a value from a JSON body (or a query string) and returns the
+    Python value the column stores, or raises Invalid with a short message.
+    they are strict about what JSON already types (true is not an integer,
+    5 is not a string) and lenient only where strings are the natural form
+    (query arguments, "42", "true", ISO 8601 dates).
+'''
+def decode_integer(value):
+    if isinstance(value, bool):
+        raise Invalid("must be an integer")
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and INTEGER_PATTERN.match(value):
+        return int(value)
+    raise Invalid("must be an integer")
+
+
+def decode_number(minimum=None, maximum=None):
+    if minimum is not None and maximum is not None:
+        message = "must be a number from {:g} to {:g}".format(minimum, maximum)
+    else:
+        message = "must be a number"
+
+    def decode(value):
+        if isinstance(value, bool) or not (isinstance(value, (int, float)) or isinstance(value, str) and NUMBER_PATTERN.match(value)):
+            raise Invalid(message)
+        value = float(value)
+        # NaN fails both comparisons
+        if not ((minimum is None or value >= minimum) and (maximum is None or value <= maximum)):
+            raise Invalid(message)
+        return value
+    return decode
+
+
+def decode_boolean(value):
+    if isinstance(value, bool):
+        return value
+    if value in ("true", "false"):
+        return value == "true"
+    raise Invalid("must be true or false")
+
+
+def decode_datetime(value):
+    if isinstance(value, str):
+        text = value.strip()
+        if text.endswith(("Z", "z")):
+            text = text[:-1] + "+00:00"
+        try:
+            parsed = datetime.datetime.fromisoformat(text)
+        except ValueError:
+            pass
+        else:
+            # the columns are timestamp without time zone, in UTC
+            if parsed.tzinfo is not None:
+                parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            return parsed
+    raise Invalid("must be an ISO 8601 date, e.g. 2022-02-12 or 2022-02-12T09:00:00")
+
+
+def decode_date(value):
+    if isinstance(value, str):
+        try:
+            return datetime.date.fromisoformat(value.strip())
+        except ValueError:
+            pass
+    raise Invalid("must be an ISO 8601 date, e.g. 2022-02-12")
+
+
+def decode_string(max_length=None):
+    message = "must be a string" if max_length is None else "must be a string of at most {} characters".format(max_length)
+
+    def decode(value):
+        if not isinstance(value, str) or max_length is not None and len(value) > max_length:
+            raise Invalid(message)
+        return value
+    return decode
+
+
+def decoder_for(column_type):
+    # Boolean before Integer and DateTime before Date: check the specific types first
+    if isinstance(column_type, Boolean):
+        return decode_boolean
+    if isinstance(column_type, DateTime):
+        return decode_datetime
+    if isinstance(column_type, Date):
+        return decode_date
+    if isinstance(column_type, Integer):
+        return decode_integer
+    if isinstance(column_type, (Float, Numeric)):
+        return decode_number()
+    if isinstance(column_type, String):
+        return decode_string(column_type.length)
+    return lambda value: value
+
+
+# nullable=False with required=False: a column with a default, which a
+# create may omit but an edit may not set to null
+Field = namedtuple("Field", "name decode required nullable", defaults=(True,))
+
+
+'''
+Checks
+    rules across fields, run once every field has decoded. a check only
+    sees values that are set; an edit is checked against the row it
+    changes, so moving just the end date before the stored start fails too.
+'''
+Check = namedtuple("Check", "fields field message test")
+
+
+def ordered(first, last):
+    """last must not be before first."""
+    return Check((first, last), last, "must not be before {}".format(first), lambda values: values[first] <= values[last])
+
+
+'''
+Schema
+    the decoders of a request body's fields, resolved once. Schema.from_model
+    builds one from a model's columns: the decoder follows the column type
+    and NOT NULL columns without a default are required. load() checks a
+    whole body and reports every bad field at once, before any database
+    work; partial=True (edits) only decodes the fields the body has, and
+    current is the row being edited, for the checks. validate_many() and
+    load_many() do the same for the entries of a bulk request, reporting
+    each error with its index. fields the schema does not know (search,
+    page) are ignored.
+'''
+class Schema:
+    def __init__(self, fields, checks=()):
+        self._fields = tuple(fields)
+        self.fields = {field.name: field for field in self._fields}
+        self.checks = tuple(checks)
+
+    @classmethod
+    def from_model(cls, model, exclude=(), checks=()):
+        return cls(
+            (
+                Field(
+                    column.key,
+                    decoder_for(column.type),
+                    not column.nullable and column.default is None and column.server_default is None,
+                    column.nullable,
+                )
+                for column in inspect(model).columns
+                if not column.primary_key and column.key not in exclude
+            ),
+            checks,
+        )
+
+    def decode(self, name, value):
+        """Decodes one field's value; raises KeyError for unknown fields and Invalid for bad values."""
+        return self.fields[name].decode(value)
+
+    def _load(self, body, partial, errors, index=None, current=None):
+        def error(field, message):
+            entry = {"field": field, "message": message}
+            if index is not None:
+                entry["index"] = index
+            errors.append(entry)
+
+        if not isinstance(body, dict):
+            error(None, "must be an object")
+            return None
+
+        values = {}
+        failed = False
+        for field in self._fields:
+            value = body.get(field.name)
+            if value is None:
+                if partial and field.name not in body:
+                    continue
+                if field.required:
+                    error(field.name, "is required")
+                    failed = True
+                elif partial and not field.nullable:
+                    error(field.name, "must not be null")
+                    failed = True
+                else:
+                    values[field.name] = None
+                continue
+            try:
+                values[field.name] = field.decode(value)
+            except Invalid as e:
+                error(field.name, str(e))
+                failed = True
+        if failed:
+            return None
+
+        for check in self.checks:
+            merged = {name: values[name] if name in values else getattr(current, name, None) for name in check.fields}
+            if None not in merged.values() and not check.test(merged):
+                error(check.field, check.message)
+                failed = True
+        return None if failed else values
+
+    def load(self, body, partial=False, current=None):
+        errors = []
+        values = self._load(body, partial, errors, current=current)
+        if errors:
+            raise SchemaError(errors)
+        return values
+
+    def validate_many(self, entries, partial=False):
+        """(values, errors): values has None at the index of every invalid entry."""
+        errors = []
+        return [self._load(entry, partial, errors, index) for index, entry in enumerate(entries)], errors
+
+    def load_many(self, entries, partial=False):
+        if not isinstance(entries, list):
+            raise SchemaError([{"field": None, "message": "must be a list"}])
+        values, errors = self.validate_many(entries, partial)
+        if errors:
+            raise SchemaError(errors)
+        return values
+
+
+# the bodies of the create and edit handlers; user_id comes from the caller's token
+students = Schema.from_model(Student, exclude=("user_id",), checks=[ordered("program_start_date", "program_end_date")])
+courses = Schema.from_model(
+    Course, exclude=("user_id", "student_count", "instructor_count"), checks=[ordered("course_start_date", "course_end_date")])
+instructors = Schema.from_model(Instructor, exclude=("user_id",))
+users = Schema.from_model(User, exclude=("default_password", "actual_password", "auth_subject"))
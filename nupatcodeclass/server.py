@@ -0,0 +1,179 @@
+"""
+Production launcher.
+
+Loads and warms the app once in the master process, then forks the
+workers from it, so imports, mapper configuration, the JWKS and the warm
+caches are shared copy-on-write instead of being rebuilt by every worker
+on its first request.
+
+    python -m nupatcodeclass.server --bind 0.0.0.0:5000
+    WEB_CONCURRENCY=9 WEB_THREADS=4 python -m nupatcodeclass.server
+
+/events streams stay open for as long as a dashboard does, which would
+pin one gthread thread each. They are served by a second, streaming
+process of the same app on gevent workers, where an open stream is a
+parked greenlet, and each worker holds up to EVENTS_MAX_SUBSCRIBERS of
+them (needs gevent and psycogreen):
+
+    python -m nupatcodeclass.server --streams --bind 0.0.0.0:5001
+
+The front proxy sends /events there and everything else to the API
+workers, which answer /events with 503:
+
+    location /events { proxy_pass http://127.0.0.1:5001; proxy_buffering off; proxy_read_timeout 1h; }
+
+Reloads (the pid of the master is in --pid, default server.pid):
+    kill -HUP <pid>     rolling restart of the workers from the preloaded
+                        app; new config, same code
+    kill -USR2 <pid>    starts a new master on the new code next to the old
+                        one; then kill -QUIT the old master once it is up
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+from sqlalchemy.orm import configure_mappers
+
+from auth.auth import AUTH0_DOMAIN, get_jwks
+from models import db, Student, Course, Instructor
+from nupatcodeclass import STUDENTS_PER_PAGE, cohorts, events, results
+
+
+EVENTS_WORKERS = int(os.getenv("EVENTS_WORKERS", 2))
+# connections a streaming worker takes on top of its streams: the 503s
+# past the cap, health checks
+EVENTS_HEADROOM = 100
+
+
+def worker_count():
+    return int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+
+
+'''
+gunicorn_config(args, hooks)
+    the settings of the API (gthread) or, with --streams, the streaming
+    (gevent) process. a streaming worker is sized by the connections it
+    holds, not by threads.
+'''
+def gunicorn_config(args, hooks=None):
+    config = {
+        "bind": args.bind,
+        "workers": args.workers,
+        "preload_app": True,
+        "pidfile": args.pid,
+        "timeout": 60,
+        "graceful_timeout": 30,
+        # recycle workers a few at a time, never all at once
+        "max_requests": 5000,
+        "max_requests_jitter": 500,
+    }
+    if args.streams:
+        config.update(
+            worker_class="gevent",
+            worker_connections=events.EVENTS_MAX_SUBSCRIBERS + EVENTS_HEADROOM,
+            # a recycled worker would drop every stream it holds
+            max_requests=0,
+        )
+    else:
+        config.update(worker_class="gthread", threads=args.threads)
+    config.update(hooks or {})
+    return config
+
+
+'''
+warm_caches(app)
+    fills what the first requests would otherwise wait for: the JWKS, the
+    first page and total of each list (the dashboard's counts) and the
+    cohort index of every program. a failing step is logged and skipped; a
+    cold cache is slower, not wrong. returns seconds spent per step.
+'''
+def warm_caches(app):
+    timings = {}
+
+    def step(name, fn):
+        started = time.perf_counter()
+        try:
+            fn()
+        except Exception:
+            app.logger.exception("warming %s failed", name)
+        timings[name] = round(time.perf_counter() - started, 4)
+
+    step("mappers", configure_mappers)
+    if AUTH0_DOMAIN:
+        step("jwks", get_jwks)
+
+    with app.app_context():
+        for model in (Student, Course, Instructor):
+            step(model.__tablename__, lambda model=model: results.search_page(model, None, None, 1, STUDENTS_PER_PAGE))
+
+        def warm_cohorts():
+            programs = db.session.query(Student.student_program).filter(Student.student_program.isnot(None)).distinct()
+            for (program,) in programs:
+                cohorts.cohort_index(program)
+        step("cohorts", warm_cohorts)
+
+        # no pooled connection may cross the fork; each worker opens its own
+        db.session.remove()
+        db.engine.dispose()
+
+    return timings
+
+
+def main():
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("the production launcher needs gunicorn: pip install gunicorn")
+
+    from nupatcodeclass import create_app
+
+    parser = argparse.ArgumentParser(description="Run the API with preloaded, pre-warmed workers.")
+    parser.add_argument("--bind", default=os.getenv("BIND", "127.0.0.1:5000"))
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--threads", type=int, default=int(os.getenv("WEB_THREADS", 4)))
+    parser.add_argument("--pid", default=os.getenv("PIDFILE", "server.pid"))
+    parser.add_argument("--streams", action="store_true", help="serve /events from gevent workers")
+    args = parser.parse_args()
+
+    hooks = {}
+    if args.streams:
+        try:
+            import gevent  # noqa: F401
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            raise SystemExit("the streaming process needs gevent and psycogreen: pip install gevent psycogreen")
+        args.workers = args.workers or EVENTS_WORKERS
+
+        # without it every query (token checks, the replay) blocks the
+        # worker's other streams
+        def post_worker_init(worker):
+            patch_psycopg()
+        hooks["post_worker_init"] = post_worker_init
+    else:
+        args.workers = args.workers or worker_count()
+        # a stream here would pin a thread; the proxy routes them to --streams
+        events.broadcaster.max_streams = 0
+
+    app = create_app()
+    timings = warm_caches(app)
+    app.logger.info("warmed caches in %.3fs: %s", sum(timings.values()), timings)
+
+    def post_fork(server, worker):
+        with app.app_context():
+            db.engine.dispose()
+    hooks["post_fork"] = post_fork
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in gunicorn_config(args, hooks).items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import os
+import re
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", os.path.join(tempfile.gettempdir(), "nupat_sessions.db"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", 60 * 60 * 24))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", 100000))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", 16 * 1024))
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", 60))
+
+SID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{43}$")
+
+"""
+SqliteSessionStore
+    an embedded key-value store for session data kept in a SQLite database
+    in WAL mode, so every worker process on the host can share it without
+    an outside service.
+
+    each thread (and each forked worker) opens its own connection, rows carry
+    an absolute expiry time and a background sweeper deletes expired rows and
+    trims the table down to max_entries, oldest expiry first.
+"""
+class SqliteSessionStore:
+    def __init__(self, path=SESSION_DB_PATH, max_entries=SESSION_MAX_ENTRIES, sweep_interval=SESSION_SWEEP_INTERVAL):
+        self.path = path
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._sweeper = None
+        self._sweeper_pid = None
+        self._sweeper_lock = threading.Lock()
+        self._connection()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def get(self, sid):
+        row = self._connection().execute(
+            "SELECT data, expires FROM sessions WHERE sid = ? AND expires > ?", (sid, time.time())
+        ).fetchone()
+        return row
+
+    def set(self, sid, data, expires):
+        if len(data) > SESSION_MAX_BYTES:
+            raise ValueError("session data exceeds SESSION_MAX_BYTES ({} bytes)".format(SESSION_MAX_BYTES))
+
+        self._connection().execute(
+            "INSERT INTO sessions (sid, data, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT (sid) DO UPDATE SET data = excluded.data, expires = excluded.expires",
+            (sid, data, expires),
+        )
+        self.ensure_sweeper()
+
+    def touch(self, sid, expires):
+        self._connection().execute("UPDATE sessions SET expires = ? WHERE sid = ?", (expires, sid))
+
+    def delete(self, sid):
+        self._connection().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def count(self):
+        return self._connection().execute("SELECT count(*) FROM sessions").fetchone()[0]
+
+    def sweep(self):
+        conn = self._connection()
+        expired = conn.execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),)).rowcount
+
+        overflow = self.count() - self.max_entries
+        if overflow > 0:
+            conn.execute(
+                "DELETE FROM sessions WHERE sid IN (SELECT sid FROM sessions ORDER BY expires LIMIT ?)",
+                (overflow,),
+            )
+            expired += overflow
+        return expired
+
+    def ensure_sweeper(self):
+        # threads do not survive fork, so every worker starts its own sweeper
+        if self._sweeper_pid == os.getpid() or self.sweep_interval <= 0:
+            return
+
+        with self._sweeper_lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper = threading.Thread(target=self._sweep_forever, name="session-sweeper", daemon=True)
+            self._sweeper_pid = os.getpid()
+            self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except sqlite3.Error:
+                pass
+
+
+"""
+LazySession
+    the session object handed to a request. nothing is read from the store
+    until a handler actually touches the session, so requests that never use
+    it cost no store round trip at all.
+"""
+class LazySession(SessionMixin):
+    def __init__(self, store, serializer, sid=None):
+        self.store = store
+        self.serializer = serializer
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        self.expires = None
+        self.regenerated = None
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            self.accessed = True
+            self._data = {}
+            if self.sid is not None:
+                row = self.store.get(self.sid)
+                if row is None:
+                    self.sid = None
+                    self.new = True
+                else:
+                    self._data = self.serializer.loads(row[0])
+                    self.expires = row[1]
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def regenerate(self):
+        """Issues a fresh session id on save, e.g. after a login."""
+        self._load()
+        if self.sid is not None:
+            self.regenerated = self.sid
+        self.sid = None
+        self.new = True
+        self.modified = True
+
+
+"""
+SqliteSessionInterface
+    plugs SqliteSessionStore into Flask as app.session_interface. the cookie
+    only carries a random session id; the data stays server-side.
+"""
+class SqliteSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store=None, ttl=SESSION_TTL):
+        self.store = store or SqliteSessionStore()
+        self.ttl = ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid is not None and not SID_PATTERN.match(sid):
+            sid = None
+        return LazySession(self.store, self.serializer, sid)
+
+    def save_session(self, app, session, response):
+        if not session.accessed:
+            return
+        response.vary.add("Cookie")
+
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.regenerated is not None:
+            self.store.delete(session.regenerated)
+
+        if not session._data:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = time.time()
+        expires = now + self.ttl
+        if session.modified or session.sid is None:
+            data = self.serializer.dumps(session._data)
+            if len(data) > SESSION_MAX_BYTES:
+                # the response itself is fine; only the session is not kept
+                app.logger.warning("dropping session of %d bytes, over SESSION_MAX_BYTES (%d)", len(data), SESSION_MAX_BYTES)
+                if session.sid is not None:
+                    self.store.delete(session.sid)
+                    response.delete_cookie(name, domain=domain, path=path)
+                return
+            if session.sid is None:
+                session.sid = secrets.token_urlsafe(32)
+            self.store.set(session.sid, data, expires)
+        elif session.expires is not None and session.expires - now < self.ttl / 2:
+            # sliding expiry, written at most once per half TTL
+            self.store.touch(session.sid, expires)
+        else:
+            return
+
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=expires,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
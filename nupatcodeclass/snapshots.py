@@ -0,0 +1,323 @@
+"""
+Snapshots of the database for seeding development and staging.
+
+snapshot writes every table of models.py to its own gzipped COPY file,
+the tables in parallel, all read from one exported Postgres snapshot so
+the files are consistent with each other. restore loads a snapshot into
+the database from .env: it empties the tables, drops their secondary
+indexes, unique and foreign key constraints, loads the tables in
+parallel with COPY and then rebuilds what it dropped, re-enables the
+triggers, moves the id sequences past the loaded rows and recounts the
+course counters.
+
+    python -m nupatcodeclass.snapshots snapshot seed/
+    python -m nupatcodeclass.snapshots snapshot seed-cohort/ --cohort "Data Science"
+    python -m nupatcodeclass.snapshots restore seed/ --workers 8
+
+--cohort keeps the students of one student_program and the rows they
+need: their courses, instructor rows, sponsors and admin rows, and the
+users all of those point at. The jobs and changes tables are left empty.
+The DDL a restore drops is first written to <dir>/restore-ddl.sql; if a
+restore is interrupted, run that file with psql to put it back.
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from models import db, Course
+from nupatcodeclass import jobs
+
+SNAPSHOT_WORKERS = int(os.getenv("SNAPSHOT_WORKERS", min(os.cpu_count() or 2, 8)))
+SNAPSHOT_COMPRESSLEVEL = int(os.getenv("SNAPSHOT_COMPRESSLEVEL", 3))
+SNAPSHOT_MAINTENANCE_WORK_MEM = os.getenv("SNAPSHOT_MAINTENANCE_WORK_MEM", "256MB")
+
+MANIFEST = "manifest.json"
+RESTORE_DDL = "restore-ddl.sql"
+
+# tables a subset leaves empty: operational state, not seed data
+OPERATIONAL_TABLES = ("jobs", "changes")
+
+'''
+Cohort subsets
+    the WHERE clause of each table for one student_program. every foreign
+    key of a kept row points at a kept row: instructor rows only of kept
+    students in kept courses, admin rows only where all three references
+    are kept, and users only as far as some kept row points at them.
+'''
+_STUDENTS = "SELECT id FROM students WHERE student_program = %(cohort)s"
+_COURSES = "SELECT course_id FROM students WHERE student_program = %(cohort)s"
+_INSTRUCTORS = "SELECT id FROM instructors WHERE student_id IN ({}) AND course_id IN ({})".format(_STUDENTS, _COURSES)
+
+COHORT_SUBSET = {
+    "students": "student_program = %(cohort)s",
+    "courses": "id IN ({})".format(_COURSES),
+    "course_materials": "course_id IN ({})".format(_COURSES),
+    "sponsors": "student_id IN ({})".format(_STUDENTS),
+    "instructors": "id IN ({})".format(_INSTRUCTORS),
+    "admins": "student_id IN ({}) AND course_id IN ({}) AND instructor_id IN ({})".format(_STUDENTS, _COURSES, _INSTRUCTORS),
+}
+COHORT_SUBSET["users"] = "id IN ({})".format(" UNION ".join(
+    "SELECT user_id FROM {} WHERE {}".format(table, COHORT_SUBSET[table])
+    for table in ("students", "courses", "sponsors", "instructors", "admins")
+))
+
+
+def tables():
+    """The tables of models.py, parents before children."""
+    return list(db.metadata.sorted_tables)
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _raw_connection():
+    connection = db.engine.raw_connection()
+    if not hasattr(connection, "copy_expert"):
+        connection.close()
+        raise SystemExit("snapshots need the psycopg2 driver (DB_DRIVER=psycopg2)")
+    return connection
+
+
+def _copy_out(snapshot_id, table, where, params, path):
+    connection = _raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+        columns = ", ".join(_quote(column.name) for column in table.columns)
+        query = "SELECT {} FROM {}".format(columns, _quote(table.name))
+        if where is not None:
+            query = cursor.mogrify("{} WHERE {}".format(query, where), params).decode()
+        started = time.perf_counter()
+        with gzip.open(path, "wb", compresslevel=SNAPSHOT_COMPRESSLEVEL) as out:
+            cursor.copy_expert("COPY ({}) TO STDOUT WITH (FORMAT binary)".format(query), out)
+        rows = cursor.rowcount
+        connection.rollback()
+        return {"rows": rows, "bytes": os.path.getsize(path), "seconds": round(time.perf_counter() - started, 3)}
+    finally:
+        connection.close()
+
+
+def snapshot(directory, cohort=None, workers=SNAPSHOT_WORKERS):
+    os.makedirs(directory, exist_ok=True)
+    manifest = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "cohort": cohort,
+        "format": "binary",
+        "tables": {},
+    }
+
+    # the exporting transaction must stay open until every worker has
+    # attached to its snapshot
+    exporter = _raw_connection()
+    try:
+        cursor = exporter.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cursor.execute("SELECT pg_export_snapshot()")
+        snapshot_id = cursor.fetchone()[0]
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for table in tables():
+                if cohort is None:
+                    where = None
+                elif table.name in COHORT_SUBSET:
+                    where = COHORT_SUBSET[table.name]
+                elif table.name in OPERATIONAL_TABLES:
+                    where = "false"
+                else:
+                    raise SystemExit("no cohort subset for table {}".format(table.name))
+                path = os.path.join(directory, "{}.copy.gz".format(table.name))
+                futures[table.name] = pool.submit(_copy_out, snapshot_id, table, where, {"cohort": cohort}, path)
+                manifest["tables"][table.name] = {
+                    "file": os.path.basename(path),
+                    "columns": [column.name for column in table.columns],
+                }
+            for name, future in futures.items():
+                manifest["tables"][name].update(future.result())
+    finally:
+        exporter.rollback()
+        exporter.close()
+
+    with open(os.path.join(directory, MANIFEST + ".tmp"), "w") as out:
+        json.dump(manifest, out, indent=2)
+    os.replace(os.path.join(directory, MANIFEST + ".tmp"), os.path.join(directory, MANIFEST))
+    return manifest
+
+
+'''
+Deferred DDL
+    what restore drops before loading and rebuilds afterwards, read from the
+    catalog rather than from models.py so that indexes added by migrations
+    are kept too. primary keys stay: the load does not need them gone and
+    the foreign keys are rebuilt against them.
+'''
+def deferred_ddl(cursor, names):
+    cursor.execute("""
+        SELECT c.conrelid::regclass::text, c.conname, c.contype, pg_get_constraintdef(c.oid)
+        FROM pg_constraint c
+        WHERE c.conrelid = ANY(%(tables)s::regclass[]) AND c.contype IN ('u', 'f')
+        ORDER BY c.contype DESC, c.conname
+    """, {"tables": names})
+    constraints = cursor.fetchall()
+
+    cursor.execute("""
+        SELECT i.indrelid::regclass::text, x.relname, pg_get_indexdef(i.indexrelid)
+        FROM pg_index i JOIN pg_class x ON x.oid = i.indexrelid
+        WHERE i.indrelid = ANY(%(tables)s::regclass[])
+          AND NOT i.indisprimary
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid AND c.contype IN ('p', 'u', 'x'))
+        ORDER BY x.relname
+    """, {"tables": names})
+    indexes = cursor.fetchall()
+
+    drop = ["ALTER TABLE {} DROP CONSTRAINT {}".format(table, _quote(name)) for table, name, kind, _ in constraints if kind == "f"]
+    drop += ["ALTER TABLE {} DROP CONSTRAINT {}".format(table, _quote(name)) for table, name, kind, _ in constraints if kind == "u"]
+    drop += ["DROP INDEX {}".format(_quote(name)) for _, name, _ in indexes]
+
+    # rebuilt per table in parallel, unique constraints and indexes first,
+    # then the foreign keys once every table has its keys back
+    build = {}
+    for table, name, definition in indexes:
+        build.setdefault(table, []).append(definition)
+    for table, name, kind, definition in constraints:
+        if kind == "u":
+            build.setdefault(table, []).append("ALTER TABLE {} ADD CONSTRAINT {} {}".format(table, _quote(name), definition))
+    foreign_keys = [
+        "ALTER TABLE {} ADD CONSTRAINT {} {}".format(table, _quote(name), definition)
+        for table, name, kind, definition in constraints if kind == "f"
+    ]
+    return drop, build, foreign_keys
+
+
+def _execute_all(statements):
+    connection = _raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SET LOCAL maintenance_work_mem = %s", (SNAPSHOT_MAINTENANCE_WORK_MEM,))
+        for statement in statements:
+            cursor.execute(statement)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def _copy_in(table, entry, path):
+    connection = _raw_connection()
+    try:
+        cursor = connection.cursor()
+        columns = ", ".join(_quote(column) for column in entry["columns"])
+        with gzip.open(path, "rb") as source:
+            cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT binary)".format(_quote(table), columns), source)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def restore(directory, workers=SNAPSHOT_WORKERS):
+    with open(os.path.join(directory, MANIFEST)) as source:
+        manifest = json.load(source)
+    names = [table.name for table in tables() if table.name in manifest["tables"]]
+    quoted = ", ".join(_quote(name) for name in names)
+    timings = {}
+
+    connection = _raw_connection()
+    try:
+        started = time.perf_counter()
+        cursor = connection.cursor()
+        drop, build, foreign_keys = deferred_ddl(cursor, names)
+        with open(os.path.join(directory, RESTORE_DDL), "w") as out:
+            for statement in [statement for statements in build.values() for statement in statements] + foreign_keys:
+                out.write(statement + ";\n")
+            for name in names:
+                out.write("ALTER TABLE {} ENABLE TRIGGER USER;\n".format(_quote(name)))
+
+        cursor.execute("TRUNCATE {} RESTART IDENTITY".format(quoted))
+        for statement in drop:
+            cursor.execute(statement)
+        # the counter and change feed triggers would count the loaded rows
+        # a second time
+        for name in names:
+            cursor.execute("ALTER TABLE {} DISABLE TRIGGER USER".format(_quote(name)))
+        connection.commit()
+        timings["prepare"] = time.perf_counter() - started
+
+        try:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                loads = [
+                    pool.submit(_copy_in, name, manifest["tables"][name], os.path.join(directory, manifest["tables"][name]["file"]))
+                    for name in names
+                ]
+                for load in loads:
+                    load.result()
+            timings["load"] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for result in [pool.submit(_execute_all, statements) for statements in build.values()]:
+                    result.result()
+            _execute_all(foreign_keys)
+            timings["indexes"] = time.perf_counter() - started
+        finally:
+            # even after a failed load, so the app keeps working on what
+            # did load; restore-ddl.sql has the rest
+            started = time.perf_counter()
+            for name in names:
+                cursor.execute("ALTER TABLE {} ENABLE TRIGGER USER".format(_quote(name)))
+            for table in tables():
+                if table.name in names and "id" in table.columns:
+                    cursor.execute(
+                        "SELECT setval(pg_get_serial_sequence(%(table)s, 'id'), coalesce(max(id), 0) + 1, false) FROM {}".format(_quote(table.name)),
+                        {"table": table.name},
+                    )
+            connection.commit()
+    finally:
+        connection.close()
+
+    # a subset keeps only some of each course's students
+    db.session.execute(jobs.RECOUNT_COURSES, {"ids": [row[0] for row in db.session.query(Course.id)]})
+    db.session.commit()
+    _execute_all(["ANALYZE {}".format(quoted)])
+    timings["finish"] = time.perf_counter() - started
+
+    return {
+        "tables": {name: manifest["tables"][name].get("rows") for name in names},
+        "seconds": {step: round(seconds, 3) for step, seconds in timings.items()},
+    }
+
+
+def main():
+    from nupatcodeclass import create_app
+
+    parser = argparse.ArgumentParser(description="Snapshot and restore the database with COPY.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    take = commands.add_parser("snapshot", help="write every table to DIRECTORY")
+    take.add_argument("directory")
+    take.add_argument("--cohort", help="only this student_program and the rows it needs")
+    take.add_argument("--workers", type=int, default=SNAPSHOT_WORKERS)
+    load = commands.add_parser("restore", help="replace the tables' contents with DIRECTORY")
+    load.add_argument("directory")
+    load.add_argument("--workers", type=int, default=SNAPSHOT_WORKERS)
+    args = parser.parse_args()
+
+    # create_app() also creates any missing tables, so restoring into an
+    # empty database works
+    app = create_app()
+    with app.app_context():
+        if args.command == "snapshot":
+            manifest = snapshot(args.directory, args.cohort, args.workers)
+            for name, entry in manifest["tables"].items():
+                print("{:18} {:>10} rows {:>12} bytes {:>8.2f}s".format(name, entry["rows"], entry["bytes"], entry["seconds"]))
+        else:
+            summary = restore(args.directory, args.workers)
+            print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+from sqlalchemy import func, lambda_stmt, select
+
+from models import db
+
+'''
+The statement layer
+    the hot lookups as lambda statements: SQLAlchemy caches the compiled
+    SQL per call site and only pulls the parameters (ids, offsets, search
+    patterns) out of the closure on each call, instead of rebuilding the
+    query and recomputing its cache key every time. with the psycopg
+    driver the connections also prepare them server-side once they are
+    hot (see PREPARE_THRESHOLD in models.py).
+'''
+def get(model, ident):
+    """The row with primary key ident, or None. answered from the session's identity map when it can be."""
+    return db.session.get(model, ident)
+
+
+def page(model, offset, limit, column=None, pattern=None):
+    if column is None:
+        stmt = lambda_stmt(lambda: select(model).order_by(model.id))
+    else:
+        stmt = lambda_stmt(lambda: select(model).where(column.ilike(pattern)).order_by(model.id))
+    stmt += lambda s: s.offset(offset).limit(limit)
+    return db.session.execute(stmt).scalars().all()
+
+
+def count(model, column=None, pattern=None):
+    if column is None:
+        stmt = lambda_stmt(lambda: select(func.count(model.id)))
+    else:
+        stmt = lambda_stmt(lambda: select(func.count(model.id)).where(column.ilike(pattern)))
+    return db.session.execute(stmt).scalar()
@@ -1,10 +1,26 @@
+import argparse
+import datetime
+import gzip
+import io
 import os
+import shutil
+import tempfile
+import time
+import types
 import unittest
 import json
+from unittest import mock
+from flask import Flask, g, jsonify, request, session
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func
+from sqlalchemy.dialects import postgresql
+from werkzeug.exceptions import NotFound
 
 from flaskr import create_app
-from models import Course, Instructor, Student, setup_db
+from models import Course, Instructor, Student, setup_db, db, period, record_changes, write_changes, discard_changes, CHANGE_LOG_LOCK
+from auth.passwords import check_password, hash_password
+from nupatcodeclass import cohorts, compression, deadlines, events, grades, jobs, media, principals, results, schemas, server, snapshots, statements
+from nupatcodeclass.sessions import SESSION_MAX_BYTES, SqliteSessionInterface, SqliteSessionStore
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -233,6 +249,957 @@ class NupatTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(len(data["message"]), "resourse not found")
 
+    
+    def test_400_login_without_credentials(self):
+        res = self.client().post("/login", json={"email": "student@nupat.test"})
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "bad request")
+    
+    def test_403_login_with_wrong_password(self):
+        res = self.client().post("/login", json={"email": "nobody@nupat.test", "password": "wrong"})
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "forbidden")
+    
+    def test_malformed_password_hash_fails_login(self):
+        stored = hash_password("secret", iterations=1000)
+        algorithm, _, salt, digest = stored.split("$")
+        
+        self.assertEqual(check_password("secret", stored), (True, True))
+        for malformed in (
+            "{}$x${}${}".format(algorithm, salt, digest),
+            "{}$0${}${}".format(algorithm, salt, digest),
+            "{}$-5${}${}".format(algorithm, salt, digest),
+            "{}$1000${}$é".format(algorithm, salt),
+        ):
+            self.assertEqual(check_password("secret", malformed), (False, False))
+    
+    def test_404_media_not_found(self):
+        res = self.client().get("/media/{}/128".format("0" * 64))
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "resource not found")
+    
+    def test_get_course_materials(self):
+        res = self.client().get("/courses/1/materials")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["course_id"], 1)
+        self.assertIsInstance(data["materials"], list)
+    
+    def test_404_course_material_upload_not_found(self):
+        res = self.client().get("/courses/1/materials/uploads/{}".format("a" * 22))
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "unknown upload")
+    
+    def test_get_grade_analytics(self):
+        res = self.client().get("/courses/1/grades/analytics")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["analytics"]["course_id"], 1)
+        self.assertIn("percentiles", data["analytics"])
+        self.assertIn("weeks", data["analytics"])
+    
+    def test_404_grade_analytics_course_does_not_exist(self):
+        res = self.client().get("/courses/1000/grades/analytics")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "resource not found")
+    
+    def test_get_active_students(self):
+        res = self.client().get("/students/active?date=2022-02-14")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["date"], "2022-02-14")
+        self.assertIsInstance(data["students"], list)
+    
+    def test_400_active_students_bad_date(self):
+        res = self.client().get("/students/active?date=12 02 2022")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "bad request")
+    
+    def test_get_courses_running_in_week(self):
+        res = self.client().get("/courses/running?week=2022-02-16")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["start"], "2022-02-14")
+        self.assertEqual(data["end"], "2022-02-20")
+    
+    def test_get_changes_since_version(self):
+        res = self.client().get("/changes?since=0&limit=5")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["since"], 0)
+        self.assertLessEqual(len(data["changes"]), 5)
+        self.assertGreaterEqual(data["next_since"], 0)
+    
+    def test_get_changes_beyond_latest_version(self):
+        res = self.client().get("/changes?since=999999999")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["changes"], [])
+        self.assertEqual(data["next_since"], 999999999)
+        self.assertEqual(data["has_more"], False)
+    
+    def test_400_events_unknown_entity(self):
+        res = self.client().get("/events?entities=students,payments")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "bad request")
+    
+    def test_create_export_job(self):
+        res = self.client().post("/jobs", json={"kind": "export", "payload": {"table": "courses"}})
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["job"]["status"], "queued")
+        self.assertEqual(data["job"]["payload"], {"table": "courses"})
+    
+    def test_400_create_job_unknown_kind(self):
+        res = self.client().post("/jobs", json={"kind": "mine_bitcoin"})
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+    
+    def test_400_create_job_bad_payload_and_attempts(self):
+        res = self.client().post("/jobs", json={"kind": "delete_course", "payload": {"course_id": "seven"}, "max_attempts": -1})
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(sorted(error["field"] for error in data["errors"]), ["max_attempts", "payload.course_id"])
+    
+    def test_404_get_unknown_job(self):
+        res = self.client().get("/jobs/999999")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "resource not found")
+    
+    def test_get_metrics(self):
+        res = self.client().get("/metrics")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertIn("reads", data["metrics"]["admission"]["groups"])
+        self.assertIn("waiting", data["metrics"]["admission"]["groups"]["reads"])
+    
+    def test_repeated_search_served_from_result_cache(self):
+        first = json.loads(self.client().post("/students", json={"search": "Data Science"}).data)
+        second = json.loads(self.client().post("/students", json={"search": "data science"}).data)
+        metrics = json.loads(self.client().get("/metrics").data)["metrics"]
+        
+        self.assertEqual(first, second)
+        self.assertGreaterEqual(metrics["results"]["hits"], 1)
+    
+    def test_authenticated_lists_served_from_result_cache(self):
+        token = os.getenv("TEST_AUTH_TOKEN")
+        if not token:
+            self.skipTest("TEST_AUTH_TOKEN is not set")
+        headers = {"Authorization": "Bearer {}".format(token)}
+        
+        for path in ("/students", "/courses"):
+            first = self.client().get(path, headers=headers)
+            hits = results.cache.stats()["hits"]
+            second = self.client().get(path, headers=headers)
+            
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(second.status_code, 200)
+            self.assertEqual(json.loads(first.data), json.loads(second.data))
+            self.assertGreater(results.cache.stats()["hits"], hits)
+    
+    def test_400_bulk_grade_invalid_entries(self):
+        course_id = json.loads(self.client().get("/courses").data)["courses"][0]["id"]
+        res = self.client().post("/courses/{}/grades".format(course_id), json={
+            "week": 3,
+            "grades": [{"student_id": "one", "grade": 80}, {"student_id": 2, "grade": 140}],
+        })
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual([error["index"] for error in data["errors"]], [0, 1])
+    
+    def test_400_bulk_grade_names_user(self):
+        course_id = json.loads(self.client().get("/courses").data)["courses"][0]["id"]
+        res = self.client().post("/courses/{}/grades".format(course_id), json={
+            "week": 3,
+            "user_id": 1,
+            "grades": [{"student_id": 1, "grade": 80}],
+        })
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertIn("user_id", data["message"])
+    
+    def test_get_student_facets(self):
+        res = self.client().get("/students/facets?accommodation=true&gender=female&gender=male")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertLessEqual(len(data["students"]), 10)
+        self.assertTrue(all(student["accommodation"] for student in data["students"]))
+        self.assertEqual(set(data["facets"]), {"gender", "student_program", "accommodation", "marital_status", "disability", "course_id"})
+    
+    def test_400_student_facets_bad_value(self):
+        res = self.client().get("/students/facets?accommodation=maybe")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+    
+    def test_request_id_propagated(self):
+        res = self.client().get("/courses", headers={"X-Request-ID": "trace-123"})
+        generated = self.client().get("/courses")
+        
+        self.assertEqual(res.headers["X-Request-ID"], "trace-123")
+        self.assertEqual(len(generated.headers["X-Request-ID"]), 32)
+    
+    def test_504_when_route_budget_spent(self):
+        deadlines.budgets["retrieve_changes"] = 0.000001
+        try:
+            res = self.client().get("/changes?since=0")
+        finally:
+            del deadlines.budgets["retrieve_changes"]
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 504)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "deadline exceeded")
+    
+    def test_404_bulk_grade_unknown_course(self):
+        res = self.client().post("/courses/999999/grades", json={"week": 3, "grades": []})
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+    
+    def test_422_instructor_body_rejected_field_by_field(self):
+        res = self.client().post("/instructors", json={"student_id": "one", "course_id": True, "weekly_project": 3})
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "unprocessable")
+        self.assertEqual(sorted(error["field"] for error in data["errors"]), ["course_id", "student_id", "weekly_project"])
+    
+    def test_get_user_duplicates(self):
+        res = self.client().get("/users/duplicates?min_score=0.9")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(all(pair["score"] >= 0.9 and pair["keep"] < pair["merge"] for pair in data["duplicates"]))
+    
+    def test_400_duplicate_check_without_names(self):
+        res = self.client().post("/users/duplicates/check", json={"phone_number": 80312345})
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+    
+    def test_get_schedule_conflicts(self):
+        res = self.client().get("/schedule/conflicts?start=2022-01-01&end=2022-03-31")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["total_conflicts"], len(data["instructor_conflicts"]) + len(data["student_conflicts"]))
+    
+    def test_400_schedule_conflicts_term_ends_before_start(self):
+        res = self.client().get("/schedule/conflicts?start=2022-03-31&end=2022-01-01")
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+    
+    def test_course_counters_follow_moved_student(self):
+        with self.app.app_context():
+            student = Student.query.first()
+            source = db.session.get(Course, student.course_id)
+            target = Course.query.filter(Course.id != source.id).first()
+            before = (source.student_count, target.student_count)
+            try:
+                student.course_id = target.id
+                db.session.flush()
+                db.session.refresh(source)
+                db.session.refresh(target)
+                
+                self.assertEqual(source.student_count, before[0] - 1)
+                self.assertEqual(target.student_count, before[1] + 1)
+                self.assertEqual(target.student_count, Student.query.filter(Student.course_id == target.id).count())
+            finally:
+                db.session.rollback()
+    
+    def test_instructor_count_counts_instructors_not_grades(self):
+        with self.app.app_context():
+            student = Student.query.first()
+            course = db.session.get(Course, student.course_id)
+            try:
+                for week in ("Week 90", "Week 91"):
+                    db.session.add(Instructor(student.user_id, student.id, course.id, course.course_title, week, "80"))
+                db.session.flush()
+                db.session.refresh(course)
+                
+                distinct = db.session.query(func.count(Instructor.user_id.distinct())).filter(Instructor.course_id == course.id).scalar()
+                self.assertEqual(course.instructor_count, distinct)
+            finally:
+                db.session.rollback()
+
+class QueryPlanTestCase(unittest.TestCase):
+    """Runs EXPLAIN on every query each endpoint issues and fails on sequential scans.
+
+    Plans are taken with enable_seqscan off, so a Seq Scan that still carries
+    a Filter means no index can serve that predicate, however small the test
+    tables are. Any Seq Scan at all on a table with at least LARGE_TABLE_ROWS
+    rows (per pg_class.reltuples) fails too.
+    """
+
+    LARGE_TABLE_ROWS = int(os.getenv("LARGE_TABLE_ROWS", 10000))
+
+    ENDPOINTS = [
+        ("GET", "/students", None),
+        ("GET", "/students/active?date=2022-02-14", None),
+        ("GET", "/students/active?date=2022-02-14&program=Data Science", None),
+        ("POST", "/students", {"search": "data"}),
+        ("GET", "/courses", None),
+        ("GET", "/courses/running?week=2022-02-14", None),
+        ("POST", "/courses", {"search": "jav"}),
+        ("GET", "/courses/1/materials", None),
+        ("GET", "/courses/1/grades/analytics", None),
+        ("GET", "/instructos", None),
+        ("POST", "/instructors", {"search": "python"}),
+        ("DELETE", "/students/1000", None),
+        ("DELETE", "/courses/1000", None),
+        ("DELETE", "/instructors/1000", None),
+        ("POST", "/login", {"email": "nobody@nupat.test", "password": "wrong"}),
+        ("GET", "/changes?since=0", None),
+        ("GET", "/media/{}".format("0" * 64), None),
+    ]
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = 'postgresql+psycopg2://{}:{}@{}:{}/{}'.format(
+            os.getenv("DB_USER"), os.getenv("DB_PASSWORD"), os.getenv("DB_HOST"), os.getenv("DB_PORT"), os.getenv("TEST_DB_NAME"))
+        setup_db(self.app, self.database_path)
+
+        token = os.getenv("TEST_AUTH_TOKEN")
+        if not token:
+            # without a token every endpoint answers 401 and issues no query
+            self.skipTest("TEST_AUTH_TOKEN is not set")
+        self.headers = {"Authorization": "Bearer {}".format(token)}
+
+    def capture_queries(self, method, path, body):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                statements.append((statement, parameters))
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            self.client().open(path, method=method, json=body, headers=self.headers)
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        return engine, statements
+
+    def seq_scans(self, plan, row_counts):
+        found = []
+        if plan.get("Node Type") == "Seq Scan":
+            relation = plan.get("Relation Name")
+            if "Filter" in plan or row_counts.get(relation, 0) >= self.LARGE_TABLE_ROWS:
+                found.append("Seq Scan on {} (filter: {})".format(relation, plan.get("Filter")))
+        for child in plan.get("Plans", []):
+            found.extend(self.seq_scans(child, row_counts))
+        return found
+
+    def test_no_sequential_scans(self):
+        captured = 0
+        for method, path, body in self.ENDPOINTS:
+            engine, statements = self.capture_queries(method, path, body)
+            captured += len(statements)
+            conn = engine.raw_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'")
+                row_counts = dict(cur.fetchall())
+                cur.execute("SET enable_seqscan = off")
+                for statement, parameters in statements:
+                    with self.subTest(endpoint="{} {}".format(method, path), statement=statement):
+                        cur.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+                        plan = cur.fetchone()[0][0]["Plan"]
+                        self.assertEqual(self.seq_scans(plan, row_counts), [])
+            finally:
+                conn.rollback()
+                conn.close()
+        self.assertGreater(captured, 0, "no endpoint issued a query to explain")
+
+
+class PeriodIndexTestCase(unittest.TestCase):
+    """Range queries and their GiST indexes tolerate swapped dates; needs no database."""
+
+    def sql(self, expression):
+        return str(expression.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+
+    def test_queries_match_the_indexed_expression(self):
+        for model, name, start, end in (
+            (Student, "ix_students_program_period", Student.program_start_date, Student.program_end_date),
+            (Course, "ix_courses_course_period", Course.course_start_date, Course.course_end_date),
+        ):
+            index = next(index for index in model.__table__.indexes if index.name == name)
+            self.assertEqual(self.sql(index.expressions[0]), self.sql(period(start, end)))
+            self.assertIn("least(", self.sql(index.expressions[0]))
+
+    def test_swapped_dates_indexed_as_their_span(self):
+        day = datetime.datetime(2022, 2, 14)
+        rows = [(1, day, day + datetime.timedelta(days=30)), (2, day + datetime.timedelta(days=30), day)]
+        with mock.patch.object(cohorts.db, "session") as session:
+            session.query.return_value.filter.return_value.all.return_value = rows
+            tree = cohorts._build("Data Science")
+
+        self.assertEqual(sorted(value for _, _, value in tree.overlapping(day, day)), [1, 2])
+
+
+class ChangeLogTestCase(unittest.TestCase):
+    """The change log is buffered per transaction and written at commit; needs no database."""
+
+    def setUp(self):
+        self.session = mock.MagicMock(info={})
+
+    def test_rows_written_under_lock_only_at_commit(self):
+        record_changes(self.session, [{"entity": "students", "entity_id": 1, "operation": "insert"}])
+        record_changes(self.session, [{"entity": "students", "entity_id": 2, "operation": "insert"}])
+        self.session.connection.assert_not_called()
+
+        write_changes(self.session)
+
+        self.session.flush.assert_called_once_with()
+        (lock, lock_params), (insert, rows) = [call.args for call in self.session.connection().execute.call_args_list]
+        self.assertIn("pg_advisory_xact_lock", str(lock))
+        self.assertEqual(lock_params, {"key": CHANGE_LOG_LOCK})
+        self.assertEqual([row["entity_id"] for row in rows], [1, 2])
+        self.assertNotIn("change_log", self.session.info)
+
+    def test_commit_without_changes_takes_no_lock(self):
+        write_changes(self.session)
+
+        self.session.connection().execute.assert_not_called()
+
+    def test_rolled_back_changes_discarded(self):
+        record_changes(self.session, [{"entity": "courses", "entity_id": 3, "operation": "delete"}])
+        discard_changes(self.session)
+        write_changes(self.session)
+
+        self.session.connection().execute.assert_not_called()
+
+
+class CohortImportTestCase(unittest.TestCase):
+    """import_cohort commits batch by batch and resumes after a checkpoint; needs no database."""
+
+    def run_import(self, total, saved):
+        ctx = mock.MagicMock()
+        ctx.resume.return_value = saved
+        rows = [{"student_program": "Data Science"} for _ in range(total)]
+        with mock.patch.object(jobs, "JOB_BATCH_SIZE", 10), \
+                mock.patch.object(jobs.schemas.students, "load_many", return_value=rows), \
+                mock.patch.object(jobs, "Student"), \
+                mock.patch.object(jobs.db, "session") as session:
+            session.add_all.side_effect = list
+            result = jobs.import_cohort(ctx, rows, 7, "Data Science")
+        return ctx, session, result
+
+    def test_each_batch_committed_with_its_checkpoint(self):
+        ctx, session, result = self.run_import(25, {})
+
+        self.assertEqual(result, {"student_program": "Data Science", "imported": 25})
+        self.assertEqual([call.args[0]["imported"] for call in ctx.checkpoint.call_args_list], [10, 20, 25])
+        self.assertEqual(session.commit.call_count, 3)
+
+    def test_retry_resumes_after_last_checkpoint(self):
+        ctx, session, result = self.run_import(25, {"imported": 20})
+
+        self.assertEqual(result["imported"], 25)
+        self.assertEqual([call.args[0]["imported"] for call in ctx.checkpoint.call_args_list], [25])
+        self.assertEqual(session.commit.call_count, 1)
+
+
+class SessionStoreTestCase(unittest.TestCase):
+    """The SQLite session store and its session interface; needs no database."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = SqliteSessionStore(os.path.join(self.directory, "sessions.db"), max_entries=3, sweep_interval=0)
+        self.app = Flask(__name__)
+        self.app.session_interface = SqliteSessionInterface(self.store)
+
+        @self.app.route("/remember/<int:size>")
+        def remember(size):
+            session["note"] = "x" * size
+            return "ok"
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sweep_drops_expired_then_oldest_sessions(self):
+        now = time.time()
+        self.store.set("expired", "{}", now - 1)
+        for i in range(5):
+            self.store.set("sid{}".format(i), "{}", now + 100 + i)
+
+        self.assertEqual(self.store.sweep(), 3)
+        self.assertEqual(self.store.count(), 3)
+        self.assertIsNone(self.store.get("expired"))
+        self.assertIsNone(self.store.get("sid1"))
+        self.assertIsNotNone(self.store.get("sid2"))
+
+    def test_session_saved_under_cookie(self):
+        res = self.app.test_client().get("/remember/10")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("session=", res.headers["Set-Cookie"])
+        self.assertEqual(self.store.count(), 1)
+
+    def test_oversized_session_dropped(self):
+        res = self.app.test_client().get("/remember/{}".format(SESSION_MAX_BYTES))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn("Set-Cookie", res.headers)
+        self.assertEqual(self.store.count(), 0)
+
+
+class MediaStoreTestCase(unittest.TestCase):
+    """Profile picture storage against a temporary MEDIA_ROOT; needs no database."""
+
+    def setUp(self):
+        self.media_root = media.MEDIA_ROOT
+        media.MEDIA_ROOT = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(media.MEDIA_ROOT)
+        media.MEDIA_ROOT = self.media_root
+
+    def stored_files(self):
+        return [name for _, _, names in os.walk(media.MEDIA_ROOT) for name in names]
+
+    def test_corrupt_image_rejected_and_removed(self):
+        corrupt = b"\x89PNG\r\n\x1a\n" + b"not really a png" * 64
+
+        with self.assertRaises(media.MediaError) as raised:
+            media.store_image(io.BytesIO(corrupt))
+
+        self.assertEqual(raised.exception.status_code, 422)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_oversized_upload_rejected_and_removed(self):
+        with self.assertRaises(media.MediaError) as raised:
+            media.store_stream(io.BytesIO(b"x" * (media.CHUNK_SIZE * 2)), max_bytes=media.CHUNK_SIZE)
+
+        self.assertEqual(raised.exception.status_code, 413)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_only_profile_pictures_served_publicly(self):
+        digest, _, _ = media.store_stream(io.BytesIO(b"%PDF-1.4 course handout"))
+        app = Flask(__name__)
+
+        with app.test_request_context(), mock.patch.object(media, "is_profile_picture", return_value=False):
+            with self.assertRaises(NotFound):
+                media.send_blob(digest)
+        with app.test_request_context(), mock.patch.object(media, "is_profile_picture", return_value=True):
+            self.assertEqual(media.send_blob(digest).status_code, 200)
+
+
+class CompressionTestCase(unittest.TestCase):
+    """Response compression and its cache of compressed bodies; needs no database."""
+
+    def setUp(self):
+        self.cache = compression.cache
+        compression.cache = compression.CompressedCache()
+        self.app = Flask(__name__)
+        self.app.after_request(compression.compress_response)
+
+        @self.app.route("/rows/<int:count>")
+        def rows(count):
+            return jsonify({"rows": [{"id": i, "name": "student {}".format(i)} for i in range(count)]})
+
+    def tearDown(self):
+        compression.cache = self.cache
+
+    def test_gzip_body_compressed_once_per_content(self):
+        client = self.app.test_client()
+        first = client.get("/rows/200", headers={"Accept-Encoding": "gzip"})
+        second = client.get("/rows/200", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(first.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", first.headers["Vary"])
+        self.assertEqual(json.loads(gzip.decompress(first.data))["rows"][199]["id"], 199)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual((compression.cache.misses, compression.cache.hits), (1, 1))
+
+    def test_small_or_unaccepted_bodies_sent_as_is(self):
+        client = self.app.test_client()
+        small = client.get("/rows/1", headers={"Accept-Encoding": "gzip"})
+        identity = client.get("/rows/200")
+
+        self.assertNotIn("Content-Encoding", small.headers)
+        self.assertNotIn("Content-Encoding", identity.headers)
+        self.assertEqual(len(json.loads(identity.data)["rows"]), 200)
+
+    def test_encoding_follows_client_preference(self):
+        with self.app.test_request_context(headers={"Accept-Encoding": "gzip;q=1.0, br;q=0.5"}):
+            self.assertEqual(compression.choose_encoding(request.accept_encodings), "gzip")
+        with self.app.test_request_context(headers={"Accept-Encoding": "identity"}):
+            self.assertIsNone(compression.choose_encoding(request.accept_encodings))
+
+    def test_cache_evicts_least_recently_used_bytes(self):
+        cache = compression.CompressedCache(max_bytes=25)
+        cache.put("a", b"x" * 10)
+        cache.put("b", b"x" * 10)
+        cache.get("a")
+        cache.put("c", b"x" * 10)
+        cache.put("huge", b"x" * 26)
+
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNone(cache.get("huge"))
+        self.assertEqual(cache.bytes, 20)
+
+
+class FakeCursor:
+    """Answers each execute with the next canned result set."""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.executed = []
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """The cohort subset SQL and the DDL a restore drops and rebuilds; needs no database."""
+
+    def test_every_table_has_a_cohort_subset(self):
+        for table in snapshots.tables():
+            self.assertTrue(
+                table.name in snapshots.COHORT_SUBSET or table.name in snapshots.OPERATIONAL_TABLES,
+                "no cohort subset for {}".format(table.name),
+            )
+
+    def test_cohort_subset_only_binds_the_cohort(self):
+        for name, where in snapshots.COHORT_SUBSET.items():
+            self.assertIn("%(cohort)s", where, name)
+            # any other % would break mogrify
+            self.assertNotIn("%", where.replace("%(cohort)s", ""), name)
+
+    def test_users_kept_for_every_kept_row(self):
+        users = snapshots.COHORT_SUBSET["users"]
+        for table in snapshots.tables():
+            if table.name in snapshots.OPERATIONAL_TABLES:
+                continue
+            if any(key.column.table.name == "users" for key in table.foreign_keys):
+                self.assertIn("FROM {} WHERE".format(table.name), users)
+
+    def test_deferred_ddl_drops_foreign_keys_first_and_rebuilds_them_last(self):
+        cursor = FakeCursor(
+            [
+                ("users", "users_email_key", "u", "UNIQUE (email)"),
+                ("admins", "admins_student_id_fkey", "f", "FOREIGN KEY (student_id) REFERENCES students(id)"),
+            ],
+            [("students", "ix_students_program", "CREATE INDEX ix_students_program ON public.students USING btree (student_program)")],
+        )
+
+        drop, build, foreign_keys = snapshots.deferred_ddl(cursor, ["users", "students", "admins"])
+
+        self.assertEqual(drop, [
+            'ALTER TABLE admins DROP CONSTRAINT "admins_student_id_fkey"',
+            'ALTER TABLE users DROP CONSTRAINT "users_email_key"',
+            'DROP INDEX "ix_students_program"',
+        ])
+        self.assertEqual(build, {
+            "students": ["CREATE INDEX ix_students_program ON public.students USING btree (student_program)"],
+            "users": ['ALTER TABLE users ADD CONSTRAINT "users_email_key" UNIQUE (email)'],
+        })
+        self.assertEqual(foreign_keys, [
+            'ALTER TABLE admins ADD CONSTRAINT "admins_student_id_fkey" FOREIGN KEY (student_id) REFERENCES students(id)',
+        ])
+        self.assertEqual([params for _, params in cursor.executed], [{"tables": ["users", "students", "admins"]}] * 2)
+
+
+class StatementCacheTestCase(unittest.TestCase):
+    """The lambda statements share compiled SQL per model and column, never across them; needs no database."""
+
+    def cache_keys(self, *calls):
+        executed = []
+        with mock.patch.object(statements.db, "session") as session:
+            session.execute.side_effect = lambda stmt: executed.append(stmt) or mock.MagicMock()
+            for fn, args in calls:
+                fn(*args)
+        return [stmt._generate_cache_key() for stmt in executed]
+
+    def test_pages_share_sql_per_model_only(self):
+        students, later_students, courses = self.cache_keys(
+            (statements.page, (Student, 0, 10)),
+            (statements.page, (Student, 20, 5)),
+            (statements.page, (Course, 0, 10)),
+        )
+
+        self.assertEqual(students.key, later_students.key)
+        self.assertNotEqual(students.key, courses.key)
+        self.assertLessEqual({20, 5}, {bind.value for bind in later_students.bindparams})
+
+    def test_searches_share_sql_per_column_only(self):
+        java, python, programs = self.cache_keys(
+            (statements.page, (Course, 0, 5, Course.course_title, "%jav%")),
+            (statements.page, (Course, 0, 5, Course.course_title, "%py%")),
+            (statements.page, (Student, 0, 5, Student.student_program, "%py%")),
+        )
+
+        self.assertEqual(java.key, python.key)
+        self.assertNotEqual(python.key, programs.key)
+        self.assertIn("%py%", [bind.value for bind in python.bindparams])
+        self.assertNotIn("%jav%", [bind.value for bind in python.bindparams])
+
+    def test_counts_share_sql_per_model_only(self):
+        students, courses, searched = self.cache_keys(
+            (statements.count, (Student,)),
+            (statements.count, (Course,)),
+            (statements.count, (Course, Course.course_title, "%py%")),
+        )
+
+        self.assertNotEqual(students.key, courses.key)
+        self.assertNotEqual(courses.key, searched.key)
+
+
+class SchemaTestCase(unittest.TestCase):
+    """Request body schemas built from the models; needs no database."""
+
+    def errors(self, body, **kwargs):
+        with self.assertRaises(schemas.SchemaError) as raised:
+            schemas.students.load(body, **kwargs)
+        return [(error["field"], error["message"]) for error in raised.exception.errors]
+
+    def test_columns_with_defaults_optional_on_create(self):
+        values = schemas.students.load({"course_id": 1})
+
+        self.assertEqual(values["course_id"], 1)
+        self.assertIsNone(values["program_start_date"])
+        self.assertEqual(self.errors({}), [("course_id", "is required")])
+
+    def test_end_before_start_rejected_by_field(self):
+        body = {"course_id": 1, "program_start_date": "2022-03-01", "program_end_date": "2022-02-01"}
+
+        self.assertEqual(self.errors(body), [("program_end_date", "must not be before program_start_date")])
+        self.assertEqual(schemas.students.load(dict(body, program_end_date="2022-03-01"))["course_id"], 1)
+
+    def test_edit_checked_against_the_stored_row(self):
+        row = types.SimpleNamespace(program_start_date=datetime.datetime(2022, 3, 1), program_end_date=datetime.datetime(2022, 6, 1))
+
+        self.assertEqual(
+            self.errors({"program_end_date": "2022-02-01"}, partial=True, current=row),
+            [("program_end_date", "must not be before program_start_date")],
+        )
+        self.assertEqual(schemas.students.load({"program_end_date": "2022-04-01"}, partial=True, current=row), {
+            "program_end_date": datetime.datetime(2022, 4, 1),
+        })
+        self.assertEqual(self.errors({"program_start_date": None}, partial=True, current=row), [("program_start_date", "must not be null")])
+
+
+class GradeEntryTestCase(unittest.TestCase):
+    """How bulk-graded weeks and grades are written; needs no database."""
+
+    def test_week_spellings_normalized(self):
+        for week in (3, "3", "week 3", " Week 03 "):
+            self.assertEqual(grades.normalize_week(week), "Week 3")
+        self.assertEqual(grades.normalize_week("Final project"), "Final project")
+        self.assertIsNone(grades.normalize_week(True))
+        self.assertIsNone(grades.normalize_week("  "))
+
+    def test_grades_written_in_fixed_point(self):
+        self.assertEqual(grades.format_grade(85), "85")
+        self.assertEqual(grades.format_grade(72.5), "72.5")
+        self.assertEqual(grades.format_grade(100.0), "100")
+        self.assertEqual(grades.format_grade(0.00001), "0.00001")
+
+    def test_duplicated_legacy_rows_all_updated(self):
+        course = types.SimpleNamespace(id=7, course_title="Data Science")
+        legacy = [
+            types.SimpleNamespace(id=1, student_id=3, project_grade="60"),
+            types.SimpleNamespace(id=2, student_id=3, project_grade="65"),
+            types.SimpleNamespace(id=4, student_id=5, project_grade="90"),
+        ]
+        with mock.patch.object(grades.db, "session") as session, \
+                mock.patch.object(grades, "record_changes") as record, \
+                mock.patch.object(grades.results, "cache"):
+            connection = session.connection.return_value
+            connection.execute.side_effect = [None, legacy, None]
+            result = grades.upsert_grades(course, "Week 3", 9, {3: "80", 5: "90"})
+
+        self.assertEqual(connection.execute.call_args_list[2].args[1], [{"row_id": 1, "grade": "80"}, {"row_id": 2, "grade": "80"}])
+        self.assertEqual([change["entity_id"] for change in record.call_args.args[1]], [1, 2])
+        self.assertEqual((result["updated"], result["unchanged"], result["inserted"]), (1, 1, 0))
+
+
+class PrincipalTestCase(unittest.TestCase):
+    """Resolving the caller from the token's sub claim; needs no database."""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        principals.invalidate("auth0|7", "auth0|unknown")
+        self.principal = principals.Principal(7, "auth0|7", "instructor", "ada@nupat.test", "ada")
+
+    def tearDown(self):
+        principals.invalidate("auth0|7", "auth0|unknown")
+
+    def test_principal_resolved_from_sub_once(self):
+        with mock.patch.object(principals, "_load", return_value=self.principal) as load:
+            with self.app.test_request_context():
+                g.auth_payload = {"sub": "auth0|7"}
+                self.assertEqual(principals.current_principal().user_id, 7)
+            with self.app.test_request_context():
+                g.auth_payload = {"sub": "auth0|7"}
+                self.assertIs(principals.current_principal(), self.principal)
+
+        load.assert_called_once_with("auth0|7")
+
+    def test_unknown_or_missing_sub_has_no_principal(self):
+        with mock.patch.object(principals, "_load", return_value=None) as load:
+            with self.app.test_request_context():
+                g.auth_payload = {"sub": "auth0|unknown"}
+                self.assertIsNone(principals.current_principal())
+            with self.app.test_request_context():
+                g.auth_payload = {}
+                self.assertIsNone(principals.current_principal())
+            self.assertIsNone(principals.resolve("auth0|unknown"))
+
+        load.assert_called_once_with("auth0|unknown")
+
+    def test_invalidated_subject_loaded_again(self):
+        with mock.patch.object(principals, "_load", return_value=self.principal) as load:
+            principals.resolve("auth0|7")
+            principals.invalidate("auth0|7")
+            principals.resolve("auth0|7")
+
+        self.assertEqual(load.call_count, 2)
+
+
+class EventStreamTestCase(unittest.TestCase):
+    """The per-worker cap on /events connections; only the endpoint test needs a database."""
+
+    def test_subscribers_beyond_cap_refused(self):
+        broadcaster = events.Broadcaster(backend="local", max_streams=2)
+        first = broadcaster.subscribe()
+        second = broadcaster.subscribe()
+
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(broadcaster.subscribe())
+        broadcaster.unsubscribe(first)
+        self.assertIsNotNone(broadcaster.subscribe())
+        self.assertEqual(broadcaster.stats()["subscribers"], 2)
+
+    def test_503_when_worker_streams_exhausted(self):
+        token = os.getenv("TEST_AUTH_TOKEN")
+        if not token:
+            self.skipTest("TEST_AUTH_TOKEN is not set")
+        app = create_app()
+        setup_db(app, 'postgresql+psycopg2://{}:{}@{}:{}/{}'.format(
+            os.getenv("DB_USER"), os.getenv("DB_PASSWORD"), os.getenv("DB_HOST"), os.getenv("DB_PORT"), os.getenv("TEST_DB_NAME")))
+        headers = {"Authorization": "Bearer {}".format(token)}
+
+        opened = []
+        with mock.patch.object(events.broadcaster, "max_streams", 2):
+            try:
+                for _ in range(3):
+                    opened.append(app.test_client().get("/events", headers=headers))
+                    if opened[-1].status_code == 200:
+                        # start the body so closing it unsubscribes
+                        next(opened[-1].response)
+            finally:
+                for res in opened:
+                    res.close()
+
+        self.assertEqual([res.status_code for res in opened], [200, 200, 503])
+        self.assertEqual(events.broadcaster.stats()["subscribers"], 0)
+
+
+class ServerTestCase(unittest.TestCase):
+    """The production launcher's sizing and boot-time cache warming."""
+
+    def test_worker_count_from_environment(self):
+        with mock.patch.dict(os.environ, {"WEB_CONCURRENCY": "3"}):
+            self.assertEqual(server.worker_count(), 3)
+        with mock.patch.dict(os.environ):
+            os.environ.pop("WEB_CONCURRENCY", None)
+            self.assertGreaterEqual(server.worker_count(), 3)
+
+    def test_streams_served_by_gevent_workers_sized_by_connections(self):
+        args = argparse.Namespace(bind="127.0.0.1:5001", workers=2, threads=4, pid="streams.pid", streams=True)
+        config = server.gunicorn_config(args)
+
+        self.assertEqual(config["worker_class"], "gevent")
+        self.assertGreater(config["worker_connections"], events.EVENTS_MAX_SUBSCRIBERS)
+        self.assertNotIn("threads", config)
+        self.assertEqual(config["max_requests"], 0)
+
+    def test_api_served_by_gthread_workers(self):
+        args = argparse.Namespace(bind="127.0.0.1:5000", workers=9, threads=4, pid="server.pid", streams=False)
+        hook = lambda server, worker: None
+        config = server.gunicorn_config(args, {"post_fork": hook})
+
+        self.assertEqual((config["worker_class"], config["threads"], config["workers"]), ("gthread", 4, 9))
+        self.assertIs(config["post_fork"], hook)
+
+    def test_failed_warming_step_logged_and_skipped(self):
+        app = create_app()
+        setup_db(app, 'postgresql+psycopg2://{}:{}@{}:{}/{}'.format(
+            os.getenv("DB_USER"), os.getenv("DB_PASSWORD"), os.getenv("DB_HOST"), os.getenv("DB_PORT"), os.getenv("TEST_DB_NAME")))
+
+        with mock.patch.object(server, "configure_mappers", side_effect=RuntimeError("boom")):
+            with self.assertLogs(app.logger, "ERROR"):
+                timings = server.warm_caches(app)
+
+        for name in ("mappers", "students", "courses", "instructors", "cohorts"):
+            self.assertIn(name, timings)
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
@@ -0,0 +1,13 @@
+"""
+WSGI entry point for any WSGI server, e.g.
+
+    gunicorn --preload --workers 9 --threads 4 wsgi:app
+
+with --preload the app is created and warmed once in the master process.
+python -m nupatcodeclass.server wraps the same thing with sensible defaults.
+"""
+from nupatcodeclass import create_app
+from nupatcodeclass.server import warm_caches
+
+app = create_app()
+warm_caches(app)